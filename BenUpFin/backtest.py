@@ -0,0 +1,151 @@
+from typing import NamedTuple
+import numpy as np
+import pandas as pd
+from BenUpFin.sharedReturns import ReturnsMatrix
+from BenUpFin.covEstimators import CovarianceEstimator, RollingCovariance
+from BenUpFin.portOptimization import _box_bounds, solve_frontier_qp, max_sharpe_weights
+
+
+def equal_weight():
+    """
+    @return: strategy holding every asset with the same weight.
+    """
+    def strategy(mean, cov, previous):
+        return np.full(len(mean), 1 / len(mean))
+    return strategy
+
+
+def min_volatility(short=False, bounds=None):
+    """
+    @return: strategy holding the minimum volatility portfolio of the window (see portOptimization.solve_frontier_qp),
+    warm-started from the previous weights.
+    """
+    def strategy(mean, cov, previous):
+        lower, upper = _box_bounds(bounds, len(mean), short)
+        return solve_frontier_qp(mean, cov, 0, lower, upper, x0=previous)
+    return strategy
+
+
+def max_sharpe(rf_rate: float = 0, short=False, bounds=None):
+    """
+    @param rf_rate: risk free rate per period of the returns (e.g. daily).
+    @return: strategy holding the maximum sharpe ratio portfolio of the window (see portOptimization.max_sharpe_weights).
+    """
+    def strategy(mean, cov, previous):
+        lower, upper = _box_bounds(bounds, len(mean), short)
+        return max_sharpe_weights(mean, cov, rf_rate, lower, upper)
+    return strategy
+
+
+STRATEGIES = {'equal_weight': equal_weight, 'min_volatility': min_volatility, 'max_sharpe': max_sharpe}
+
+
+class BacktestResult(NamedTuple):
+    """
+    returns: Dataframe of the realized (net of costs) portfolio returns, one column per strategy.
+    weights: {strategy: Dataframe of the target weights set at each rebalance date}.
+    turnover: Dataframe of the turnover (sum of absolute weight changes) at each rebalance date, one column per
+    strategy.
+    """
+    returns: pd.DataFrame
+    weights: dict
+    turnover: pd.DataFrame
+
+    def wealth(self) -> pd.DataFrame:
+        return (1 + self.returns).cumprod()
+
+
+class WalkForward:
+
+    def __init__(self, returns, lookback: int = 252, rebalance='M', costs: float = 0, estimator=None):
+        """
+        Walk-forward backtest: at each rebalance date the strategies are given the mean and covariance of the last
+        `lookback` returns and set their target weights, which are held (drifting with the prices) until the next
+        rebalance date. The window statistics are updated incrementally from one rebalance date to the next (only
+        the returns entering and leaving the window are processed) and shared by all the strategies, which are run
+        in a single pass over the data.
+        @param returns: Dataframe of daily (percent) returns or sharedReturns.ReturnsMatrix, oldest first.
+        @param lookback: number of returns in the estimation window.
+        @param rebalance: rebalance calendar: a pandas period frequency ("W", "M", "Q", "Y": the last date of each
+        period), an int (every n dates) or a list of dates.
+        @param costs: transaction costs as a fraction of the traded value (e.g. 0.001 for 10bp), charged on the
+        date following the rebalance.
+        @param estimator: covEstimators estimator computing the statistics, e.g. EWMACovariance or
+        LedoitWolfCovariance(lookback). It must not have been fed yet: it is only used as a template, each run
+        starting from a copy of it. Default RollingCovariance(lookback), the sample mean and covariance of the
+        window.
+        """
+        frame = returns.to_frame() if isinstance(returns, ReturnsMatrix) else returns
+        self.values = np.ascontiguousarray(frame.values, dtype=np.float64)
+        self.index = frame.index
+        self.columns = list(frame.columns)
+        self.lookback = int(lookback)
+        self.rebalance = rebalance
+        self.costs = costs
+        self.estimator = RollingCovariance(self.lookback) if estimator is None else estimator
+        if len(self.values) <= self.lookback:
+            raise Exception("Not enough returns for the lookback window.")
+
+    def rebalance_positions(self) -> np.ndarray:
+        """
+        @return: row positions of the rebalance dates having a full lookback window (the last date is excluded as
+        nothing is held after it).
+        """
+        length = len(self.values)
+        if isinstance(self.rebalance, (int, np.integer)):
+            positions = np.arange(self.lookback - 1, length, int(self.rebalance))
+        elif isinstance(self.rebalance, str):
+            periods = pd.DatetimeIndex(self.index).to_period(self.rebalance)
+            positions = np.flatnonzero(periods[1:] != periods[:-1])
+        else:
+            dates = pd.DatetimeIndex(self.rebalance)
+            positions = np.unique(np.searchsorted(self.index, dates, side='right') - 1)
+        return positions[(positions >= self.lookback - 1) & (positions < length - 1)]
+
+    def run(self, strategies) -> BacktestResult:
+        """
+        @param strategies: {name: strategy}, a strategy being a name of STRATEGIES (run with its default parameters)
+        or a callable (mean, cov, previous weights or None) -> target weights. A list of names is also accepted.
+        @return: BacktestResult.
+        """
+        if not isinstance(strategies, dict):
+            strategies = {name: name for name in strategies}
+        names = list(strategies)
+        functions = [STRATEGIES[strategy]() if isinstance(strategy, str) else strategy
+                     for strategy in strategies.values()]
+        positions = self.rebalance_positions()
+        if len(positions) == 0:
+            raise Exception("No rebalance date with a full lookback window.")
+
+        nb_strategies, nb_assets = len(names), self.values.shape[1]
+        holdings = np.zeros((nb_strategies, nb_assets))
+        targets = np.empty((len(positions), nb_strategies, nb_assets))
+        turnover = np.empty((len(positions), nb_strategies))
+        returns = np.zeros((len(self.values) - positions[0] - 1, nb_strategies))
+        first = positions[0] + 1
+        # a fresh copy per run: stateful (expanding, EWMA) estimators would otherwise absorb the history twice
+        estimator = CovarianceEstimator.from_state(self.estimator.state_dict())
+        for i, position in enumerate(positions):
+            estimator.update(self.values[positions[i - 1] + 1 if i else 0:position + 1])
+            mean, cov = estimator.mean(), estimator.covariance()
+            for j, function in enumerate(functions):
+                targets[i, j] = function(mean, cov, holdings[j] if i else None)
+            turnover[i] = np.abs(targets[i] - holdings).sum(axis=1)
+
+            # hold the targets until the next rebalance date: the value of each position follows the cumulated
+            # returns of its asset, so the weights drift and the portfolio return is the growth of the total value
+            stop = positions[i + 1] + 1 if i + 1 < len(positions) else len(self.values)
+            growth = np.cumprod(1 + self.values[position + 1:stop], axis=0)
+            value = growth @ targets[i].T
+            segment = value / np.vstack([np.ones((1, nb_strategies)), value[:-1]]) - 1
+            # the cost of the trades is charged on the first holding date
+            segment[0] = (1 + segment[0]) * (1 - self.costs * turnover[i]) - 1
+            returns[position + 1 - first:stop - first] = segment
+            holdings = targets[i] * growth[-1] / value[-1][:, None]
+
+        dates = self.index[positions]
+        return BacktestResult(
+            returns=pd.DataFrame(returns, index=self.index[first:], columns=names),
+            weights={name: pd.DataFrame(targets[:, j], index=dates, columns=self.columns)
+                     for j, name in enumerate(names)},
+            turnover=pd.DataFrame(turnover, index=dates, columns=names))
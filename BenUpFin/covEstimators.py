@@ -0,0 +1,258 @@
+import numpy as np
+from scipy.linalg.blas import dgemm
+
+
+def _as_rows(returns) -> np.ndarray:
+    """
+    @return: (k x n) float array of one return vector (size n) or of k rows of returns (Dataframe or array).
+    """
+    values = np.asarray(getattr(returns, 'values', returns), dtype=np.float64)
+    return values[None] if values.ndim == 1 else values
+
+
+class CovarianceEstimator:
+
+    # constructor parameters and state arrays saved by state_dict
+    _parameters = ()
+    _arrays = ()
+
+    def __init__(self):
+        """
+        Base class of the streaming covariance estimators. update absorbs new returns (one day in O(n^2), a block of
+        k days with a single O(k.n^2) matrix product); mean and covariance read the current estimates. The whole
+        state is a dictionary of arrays (state_dict / from_state) that can be saved to and loaded from a npz file,
+        so a daily batch only has to load yesterday's state and absorb today's returns.
+        """
+        self.count = 0
+
+    def update(self, returns) -> "CovarianceEstimator":
+        raise NotImplementedError
+
+    def mean(self) -> np.ndarray:
+        raise NotImplementedError
+
+    def covariance(self) -> np.ndarray:
+        raise NotImplementedError
+
+    def correlation(self) -> np.ndarray:
+        covariance = self.covariance()
+        std = np.sqrt(np.diag(covariance))
+        return covariance / np.outer(std, std)
+
+    def state_dict(self) -> {}:
+        """
+        @return: {name: array} holding the estimator type, its parameters and its state.
+        """
+        state = {'estimator': np.array(type(self).__name__), 'count': np.array(self.count)}
+        for name in self._parameters + self._arrays:
+            value = getattr(self, name)
+            # None is stored as an empty array
+            state[name] = np.empty(0) if value is None else np.asarray(value)
+        return state
+
+    @staticmethod
+    def from_state(state: {}) -> "CovarianceEstimator":
+        """
+        Rebuild an estimator from the output of state_dict (or the content of a file written by save).
+        """
+        def decode(value):
+            value = np.asarray(value)
+            if value.size == 0:
+                return None
+            return value.item() if value.ndim == 0 else value.copy()
+
+        cls = ESTIMATORS[str(np.asarray(state['estimator']))]
+        estimator = cls(**{name: decode(state[name]) for name in cls._parameters})
+        estimator.count = int(np.asarray(state['count']))
+        for name in cls._arrays:
+            setattr(estimator, name, decode(state[name]))
+        return estimator
+
+    def save(self, path: str):
+        np.savez(path, **self.state_dict())
+
+    @staticmethod
+    def load(path: str) -> "CovarianceEstimator":
+        with np.load(path) as state:
+            return CovarianceEstimator.from_state(dict(state))
+
+
+class RollingCovariance(CovarianceEstimator):
+
+    _parameters = ('window', 'ddof')
+    _arrays = ('shift', 'sums', 'products', 'buffer', 'position')
+
+    def __init__(self, window: int = None, ddof: int = 1):
+        """
+        Sample mean and covariance of the last `window` returns (of every return absorbed when window is None),
+        kept as running sums of the returns and of their cross products. A new day adds its outer product and, once
+        the window is full, removes the one of the day leaving the window, which is kept in a circular buffer.
+        Returns are shifted by the first one absorbed to limit the cancellation in the sums.
+        @param ddof: 1 as DataFrame.cov, 0 as np.cov(bias=True).
+        """
+        super().__init__()
+        self.window = window
+        self.ddof = ddof
+        self.shift = None
+        self.sums = None
+        self.products = None
+        self.buffer = None
+        self.position = 0
+
+    def _start(self, nb_assets: int, first: np.ndarray):
+        self.shift = first.copy()
+        self.sums = np.zeros(nb_assets)
+        self.products = np.zeros((nb_assets, nb_assets))
+        if self.window is not None:
+            self.buffer = np.zeros((self.window, nb_assets))
+
+    def _add(self, rows: np.ndarray, signs: np.ndarray):
+        """
+        Add (sign 1) or remove (sign -1) rows from the sums.
+        """
+        signed = rows * signs[:, None]
+        self.sums += signed.sum(axis=0)
+        # products += rows' diag(signs) rows, in place: products is symmetric so its transpose is a Fortran ordered
+        # view that BLAS can update without any n x n temporary
+        dgemm(1.0, signed, rows, beta=1.0, c=self.products.T, trans_a=1, overwrite_c=1)
+
+    def update(self, returns) -> "RollingCovariance":
+        """
+        @param returns: one return vector or (k x n) returns, oldest first.
+        """
+        rows = _as_rows(returns)
+        if len(rows) == 0:
+            return self
+        if self.sums is None:
+            self._start(rows.shape[1], rows[0])
+        rows = rows - self.shift
+        if self.window is None:
+            self._add(rows, np.ones(len(rows)))
+            self.count += len(rows)
+            return self
+
+        if len(rows) >= self.window:
+            # the whole window is replaced
+            rows = rows[-self.window:]
+            self.sums[:] = 0
+            self.products[:] = 0
+            self._add(rows, np.ones(len(rows)))
+            self.buffer[:] = rows
+            self.position = 0
+            self.count = self.window
+            return self
+
+        k = len(rows)
+        leaving = max(0, self.count + k - self.window)
+        # the oldest rows start count slots before the next free one and are the first to be overwritten
+        oldest = (self.position - self.count + np.arange(leaving)) % self.window
+        self._add(np.vstack([rows, self.buffer[oldest]]), np.r_[np.ones(k), -np.ones(leaving)])
+        self.buffer[(self.position + np.arange(k)) % self.window] = rows
+        self.position = (self.position + k) % self.window
+        self.count = min(self.count + k, self.window)
+        return self
+
+    def mean(self) -> np.ndarray:
+        return self.sums / self.count + self.shift
+
+    def covariance(self) -> np.ndarray:
+        centered = self.products - np.outer(self.sums, self.sums) / self.count
+        return centered / (self.count - self.ddof)
+
+
+class LedoitWolfCovariance(RollingCovariance):
+
+    _parameters = ('window',)
+    _arrays = RollingCovariance._arrays + ('cubes', 'quartic')
+
+    def __init__(self, window: int = None):
+        """
+        Ledoit-Wolf shrinkage of the (ddof=0) sample covariance towards a scaled identity, as
+        sklearn.covariance.ledoit_wolf, over the last `window` returns (or every return absorbed). The shrinkage
+        intensity needs sum_t |x_t|^4 of the centered returns x_t = r_t - mean; expanding the square it only depends
+        on running sums of r_t, r_t r_t', |r_t|^2 r_t and |r_t|^4, which are updated like the sample moments.
+        """
+        super().__init__(window, ddof=0)
+        self.cubes = None
+        self.quartic = None
+
+    def _start(self, nb_assets: int, first: np.ndarray):
+        super()._start(nb_assets, first)
+        self.cubes = np.zeros(nb_assets)
+        self.quartic = 0.0
+
+    def _add(self, rows: np.ndarray, signs: np.ndarray):
+        super()._add(rows, signs)
+        squaredNorms = np.einsum('ij,ij->i', rows, rows)
+        self.cubes += (signs * squaredNorms) @ rows
+        self.quartic += float(signs @ squaredNorms ** 2)
+
+    def shrinkage(self) -> float:
+        """
+        @return: shrinkage intensity in [0, 1].
+        """
+        count, nb_assets = self.count, len(self.sums)
+        center = self.sums / count
+        sample = self.products / count - np.outer(center, center)
+        target = np.trace(sample) / nb_assets
+        delta = (np.sum(sample ** 2) - 2 * target * np.trace(sample) + target ** 2 * nb_assets) / nb_assets
+        if delta <= 0:
+            return 0.0
+        # sum_t |r_t - c|^4 with |r_t - c|^2 = |r_t|^2 - 2 r_t.c + |c|^2
+        squaredCenter = center @ center
+        quartic = (self.quartic + 4 * center @ self.products @ center + count * squaredCenter ** 2
+                   - 4 * self.cubes @ center + 2 * squaredCenter * np.trace(self.products)
+                   - 4 * squaredCenter * (self.sums @ center))
+        beta = (quartic / count - np.sum(sample ** 2)) / (count * nb_assets)
+        return float(min(max(beta, 0), delta) / delta)
+
+    def covariance(self) -> np.ndarray:
+        sample = super().covariance()
+        shrinkage = self.shrinkage()
+        shrunk = (1 - shrinkage) * sample
+        shrunk.flat[::len(sample) + 1] += shrinkage * np.trace(sample) / len(sample)
+        return shrunk
+
+
+class EWMACovariance(CovarianceEstimator):
+
+    _parameters = ('decayFactor',)
+    _arrays = ('ewmaMean', 'ewmaCovariance')
+
+    def __init__(self, decayFactor: float = 0.94):
+        """
+        RiskMetrics exponentially weighted covariance cov[t] = decay * cov[t-1] + (1 - decay) * r[t] r[t]' (returns
+        are not demeaned, as in riskMetrics.ewma_variance), seeded with the mean cross product of the first block of
+        returns absorbed. The mean returned is the exponentially weighted mean with the same decay.
+        """
+        super().__init__()
+        self.decayFactor = decayFactor
+        self.ewmaMean = None
+        self.ewmaCovariance = None
+
+    def update(self, returns) -> "EWMACovariance":
+        """
+        @param returns: one return vector or (k x n) returns, oldest first. A block of k returns is absorbed with a
+        single weighted matrix product.
+        """
+        rows = _as_rows(returns)
+        k = len(rows)
+        if k == 0:
+            return self
+        if self.ewmaCovariance is None:
+            self.ewmaMean = rows.mean(axis=0)
+            self.ewmaCovariance = rows.T @ rows / k
+        weights = (1 - self.decayFactor) * self.decayFactor ** np.arange(k - 1, -1, -1)
+        self.ewmaMean = self.decayFactor ** k * self.ewmaMean + weights @ rows
+        self.ewmaCovariance = self.decayFactor ** k * self.ewmaCovariance + (rows * weights[:, None]).T @ rows
+        self.count += k
+        return self
+
+    def mean(self) -> np.ndarray:
+        return self.ewmaMean
+
+    def covariance(self) -> np.ndarray:
+        return self.ewmaCovariance
+
+
+ESTIMATORS = {cls.__name__: cls for cls in (RollingCovariance, LedoitWolfCovariance, EWMACovariance)}
@@ -0,0 +1,305 @@
+import numpy as np
+import pandas as pd
+from scipy.special import gammaln, digamma
+
+
+def _as_matrix(returns) -> (np.ndarray, pd.Index, list):
+    """
+    @return: (T x m) float array, the date index and the series names of a Series / Dataframe / array input.
+    """
+    if isinstance(returns, pd.Series):
+        return returns.values.astype(np.float64)[:, None], returns.index, [returns.name]
+    if isinstance(returns, pd.DataFrame):
+        return returns.values.astype(np.float64), returns.index, list(returns.columns)
+    values = np.asarray(returns, dtype=np.float64)
+    values = values[:, None] if values.ndim == 1 else values
+    return values, pd.RangeIndex(len(values)), list(range(values.shape[1]))
+
+
+def garch_recursion(eps: np.ndarray, omega, alpha, beta, backcast, gradient: bool = False):
+    """
+    GARCH(1,1) conditional variance sigma2[t] = omega + alpha * eps[t-1]**2 + beta * sigma2[t-1] of m series at once.
+    The loop runs over time only, every operation being vectorized over the series.
+    @param eps: (T x m) residuals.
+    @param backcast: (m,) variance used for the first date.
+    @param gradient: also return d sigma2 / d(mu, omega, alpha, beta) as a (T x 4 x m) array.
+    @return: (T + 1) x m variances, the last row being the one step ahead forecast (and the gradient if asked).
+    """
+    length, nb_series = eps.shape
+    sigma2 = np.empty((length + 1, nb_series))
+    sigma2[0] = backcast
+    sqrdEps = eps ** 2
+    if not gradient:
+        for i in range(1, length + 1):
+            sigma2[i] = omega + alpha * sqrdEps[i - 1] + beta * sigma2[i - 1]
+        return sigma2
+
+    derivative = np.zeros((length + 1, 4, nb_series))
+    for i in range(1, length + 1):
+        sigma2[i] = omega + alpha * sqrdEps[i - 1] + beta * sigma2[i - 1]
+        derivative[i, 0] = -2 * alpha * eps[i - 1]
+        derivative[i, 1] = 1
+        derivative[i, 2] = sqrdEps[i - 1]
+        derivative[i, 3] = sigma2[i - 1]
+        derivative[i] += beta * derivative[i - 1]
+    return sigma2, derivative
+
+
+def negative_loglikelihood(params: np.ndarray, returns: np.ndarray, backcast: np.ndarray, dist: str = 'normal'):
+    """
+    Negative log-likelihood of m GARCH(1,1) models with constant mean and its gradient.
+    @param params: (k x m) array, rows mu, omega, alpha, beta (and nu for the student distribution).
+    @param returns: (T x m) returns.
+    @return: (m,) negative log-likelihoods and their (k x m) gradient.
+    """
+    mu, omega, alpha, beta = params[:4]
+    eps = returns - mu
+    sigma2, derivative = garch_recursion(eps, omega, alpha, beta, backcast, gradient=True)
+    sigma2, derivative = sigma2[:-1], derivative[:-1]
+    ratio = eps ** 2 / sigma2
+
+    if dist == 'normal':
+        nll = 0.5 * np.sum(np.log(2 * np.pi) + np.log(sigma2) + ratio, axis=0)
+        dSigma2 = 0.5 * (1 - ratio) / sigma2
+        dEps = eps / sigma2
+        grad = np.einsum('tm,tkm->km', dSigma2, derivative)
+        grad[0] -= np.sum(dEps, axis=0)
+        return nll, grad
+
+    nu = params[4]
+    q = ratio / (nu - 2)
+    logq = np.log1p(q)
+    constant = gammaln((nu + 1) / 2) - gammaln(nu / 2) - 0.5 * np.log(np.pi * (nu - 2))
+    nll = np.sum(0.5 * np.log(sigma2) + (nu + 1) / 2 * logq, axis=0) - len(returns) * constant
+    weight = (nu + 1) / 2 * q / (1 + q)
+    dSigma2 = (0.5 - weight) / sigma2
+    dEps = (nu + 1) * eps / (sigma2 * (nu - 2) * (1 + q))
+    grad = np.zeros_like(params)
+    grad[:4] = np.einsum('tm,tkm->km', dSigma2, derivative)
+    grad[0] -= np.sum(dEps, axis=0)
+    dConstant = 0.5 * digamma((nu + 1) / 2) - 0.5 * digamma(nu / 2) - 0.5 / (nu - 2)
+    grad[4] = np.sum(0.5 * logq - weight / (nu - 2), axis=0) - len(returns) * dConstant
+    return nll, grad
+
+
+def _projected_gradient(x: np.ndarray, grad: np.ndarray, lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+    """
+    Gradient with the components pushing against an active bound set to 0.
+    """
+    return np.where((x <= lower) & (grad > 0) | (x >= upper) & (grad < 0), 0, grad)
+
+
+def batch_minimize(function, x0: np.ndarray, lower: np.ndarray, upper: np.ndarray, gtol: float = 1e-5,
+                   maxiter: int = 500) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Minimise m independent box-constrained problems at once with a projected BFGS: each column has its own inverse
+    Hessian approximation, line search and stopping test, the columns still running being evaluated together.
+    @param function: (x (k x j), columns (j,)) -> (values (j,), gradient (k x j)) of the given columns.
+    @param x0: (k x m) starting points.
+    @param lower: (k x m) lower bounds. upper: (k x m) upper bounds.
+    @param gtol: a column stops when the largest component of its projected gradient is below gtol.
+    @return: (k x m) solutions, (m,) largest projected gradient components and (m,) iteration counts.
+    """
+    nb_params, nb_series = x0.shape
+    x = np.clip(x0, lower, upper)
+    values, grad = function(x, np.arange(nb_series))
+    inverse = np.repeat(np.eye(nb_params)[None], nb_series, axis=0)
+    iterations = np.zeros(nb_series, dtype=int)
+    running = np.abs(_projected_gradient(x, grad, lower, upper)).max(axis=0) > gtol
+
+    for _ in range(maxiter):
+        columns = np.flatnonzero(running)
+        if len(columns) == 0:
+            break
+        xs, gs = x[:, columns], grad[:, columns]
+        lo, up = lower[:, columns], upper[:, columns]
+        # quasi-Newton step on the free variables only (bound-active components are held)
+        free = ~(((xs <= lo) & (gs > 0)) | ((xs >= up) & (gs < 0)))
+        mask = (free.T[:, :, None] & free.T[:, None, :])
+        direction = -np.einsum('jab,bj->aj', inverse[columns] * mask, gs * free)
+
+        # backtracking (Armijo) line search, column by column
+        step = np.ones(len(columns))
+        accepted = np.zeros(len(columns), dtype=bool)
+        newX, newValues, newGrad = xs.copy(), values[columns].copy(), gs.copy()
+        for _ in range(40):
+            pending = np.flatnonzero(~accepted)
+            if len(pending) == 0:
+                break
+            trial = np.clip(xs[:, pending] + step[pending] * direction[:, pending], lo[:, pending], up[:, pending])
+            trialValues, trialGrad = function(trial, columns[pending])
+            decrease = np.sum(gs[:, pending] * (trial - xs[:, pending]), axis=0)
+            ok = np.isfinite(trialValues) & (trialValues <= values[columns[pending]] + 1e-4 * decrease)
+            done = pending[ok]
+            newX[:, done], newValues[done], newGrad[:, done] = trial[:, ok], trialValues[ok], trialGrad[:, ok]
+            accepted[done] = True
+            step[pending[~ok]] *= 0.5
+        # columns without an acceptable step cannot make progress
+        running[columns[~accepted]] = False
+        columns, newX, newValues, newGrad = (columns[accepted], newX[:, accepted], newValues[accepted],
+                                             newGrad[:, accepted])
+
+        # BFGS update of the inverse Hessians with a positive curvature
+        s, y = newX - x[:, columns], newGrad - grad[:, columns]
+        curvature = np.sum(s * y, axis=0)
+        update = curvature > 1e-12 * np.sqrt(np.sum(s * s, axis=0) * np.sum(y * y, axis=0))
+        if update.any():
+            H, s, y, rho = inverse[columns[update]], s[:, update].T, y[:, update].T, 1 / curvature[update]
+            # the first update rescales the identity to the observed curvature
+            first = iterations[columns[update]] == 0
+            H[first] *= (1 / (rho[first] * np.einsum('ja,ja->j', y[first], y[first])))[:, None, None]
+            Hy = np.einsum('jab,jb->ja', H, y)
+            yHy = np.einsum('ja,ja->j', y, Hy)
+            H += ((1 + rho * yHy) * rho)[:, None, None] * s[:, :, None] * s[:, None, :] \
+                - rho[:, None, None] * (Hy[:, :, None] * s[:, None, :] + s[:, :, None] * Hy[:, None, :])
+            inverse[columns[update]] = H
+
+        x[:, columns], values[columns], grad[:, columns] = newX, newValues, newGrad
+        iterations[columns] += 1
+        norms = np.abs(_projected_gradient(newX, newGrad, lower[:, columns], upper[:, columns])).max(axis=0)
+        running[columns[norms <= gtol]] = False
+
+    return x, np.abs(_projected_gradient(x, grad, lower, upper)).max(axis=0), iterations
+
+
+class GARCH:
+
+    # the optimisation runs on persistence = alpha + beta and share = alpha / persistence, so that the box bounds
+    # keep every fitted model stationary
+    _bounds = {'mu': (-10, 10), 'omega': (1e-8, 10), 'persistence': (0, 1 - 1e-6), 'share': (0, 1), 'nu': (2.05, 200)}
+
+    def __init__(self, dist: str = 'normal'):
+        """
+        GARCH(1,1) with constant mean, normal ("normal") or standardized student ("t") innovations, fitted by
+        maximum likelihood on one or many series at once (see batch_minimize), with alpha + beta < 1. Fitted
+        parameters are kept, so refits after new observations can warm-start from them (see update).
+        """
+        if dist not in ('normal', 't'):
+            raise Exception("dist should be 'normal' or 't'.")
+        self.dist = dist
+        self.names = ['mu', 'omega', 'alpha', 'beta'] + (['nu'] if dist == 't' else [])
+        self.params = None
+        self.returns = None
+
+    def _start(self, nb_series: int) -> np.ndarray:
+        start = np.array([0, 0.05, 0.05, 0.90, 8][:len(self.names)], dtype=np.float64)
+        return np.repeat(start[:, None], nb_series, axis=1)
+
+    @staticmethod
+    def _to_internal(params: np.ndarray) -> np.ndarray:
+        # (mu, omega, alpha, beta, ...) -> (mu, omega, persistence, share, ...)
+        internal = params.copy()
+        internal[2] = params[2] + params[3]
+        internal[3] = np.divide(params[2], internal[2], out=np.full(params.shape[1], 0.5), where=internal[2] > 0)
+        return internal
+
+    @staticmethod
+    def _from_internal(internal: np.ndarray) -> np.ndarray:
+        params = internal.copy()
+        params[2] = internal[2] * internal[3]
+        params[3] = internal[2] * (1 - internal[3])
+        return params
+
+    def fit(self, returns, x0: pd.DataFrame() = None, maxiter: int = 500, gtol: float = 1e-4):
+        """
+        @param returns: Series, Dataframe (one series per column) or array of returns, oldest first.
+        @param x0: optional Dataframe of starting parameters (same layout as self.params), e.g. yesterday's fit.
+        @param maxiter: maximum number of iterations.
+        @param gtol: a series has converged when the largest component of its projected gradient (of the average
+        negative log-likelihood of the rescaled series) is below gtol. self.converged, self.gradient (that largest
+        component) and self.nit are reported per series.
+        @return: the fitted model (self).
+        """
+        self.returns = returns
+        values, self.index, self.columns = _as_matrix(returns)
+        nb_series = values.shape[1]
+        scale = values.std(axis=0)
+        scaled = values / scale
+        backcast = scaled.var(axis=0)
+
+        if x0 is None:
+            start = self._start(nb_series)
+        else:
+            start = x0.loc[self.columns, self.names].values.T.astype(np.float64)
+            start[0] /= scale
+            start[1] /= scale ** 2
+        internalNames = ['mu', 'omega', 'persistence', 'share'] + self.names[4:]
+        lower, upper = (np.repeat(np.array([self._bounds[name][i] for name in internalNames])[:, None], nb_series, 1)
+                        for i in (0, 1))
+        start = np.clip(self._to_internal(start), lower, upper)
+
+        def objective(x, columns):
+            nll, grad = negative_loglikelihood(self._from_internal(x), scaled[:, columns], backcast[columns], self.dist)
+            # chain rule: alpha = persistence * share, beta = persistence * (1 - share)
+            dAlpha, dBeta = grad[2].copy(), grad[3].copy()
+            grad[2] = dAlpha * x[3] + dBeta * (1 - x[3])
+            grad[3] = (dAlpha - dBeta) * x[2]
+            return nll / len(scaled), grad / len(scaled)
+
+        internal, gradient, iterations = batch_minimize(objective, start, lower, upper, gtol, maxiter)
+        self.nit = pd.Series(iterations, index=self.columns)
+        self.gradient = pd.Series(gradient, index=self.columns)
+        self.converged = self.gradient <= gtol
+        params = self._from_internal(internal)
+        # log-likelihood of the original (unscaled) returns
+        self.loglikelihood = -negative_loglikelihood(params, scaled, backcast, self.dist)[0] - len(scaled) * np.log(scale)
+        params[0] *= scale
+        params[1] *= scale ** 2
+        self.params = pd.DataFrame(params.T, index=self.columns, columns=self.names)
+        self._values = values
+        self._backcast = backcast * scale ** 2
+
+        return self
+
+    def update(self, newReturns, maxiter: int = 500, gtol: float = 1e-4):
+        """
+        Append new observations and refit, starting from the current parameters (warm start).
+        @param newReturns: Series / Dataframe with the same columns as the fitted data, or rows of it: a Series
+        indexed by the columns of a fitted Dataframe (e.g. df.iloc[-1]), a scalar, an array row or a (k x m) array.
+        Unlabelled rows get the next business days after the last date (the next integers after a RangeIndex).
+        @return: the refitted model (self).
+        """
+        if isinstance(self.returns, (pd.Series, pd.DataFrame)) and isinstance(newReturns, type(self.returns)):
+            return self.fit(pd.concat([self.returns, newReturns]), x0=self.params, maxiter=maxiter, gtol=gtol)
+        if isinstance(newReturns, pd.Series):
+            rows, labels = newReturns.reindex(self.columns).values[None], [newReturns.name]
+        else:
+            rows, labels = np.asarray(newReturns, dtype=np.float64).reshape(-1, len(self.columns)), [None]
+        if not isinstance(self.returns, (pd.Series, pd.DataFrame)):
+            returns = np.vstack([self._values, rows])
+            returns = returns[:, 0] if np.ndim(self.returns) == 1 else returns
+        else:
+            if labels[0] is not None and len(rows) == 1:
+                index = self.index.append(pd.Index(labels))
+            elif isinstance(self.index, pd.DatetimeIndex):
+                index = self.index.append(pd.bdate_range(self.index[-1], periods=len(rows) + 1)[1:])
+            else:
+                index = self.index.append(pd.RangeIndex(len(self.index), len(self.index) + len(rows)))
+            if isinstance(self.returns, pd.Series):
+                returns = pd.concat([self.returns, pd.Series(rows[:, 0], index=index[-len(rows):],
+                                                             name=self.returns.name)])
+            else:
+                returns = pd.concat([self.returns, pd.DataFrame(rows, index=index[-len(rows):],
+                                                                columns=self.returns.columns)])
+        return self.fit(returns, x0=self.params, maxiter=maxiter, gtol=gtol)
+
+    def variance(self) -> np.ndarray:
+        """
+        @return: (T + 1) x m conditional variances, row t being the variance of date t given the information up to
+        date t-1 (the last row is the forecast for the next date).
+        """
+        mu, omega, alpha, beta = self.params[['mu', 'omega', 'alpha', 'beta']].values.T
+        return garch_recursion(self._values - mu, omega, alpha, beta, self._backcast)
+
+    def forecast(self) -> pd.DataFrame():
+        """
+        One step ahead volatility forecast made at each date (for the next date), as in arch's forecast(start=...).
+        @return: Dataframe indexed by date, one column per series.
+        """
+        return pd.DataFrame(np.sqrt(self.variance()[1:]), index=self.index, columns=self.columns)
+
+    def conditional_volatility(self) -> pd.DataFrame():
+        """
+        @return: in-sample conditional volatility of each date, one column per series.
+        """
+        return pd.DataFrame(np.sqrt(self.variance()[:-1]), index=self.index, columns=self.columns)
@@ -3,8 +3,8 @@ from BenUpFin import perfMetrics
 from BenUpFin import preProcessing
 from BenUpFin import riskMetrics
 from BenUpFin import optionValuation
+from BenUpFin.priceStore import PriceStore
 import matplotlib.pyplot as plt
-import yfinance as yf
 import pandas as pd
 
 
@@ -12,7 +12,8 @@ def main():
 
     # region Risk Metrics
     tickers = ["AAPL", "MSFT"]
-    data = yf.download(tickers=tickers, period="1y")
+    store = PriceStore("~/.benupfin/prices")
+    data = store.download(tickers, period="1y")
     risk = riskMetrics.Metrics(data, tickers, [0.5, 0.5])
     es_p = risk.historicalPortfolioES()
     var_p = risk.historicalPortfolioVaR()
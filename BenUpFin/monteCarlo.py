@@ -0,0 +1,400 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from scipy.stats import norm, t
+
+
+def get_generator(seed=None) -> np.random.Generator:
+    """
+    Normalise a seed argument into a numpy random generator.
+    @param seed: None (fresh entropy), an int / SeedSequence, or an existing np.random.Generator (returned as is).
+    @return: np.random.Generator
+    """
+    if isinstance(seed, np.random.Generator):
+        return seed
+    return np.random.default_rng(seed)
+
+
+def get_seed_sequence(seed=None) -> np.random.SeedSequence:
+    """
+    Normalise a seed argument into a SeedSequence, whose spawned children seed independent blocks of a simulation.
+    @param seed: None (fresh entropy), an int, a SeedSequence (returned as is) or a np.random.Generator (a child
+    sequence is drawn from it).
+    @return: np.random.SeedSequence
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if isinstance(seed, np.random.Generator):
+        return np.random.SeedSequence(int(seed.integers(2 ** 63)))
+    return np.random.SeedSequence(seed)
+
+
+def as_probability(confidenceLevel) -> float:
+    """
+    The library mixes confidence levels given in percent (95) and as probabilities (0.95).
+    @return: the confidence level as a probability in (0, 1).
+    """
+    level = float(confidenceLevel)
+    return level / 100 if level > 1 else level
+
+
+def tail_size(nb_observation: int, confidenceLevels) -> int:
+    """
+    Number of smallest observations needed to evaluate np.percentile (linear interpolation) and the expected
+    shortfall at every confidence level.
+    """
+    q = 1 - min(as_probability(c) for c in confidenceLevels)
+    return int(min(nb_observation, np.floor(q * (nb_observation - 1)) + 2))
+
+
+class TailBuffer:
+
+    def __init__(self, nb_columns: int, size: int, chunkSize: int, dtype=np.float64):
+        """
+        Keep, column by column, the `size` smallest values of a stream of (rows x nb_columns) chunks.
+        The buffer is only partitioned when full, so the amortised cost is linear in the number of values pushed
+        and memory never exceeds (size + max(size, chunkSize)) rows. Values are stored column-major so that each
+        partition works on contiguous memory.
+        @param nb_columns: number of simulated series.
+        @param size: number of order statistics to keep.
+        @param chunkSize: expected number of rows per chunk.
+        """
+        self.size = size
+        self.count = 0
+        # values equal to the largest kept one that were dropped, for the inclusive expected shortfall
+        self.ties = np.zeros(nb_columns, dtype=np.int64)
+        self._threshold = np.full(nb_columns, np.inf)
+        self._filled = 0
+        self._buffer = np.empty((nb_columns, size + max(size, chunkSize)), dtype=dtype)
+
+    def push(self, chunk: np.ndarray):
+        self.count += chunk.shape[0]
+        start = 0
+        while start < chunk.shape[0]:
+            stop = min(chunk.shape[0], start + self._buffer.shape[1] - self._filled)
+            self._buffer[:, self._filled:self._filled + stop - start] = chunk[start:stop].T
+            self._filled += stop - start
+            start = stop
+            if self._filled == self._buffer.shape[1]:
+                self._compact()
+
+    def merge(self, other: "TailBuffer"):
+        rows = other.sorted()
+        self.push(rows)
+        self.count += other.count - rows.shape[0]
+        self._compact()
+        if self._filled:
+            top = self._buffer[:, :self._filled].max(axis=1)
+            self.ties = np.where(self._threshold == top, self.ties, 0) + np.where(other._threshold == top,
+                                                                                  other.ties, 0)
+            self._threshold = top
+
+    def _compact(self):
+        if self._filled > self.size:
+            kept = self._buffer[:, :self._filled]
+            kept.partition(self.size - 1, axis=1)
+            threshold = kept[:, self.size - 1]
+            dropped = np.sum(kept[:, self.size:] == threshold[:, None], axis=1)
+            self.ties = dropped + np.where(threshold == self._threshold, self.ties, 0)
+            self._threshold = threshold.copy()
+            self._filled = self.size
+
+    def sorted(self) -> np.ndarray:
+        """
+        @return: the kept order statistics as a (k x nb_columns) array, sorted in ascending order along the first axis.
+        """
+        self._compact()
+        return np.sort(self._buffer[:, :self._filled], axis=1).T
+
+
+def tail_risk_measures(sortedTail: np.ndarray, nb_observation: int, confidenceLevels,
+                       inclusive: bool = False, ties=None) -> (np.ndarray, np.ndarray):
+    """
+    VaR (np.percentile with linear interpolation, reported as a positive loss) and expected shortfall
+    (mean of the outcomes strictly below the cut) from the lowest order statistics of each column.
+    @param sortedTail: (k x n) ascending order statistics, as returned by TailBuffer.sorted().
+    @param nb_observation: total number of observations the tail was extracted from.
+    @param inclusive: average the outcomes lower or equal to the cut (historical convention) instead.
+    @param ties: (n,) number of outcomes equal to the last order statistic left out of sortedTail (TailBuffer.ties),
+    averaged with the others by the inclusive convention.
+    @return: two (levels x n) arrays, VaR and ES.
+    """
+    cumTail = np.cumsum(sortedTail, axis=0)
+    var = np.empty((len(confidenceLevels), sortedTail.shape[1]))
+    es = np.empty_like(var)
+    for i, level in enumerate(confidenceLevels):
+        position = (1 - as_probability(level)) * (nb_observation - 1)
+        lower = int(np.floor(position))
+        upper = min(lower + 1, nb_observation - 1)
+        cut = sortedTail[lower] + (position - lower) * (sortedTail[upper] - sortedTail[lower])
+        tail = sortedTail[:upper + 1] if not inclusive else sortedTail
+        below = np.sum(tail <= cut if inclusive else tail < cut, axis=0)
+        total = np.where(below > 0, cumTail[np.maximum(below - 1, 0), np.arange(sortedTail.shape[1])], np.nan)
+        if inclusive and ties is not None:
+            extra = np.where(cut == sortedTail[-1], ties, 0)
+            below, total = below + extra, total + extra * cut
+        var[i] = -cut
+        with np.errstate(invalid='ignore', divide='ignore'):
+            es[i] = -total / below
+    return var, es
+
+
+def normal_risk_measures(mu, std, confidenceLevel: float = 0.95):
+    """
+    @return: (VaR, ES) of a normal distribution, vectorized over mu and std.
+    """
+    z = norm.ppf(confidenceLevel)
+    return mu + std * z, mu + std * norm.pdf(z) * (1 - confidenceLevel) ** -1
+
+
+def student_risk_measures(mu, std, dof: int, confidenceLevel: float = 0.95):
+    """
+    @return: (VaR, ES) of a scaled student distribution with `dof` degrees of freedom, vectorized over mu and std.
+    """
+    xanu = t.ppf(1 - confidenceLevel, dof)
+    var = mu + std * t.ppf(confidenceLevel, dof) * np.sqrt((dof - 2) / dof)
+    es = (-1 / (1 - confidenceLevel)) * (1 - dof) ** (-1) * (dof - 2 + xanu ** 2) * t.pdf(xanu, dof) * std - mu
+    return var, es
+
+
+def risk_measures_frame(var: np.ndarray, es: np.ndarray, names, confidenceLevels) -> pd.DataFrame:
+    """
+    @return: Dataframe indexed by series name with (measure, confidence level) columns.
+    """
+    columns = pd.MultiIndex.from_product([['VaR', 'ES'], list(confidenceLevels)], names=['measure', 'confidenceLevel'])
+    return pd.DataFrame(np.vstack([var, es]).T, index=pd.Index(names), columns=columns)
+
+
+class MonteCarloEngine:
+
+    def __init__(self, mu, std, nb_simulation: int = 1000, chunkSize: int = 10000, seed=None):
+        """
+        Gaussian Monte-Carlo simulation of one-period returns for several independent series at once.
+        Scenarios are drawn chunk by chunk into a single pre-sized (chunkSize x n) array and only the lower tail
+        of each series is kept, so memory does not grow with the number of simulations.
+        @param mu: mean of each series (array like of size n).
+        @param std: standard deviation of each series (array like of size n).
+        @param nb_simulation: number of scenarios to draw per series.
+        @param chunkSize: maximum number of scenarios held in memory at once.
+        @param seed: int, SeedSequence or np.random.Generator used to make the draw reproducible.
+        """
+        self.mu = np.atleast_1d(np.asarray(mu, dtype=np.float64))
+        self.std = np.atleast_1d(np.asarray(std, dtype=np.float64))
+        self.nb_simulation = int(nb_simulation)
+        self.chunkSize = int(max(1, min(chunkSize, nb_simulation)))
+        self.rng = get_generator(seed)
+
+    def simulate(self):
+        """
+        @return: generator of (rows x n) scenario chunks. The same buffer is reused between chunks.
+        """
+        buffer = np.empty((self.chunkSize, self.mu.size))
+        done = 0
+        while done < self.nb_simulation:
+            rows = min(self.chunkSize, self.nb_simulation - done)
+            chunk = buffer[:rows]
+            self.rng.standard_normal(out=chunk)
+            chunk *= self.std
+            chunk += self.mu
+            done += rows
+            yield chunk
+
+    def tail(self, confidenceLevels=(95,)) -> TailBuffer:
+        tail = TailBuffer(self.mu.size, tail_size(self.nb_simulation, confidenceLevels), self.chunkSize)
+        for chunk in self.simulate():
+            tail.push(chunk)
+        return tail
+
+    def risk_measures(self, confidenceLevels=(95,)) -> (np.ndarray, np.ndarray):
+        """
+        VaR and ES of every series at every confidence level, all from a single draw.
+        @return: two (levels x n) arrays, VaR and ES.
+        """
+        return tail_risk_measures(self.tail(confidenceLevels).sorted(), self.nb_simulation, confidenceLevels)
+
+
+def covariance_factor(cov) -> np.ndarray:
+    """
+    Lower triangular factor L such that L @ L.T == cov. Falls back on an eigen decomposition when the covariance
+    is only positive semi-definite (e.g. collinear assets).
+    """
+    cov = np.asarray(cov, dtype=np.float64)
+    try:
+        return np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        eigenvalues, eigenvectors = np.linalg.eigh(cov)
+        return eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))
+
+
+def _simulate_correlated_block(task) -> (np.ndarray, int):
+    """
+    Worker of MultivariateMonteCarloEngine: simulate one block of correlated scenarios and return its lower tail.
+    The covariance factor is read from shared memory (no copy per worker) when a shared memory name is given.
+    """
+    factor, shape, mu, weights, rows, seedSequence, size, chunkSize = task
+    shm = None
+    if isinstance(factor, str):
+        shm = shared_memory.SharedMemory(name=factor)
+        factor = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    try:
+        rng = np.random.default_rng(seedSequence)
+        tail = TailBuffer(mu.size + 1, size, chunkSize)
+        normals = np.empty((chunkSize, mu.size))
+        scenarios = np.empty((chunkSize, mu.size + 1))
+        done = 0
+        while done < rows:
+            m = min(chunkSize, rows - done)
+            rng.standard_normal(out=normals[:m])
+            np.matmul(normals[:m], factor.T, out=scenarios[:m, :-1])
+            scenarios[:m, :-1] += mu
+            np.matmul(scenarios[:m, :-1], weights, out=scenarios[:m, -1])
+            tail.push(scenarios[:m])
+            done += m
+        return tail.sorted(), tail.count
+    finally:
+        del factor
+        if shm is not None:
+            shm.close()
+
+
+class MultivariateMonteCarloEngine:
+
+    def __init__(self, mu, cov, weights, nb_simulation: int = 1000, blockSize: int = 50000, chunkSize: int = 10000,
+                 seed=None, n_workers: int = 1):
+        """
+        Gaussian Monte-Carlo simulation of correlated asset returns. The covariance is factored once and each
+        scenario is mu + L @ z, so the portfolio return of every scenario reflects the cross-asset covariance.
+        The simulation is split in blocks of fixed size, each with its own child seed spawned from `seed`:
+        the blocks (and therefore the results) do not depend on the number of workers.
+        @param mu: mean return of each asset (size n).
+        @param cov: (n x n) covariance matrix of the returns.
+        @param weights: portfolio weights (size n).
+        @param nb_simulation: number of simulated scenarios.
+        @param blockSize: number of scenarios per block (unit of work sent to a worker).
+        @param chunkSize: maximum number of scenarios held in memory at once inside a block.
+        @param seed: int, SeedSequence or np.random.Generator. The block seeds are spawned again at every call, so
+        a given seed always gives the same scenarios.
+        @param n_workers: number of processes. 1 runs everything in the current process.
+        """
+        self.mu = np.atleast_1d(np.asarray(mu, dtype=np.float64))
+        self.factor = covariance_factor(cov)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.nb_simulation = int(nb_simulation)
+        self.blockSize = int(max(1, blockSize))
+        self.chunkSize = int(max(1, min(chunkSize, self.blockSize)))
+        self.seed = get_seed_sequence(seed)
+        self.n_workers = max(1, int(n_workers))
+
+    def _tasks(self, factor, size: int):
+        nb_blocks = -(-self.nb_simulation // self.blockSize)
+        # spawning advances the sequence, so the children are spawned from a fresh copy of it
+        root = np.random.SeedSequence(self.seed.entropy, spawn_key=self.seed.spawn_key, pool_size=self.seed.pool_size)
+        seeds = root.spawn(nb_blocks)
+        for i, seedSequence in enumerate(seeds):
+            rows = min(self.blockSize, self.nb_simulation - i * self.blockSize)
+            yield factor, self.factor.shape, self.mu, self.weights, rows, seedSequence, size, self.chunkSize
+
+    def tail(self, confidenceLevels=(95,)) -> TailBuffer:
+        size = tail_size(self.nb_simulation, confidenceLevels)
+        tail = TailBuffer(self.mu.size + 1, size, size)
+        if self.n_workers == 1:
+            for rows, count in map(_simulate_correlated_block, self._tasks(self.factor, size)):
+                tail.push(rows)
+                tail.count += count - rows.shape[0]
+            return tail
+
+        shm = shared_memory.SharedMemory(create=True, size=max(1, self.factor.nbytes))
+        try:
+            np.ndarray(self.factor.shape, dtype=np.float64, buffer=shm.buf)[:] = self.factor
+            with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                for rows, count in executor.map(_simulate_correlated_block, self._tasks(shm.name, size)):
+                    tail.push(rows)
+                    tail.count += count - rows.shape[0]
+        finally:
+            shm.close()
+            shm.unlink()
+        return tail
+
+    def risk_measures(self, confidenceLevels=(95,)) -> (np.ndarray, np.ndarray):
+        """
+        VaR and ES of every asset and of the portfolio (last column) at every confidence level.
+        @return: two (levels x (n + 1)) arrays, VaR and ES.
+        """
+        return tail_risk_measures(self.tail(confidenceLevels).sorted(), self.nb_simulation, confidenceLevels)
+
+
+class BootstrapEngine:
+
+    def __init__(self, returns, weights=None, nb_simulation: int = 10000, mode: str = 'bootstrap', horizon: int = 1,
+                 blockSize: int = 5, scale=None, chunkSize: int = 10000, seed=None):
+        """
+        Non parametric scenario generation by resampling dates of a (T x n) return matrix. For every chunk the
+        resampled dates are drawn as one integer array and all assets are gathered at once, so the cross-sectional
+        dependence of each date is preserved and no Python list is ever built.
+        @param returns: (T x n) array of returns (or of standardized residuals for filtered historical simulation).
+        @param weights: optional portfolio weights; the portfolio scenario is then appended as a last column.
+        @param mode: "bootstrap" (i.i.d. dates) or "block" (circular blocks of consecutive dates).
+        @param horizon: number of periods aggregated (summed) in each scenario.
+        @param blockSize: length of the blocks in "block" mode.
+        @param scale: optional (n,) volatility multiplying the resampled values (filtered historical simulation).
+        @param chunkSize: maximum number of scenarios held in memory at once (whatever the horizon).
+        @param seed: int, SeedSequence or np.random.Generator.
+        """
+        if mode not in ('bootstrap', 'block'):
+            raise Exception(f"Unknown mode {mode}. Use 'bootstrap' or 'block'.")
+        self.returns = np.ascontiguousarray(returns, dtype=np.float64)
+        self.weights = None if weights is None else np.asarray(weights, dtype=np.float64)
+        self.nb_simulation = int(nb_simulation)
+        self.mode = mode
+        self.horizon = int(horizon)
+        self.blockSize = int(min(blockSize, len(self.returns)))
+        self.scale = None if scale is None else np.asarray(scale, dtype=np.float64)
+        self.chunkSize = int(max(1, min(chunkSize, nb_simulation)))
+        self.rng = get_generator(seed)
+
+    def _indices(self, rows: int) -> np.ndarray:
+        length = len(self.returns)
+        if self.mode == 'bootstrap':
+            return self.rng.integers(0, length, size=(rows, self.horizon))
+        nb_blocks = -(-self.horizon // self.blockSize)
+        starts = self.rng.integers(0, length, size=(rows, nb_blocks, 1))
+        indices = (starts + np.arange(self.blockSize)) % length
+        return indices.reshape(rows, -1)[:, :self.horizon]
+
+    def simulate(self):
+        """
+        @return: generator of (rows x n) scenario chunks, (rows x (n + 1)) when weights are given.
+        """
+        nb_assets = self.returns.shape[1]
+        nb_columns = nb_assets + (self.weights is not None)
+        buffer = np.empty((self.chunkSize, nb_columns))
+        # multi-period scenarios are summed one period at a time, so that memory stays chunkSize x n
+        step = np.empty((self.chunkSize, nb_assets)) if self.horizon > 1 else None
+        done = 0
+        while done < self.nb_simulation:
+            rows = min(self.chunkSize, self.nb_simulation - done)
+            chunk = buffer[:rows]
+            indices = self._indices(rows)
+            np.take(self.returns, indices[:, 0], axis=0, out=chunk[:, :nb_assets])
+            for period in range(1, self.horizon):
+                np.take(self.returns, indices[:, period], axis=0, out=step[:rows])
+                chunk[:, :nb_assets] += step[:rows]
+            if self.scale is not None:
+                chunk[:, :nb_assets] *= self.scale
+            if self.weights is not None:
+                np.matmul(chunk[:, :nb_assets], self.weights, out=chunk[:, -1])
+            done += rows
+            yield chunk
+
+    def risk_measures(self, confidenceLevels=(95,)) -> (np.ndarray, np.ndarray):
+        """
+        VaR and ES of every column at every confidence level from a single resampling.
+        @return: two (levels x columns) arrays, VaR and ES.
+        """
+        nb_columns = self.returns.shape[1] + (self.weights is not None)
+        tail = TailBuffer(nb_columns, tail_size(self.nb_simulation, confidenceLevels), self.chunkSize)
+        for chunk in self.simulate():
+            tail.push(chunk)
+        return tail_risk_measures(tail.sorted(), self.nb_simulation, confidenceLevels, inclusive=True,
+                                  ties=tail.ties)
@@ -1,6 +1,525 @@
+from typing import NamedTuple
 import numpy as np
 import pandas as pd
-from scipy.stats import stats
+from scipy.special import ndtr
+from BenUpFin.monteCarlo import get_generator
+
+GREEKS = ('delta', 'gamma', 'vega', 'theta', 'rho', 'epsilon', 'vanna', 'charm', 'vomma', 'veta')
+
+
+def option_sign(typeOption) -> np.ndarray:
+    """
+    @param typeOption: call ("c") or put ("p"), or an array of them (signs already computed are returned as is).
+    @return: +1 for the calls and -1 for the puts.
+    """
+    typeOption = np.asarray(typeOption)
+    if typeOption.dtype.kind == 'f':
+        return typeOption
+    if not np.all(np.isin(typeOption, ('c', 'p'))):
+        raise Exception("typeOption should be 'c' (call) or 'p' (put).")
+    return np.where(typeOption == 'c', 1.0, -1.0)
+
+
+def bsm_chain(s, k, T, sigma, rf=0, q=0, typeOption='c', greeks=True) -> {}:
+    """
+    Black-Scholes-Merton price and Greeks of a whole chain of European options in one vectorized pass. Every input
+    is a scalar or an array and they are broadcast together; d1, d2, the discount factors and the normal CDF / PDF
+    are computed once and shared by the price and every Greek.
+    @param s: spot price(s).
+    @param k: strike(s).
+    @param T: time(s) to maturity in years. Expired options (T <= 0) are worth their intrinsic value.
+    @param sigma: volatility(ies).
+    @param rf: risk free rate(s), continuous.
+    @param q: dividend yield(s), continuous.
+    @param typeOption: call ("c") or put ("p"), or an array of them.
+    @param greeks: True for every Greek of GREEKS, False for the price only, or the names of the Greeks to compute.
+    First order: delta, vega, theta, rho, epsilon (dividend rho). Second order: gamma, vanna (d delta / d sigma),
+    charm (d delta / dt), vomma (d vega / d sigma), veta (d vega / dt). Sensitivities are per unit of the input
+    (vega per 1.00 of volatility, rho per 1.00 of rate) and time derivatives per year of calendar time.
+    @return: {name: array} with the price and the requested Greeks, all of the broadcast shape.
+    """
+    names = GREEKS if greeks is True else () if greeks is False else tuple(greeks)
+    unknown = set(names) - set(GREEKS)
+    if unknown:
+        raise Exception(f"Unknown Greeks {unknown}. Use some of {GREEKS}.")
+    s, k, T, sigma, rf, q, phi = np.broadcast_arrays(*(np.asarray(x, dtype=np.float64) for x in (s, k, T, sigma, rf, q)),
+                                                     option_sign(typeOption))
+    live = T > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sqrtT = np.sqrt(np.where(live, T, np.nan))
+        volT = sigma * sqrtT
+        d1 = (np.log(s / k) + (rf - q + 0.5 * sigma ** 2) * T) / volT
+        d2 = d1 - volT
+    dividendDiscount = np.exp(-q * T)
+    rateDiscount = np.exp(-rf * T)
+    forward = s * dividendDiscount
+    cdf1 = ndtr(phi * d1)
+    cdf2 = ndtr(phi * d2)
+    pdf1 = np.exp(-0.5 * d1 ** 2) / np.sqrt(2 * np.pi)
+
+    price = phi * (forward * cdf1 - k * rateDiscount * cdf2)
+    result = {'price': np.where(live, price, np.maximum(phi * (s - k), 0))}
+    if not names:
+        return result
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vega = forward * pdf1 * sqrtT
+        formulas = {
+            'delta': lambda: phi * dividendDiscount * cdf1,
+            'gamma': lambda: dividendDiscount * pdf1 / (s * volT),
+            'vega': lambda: vega,
+            'theta': lambda: (-forward * pdf1 * sigma / (2 * sqrtT) - phi * rf * k * rateDiscount * cdf2
+                              + phi * q * forward * cdf1),
+            'rho': lambda: phi * k * T * rateDiscount * cdf2,
+            'epsilon': lambda: -phi * forward * T * cdf1,
+            'vanna': lambda: -dividendDiscount * pdf1 * d2 / sigma,
+            'charm': lambda: (phi * q * dividendDiscount * cdf1
+                              - dividendDiscount * pdf1 * (2 * (rf - q) * T - d2 * volT) / (2 * T * volT)),
+            'vomma': lambda: vega * d1 * d2 / sigma,
+            'veta': lambda: vega * (q + (rf - q) * d1 / volT - (1 + d1 * d2) / (2 * T)),
+        }
+        for name in names:
+            result[name] = np.where(live, formulas[name](), 0.0)
+    if 'delta' in result:
+        # expired: 1 (or -1 for a put) in the money, 0 otherwise
+        result['delta'] = np.where(live, result['delta'], phi * (phi * (s - k) > 0))
+    return result
+
+
+def implied_volatility(price, s, k, T, rf=0, q=0, typeOption='c', tol: float = 1e-8, maxiter: int = 100,
+                       lower: float = 1e-4, upper: float = 5.0, volTol: float = 1e-8) -> {}:
+    """
+    Black-Scholes-Merton implied volatilities of a whole chain of quotes at once (inputs are broadcast as in
+    bsm_chain). Each contract keeps a bracket [low, high] of its volatility, narrowed at every evaluation since the
+    price increases with the volatility, and takes a Newton step price error / vega when it falls inside the bracket,
+    a bisection step otherwise. Only the contracts not yet converged are repriced, so each iteration costs one
+    price + vega evaluation of the remaining ones.
+    @param price: option price(s) to match.
+    @param tol: absolute price tolerance. Quotes not above it cannot be inverted and are not converged.
+    @param lower, upper: initial volatility bracket.
+    @param volTol: volatility tolerance. A contract has only converged when its price error (and the rounding of
+    its price) divided by its vega is below it, so quotes with almost no vega are not converged.
+    @return: {"volatility": array (NaN where not converged), "converged": boolean array, "iterations": number of
+    evaluations of each contract}.
+    """
+    price, s, k, T, rf, q, phi = [np.array(x, dtype=np.float64) for x in np.broadcast_arrays(
+        *(np.asarray(x, dtype=np.float64) for x in (price, s, k, T, rf, q)), option_sign(typeOption))]
+    shape = price.shape
+    price, s, k, T, rf, q, phi = (x.ravel() for x in (price, s, k, T, rf, q, phi))
+    forward = s * np.exp(-q * T)
+    discountedStrike = k * np.exp(-rf * T)
+    # no-arbitrage bounds: no volatility reproduces a price outside of them
+    minimum = np.maximum(phi * (forward - discountedStrike), 0)
+    maximum = np.where(phi > 0, forward, discountedStrike)
+    valid = (T > 0) & (price > minimum) & (price < maximum) & (price > tol)
+
+    low = np.full(price.shape, lower)
+    high = np.full(price.shape, upper)
+    # Manaster-Koehler starting point, inside the bracket
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma = np.sqrt(2 * np.abs(np.log(forward / discountedStrike)) / T)
+    sigma = np.where(np.isfinite(sigma) & (sigma > lower) & (sigma < upper), sigma, np.clip(0.2, lower, upper))
+    converged = np.zeros(price.shape, dtype=bool)
+    iterations = np.zeros(price.shape, dtype=np.int64)
+
+    active = np.flatnonzero(valid)
+    for _ in range(maxiter):
+        if len(active) == 0:
+            break
+        chain = bsm_chain(s[active], k[active], T[active], sigma[active], rf[active], q[active], phi[active],
+                          greeks=('vega',))
+        error = chain['price'] - price[active]
+        iterations[active] += 1
+        # the volatility is only known to (price error + rounding of the price) / vega
+        done = (np.abs(error) <= tol) & \
+            (np.abs(error) + 4 * np.finfo(np.float64).eps * price[active] <= volTol * chain['vega'])
+        converged[active[done]] = True
+        current = sigma[active]
+        high[active] = np.where(error > 0, current, high[active])
+        low[active] = np.where(error < 0, current, low[active])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = current - error / chain['vega']
+        inside = (newton > low[active]) & (newton < high[active])
+        sigma[active] = np.where(done, current, np.where(inside, newton, (low[active] + high[active]) / 2))
+        # a bracket narrower than the rounding of the volatility cannot improve further
+        stuck = high[active] - low[active] <= 1e-15 * high[active]
+        active = active[~done & ~stuck]
+
+    return {'volatility': np.where(converged, sigma, np.nan).reshape(shape),
+            'converged': converged.reshape(shape),
+            'iterations': iterations.reshape(shape)}
+
+
+def lattice_price(s, k, T, sigma, rf=0, q=0, typeOption='c', american: bool = True, steps: int = 500,
+                  method: str = 'binomial', chunkSize: int = 128) -> {}:
+    """
+    Price of many European or American options on a recombining lattice, all contracts sharing the step count.
+    The option values of every contract are one row of a single (contracts x nodes) array, rolled back in place from
+    the maturity to the root, so the memory is O(steps) per contract whatever the number of steps; the exercise
+    values of all the price levels are computed once. Delta, gamma and
+    theta are read from the nodes of the first steps of the same lattice (no bump-and-reprice).
+    @param american: allow early exercise.
+    @param method: "binomial" (Cox-Ross-Rubinstein) or "trinomial" (Boyle, middle probability 2/3).
+    @param chunkSize: number of contracts rolled back together, small enough for their lattice to stay in cache.
+    @return: {"price", "delta", "gamma", "theta"}, arrays of the broadcast shape of the inputs.
+    """
+    if method not in ('binomial', 'trinomial'):
+        raise Exception(f"Unknown method {method}. Use 'binomial' or 'trinomial'.")
+    s, k, T, sigma, rf, q, phi = np.broadcast_arrays(*(np.asarray(x, dtype=np.float64) for x in (s, k, T, sigma, rf, q)),
+                                                     option_sign(typeOption))
+    shape = s.shape
+    if s.size > chunkSize:
+        inputs = [np.ravel(x) for x in (s, k, T, sigma, rf, q, phi)]
+        chunks = [lattice_price(*(x[start:start + chunkSize] for x in inputs), american, steps, method, chunkSize)
+                  for start in range(0, s.size, chunkSize)]
+        return {name: np.concatenate([chunk[name] for chunk in chunks]).reshape(shape) for name in chunks[0]}
+    s, k, T, sigma, rf, q, phi = (np.ravel(x)[:, None] for x in (s, k, T, sigma, rf, q, phi))
+    dt = T / steps
+    discount = np.exp(-rf * dt)
+    if method == 'binomial':
+        # node j of step i has the price s * u ** (2j - i)
+        logStep = sigma * np.sqrt(dt)
+        up = (np.exp((rf - q) * dt) - np.exp(-logStep)) / (np.exp(logStep) - np.exp(-logStep))
+        probabilities = (discount * (1 - up), discount * up)
+        width, moves, nodes = (lambda i: i + 1, lambda i: 2 * np.arange(i + 1) - i,
+                               lambda i: slice(steps - i, steps + i + 1, 2))
+    else:
+        # node j of step i has the price s * u ** (j - i)
+        logStep = sigma * np.sqrt(3 * dt)
+        drift = (rf - q - 0.5 * sigma ** 2) * np.sqrt(dt / (12 * sigma ** 2))
+        probabilities = (discount * (1 / 6 - drift), discount * 2 / 3, discount * (1 / 6 + drift))
+        width, moves, nodes = (lambda i: 2 * i + 1, lambda i: np.arange(2 * i + 1) - i,
+                               lambda i: slice(steps - i, steps + i + 1))
+
+    # exercise value of every price level s * u ** e, -steps <= e <= steps, computed once for all the steps
+    intrinsic = np.maximum(phi * (s * np.exp(logStep * np.arange(-steps, steps + 1)) - k), 0)
+    values = intrinsic[:, nodes(steps)].copy()
+    scratch = np.empty_like(values)
+    if method == 'trinomial':
+        upper = np.empty_like(values)
+    saved = {}
+    for i in range(steps - 1, -1, -1):
+        n = width(i)
+        # values[:n] = p0 * values[:n] + p1 * values[1:n + 1] (+ p2 * values[2:n + 2]), in place
+        np.multiply(values[:, 1:n + 1], probabilities[1], out=scratch[:, :n])
+        if method == 'trinomial':
+            np.multiply(values[:, 2:n + 2], probabilities[2], out=upper[:, :n])
+            scratch[:, :n] += upper[:, :n]
+        values[:, :n] *= probabilities[0]
+        values[:, :n] += scratch[:, :n]
+        if american:
+            np.maximum(values[:, :n], intrinsic[:, nodes(i)], out=values[:, :n])
+        if i <= 2:
+            saved[i] = values[:, :n].copy()
+
+    price = saved[0][:, 0]
+    if method == 'binomial':
+        level1, level2 = s * np.exp(logStep * moves(1)), s * np.exp(logStep * moves(2))
+        delta = (saved[1][:, 1] - saved[1][:, 0]) / (level1[:, 1] - level1[:, 0])
+        upDelta = (saved[2][:, 2] - saved[2][:, 1]) / (level2[:, 2] - level2[:, 1])
+        downDelta = (saved[2][:, 1] - saved[2][:, 0]) / (level2[:, 1] - level2[:, 0])
+        gamma = (upDelta - downDelta) / (0.5 * (level2[:, 2] - level2[:, 0]))
+        theta = (saved[2][:, 1] - price) / (2 * dt[:, 0])
+    else:
+        level1 = s * np.exp(logStep * moves(1))
+        delta = (saved[1][:, 2] - saved[1][:, 0]) / (level1[:, 2] - level1[:, 0])
+        upDelta = (saved[1][:, 2] - saved[1][:, 1]) / (level1[:, 2] - level1[:, 1])
+        downDelta = (saved[1][:, 1] - saved[1][:, 0]) / (level1[:, 1] - level1[:, 0])
+        gamma = (upDelta - downDelta) / (0.5 * (level1[:, 2] - level1[:, 0]))
+        theta = (saved[1][:, 1] - price) / dt[:, 0]
+    return {name: value.reshape(shape) for name, value in
+            (('price', price), ('delta', delta), ('gamma', gamma), ('theta', theta))}
+
+
+def lattice_implied_volatility(price, s, k, T, rf=0, q=0, typeOption='c', american: bool = True, steps: int = 500,
+                               method: str = 'binomial', tol: float = 1e-6, maxiter: int = 100, lower: float = 1e-4,
+                               upper: float = 5.0, volTol: float = 1e-6) -> {}:
+    """
+    Implied volatilities on the lattice of lattice_price (e.g. of American options, whose prices BSM cannot invert),
+    for many quotes at once. The lattice has no closed-form vega, so each contract keeps a bracket of its volatility
+    with the prices at both ends and takes a secant step inside it (Illinois variant of the false position method),
+    a bisection step otherwise; the contracts not yet converged are repriced together by one lattice_price call.
+    @param price: option price(s) to match.
+    @param tol: absolute price tolerance. Quotes not above it are not converged.
+    @param lower, upper: volatility bracket. Quotes whose price is not between the prices at both ends are NaN.
+    @param volTol: volatility tolerance, as in implied_volatility (the vega being the slope of the bracket).
+    @return: {"volatility": array (NaN where not converged), "converged": boolean array, "iterations": number of
+    evaluations of each contract}.
+    """
+    price, s, k, T, rf, q, phi = [np.array(x, dtype=np.float64) for x in np.broadcast_arrays(
+        *(np.asarray(x, dtype=np.float64) for x in (price, s, k, T, rf, q)), option_sign(typeOption))]
+    shape = price.shape
+    price, s, k, T, rf, q, phi = (x.ravel() for x in (price, s, k, T, rf, q, phi))
+
+    def error(active, sigma):
+        return lattice_price(s[active], k[active], T[active], sigma, rf[active], q[active], phi[active], american,
+                             steps, method)['price'] - price[active]
+
+    low, high = np.full(price.shape, lower), np.full(price.shape, upper)
+    everything = np.arange(price.size)
+    errorLow, errorHigh = error(everything, low), error(everything, high)
+    iterations = np.full(price.shape, 2, dtype=np.int64)
+    # a quote matched at the lower bound (e.g. an American option worth its exercise value) has no volatility
+    converged = np.zeros(price.shape, dtype=bool)
+    sigma = np.full(price.shape, np.nan)
+    active = np.flatnonzero((T > 0) & (price > tol) & (errorLow < -tol) & (errorHigh > 0))
+    movedLow = np.zeros(price.shape, dtype=bool)
+    for _ in range(maxiter):
+        if len(active) == 0:
+            break
+        eLow, eHigh = errorLow[active], errorHigh[active]
+        candidate = low[active] - eLow * (high[active] - low[active]) / (eHigh - eLow)
+        inside = (candidate > low[active]) & (candidate < high[active])
+        candidate = np.where(inside, candidate, (low[active] + high[active]) / 2)
+        e = error(active, candidate)
+        iterations[active] += 1
+        slope = (eHigh - eLow) / (high[active] - low[active])
+        done = (np.abs(e) <= tol) & (np.abs(e) + 4 * np.finfo(np.float64).eps * price[active] <= volTol * slope)
+        sigma[active[done]] = candidate[done]
+        converged[active[done]] = True
+        below = e < 0
+        # Illinois: when the same end moves twice in a row, halve the error kept at the other one so that the
+        # secant does not stall on one side
+        again = below == movedLow[active]
+        errorHigh[active] = np.where(below, np.where(again, eHigh / 2, eHigh), e)
+        errorLow[active] = np.where(below, e, np.where(again, eLow / 2, eLow))
+        movedLow[active] = below
+        low[active] = np.where(below, candidate, low[active])
+        high[active] = np.where(below, high[active], candidate)
+        stuck = high[active] - low[active] <= 1e-15 * high[active]
+        active = active[~done & ~stuck]
+
+    return {'volatility': sigma.reshape(shape), 'converged': converged.reshape(shape),
+            'iterations': iterations.reshape(shape)}
+
+
+def monte_carlo_price(s, k, T, sigma, rf=0, q=0, typeOption='c', payoff: str = 'european', barrier: float = None,
+                      barrierType: str = 'up-and-out', steps: int = 252, nb_paths: int = 100000,
+                      chunkSize: int = 10000, antithetic: bool = True, control_variate: bool = True,
+                      seed=None) -> {}:
+    """
+    Monte-Carlo price of a path-dependent option under geometric brownian motion, for one or many contracts (s and
+    k are broadcast together, the other parameters are scalars; the same paths are used for every contract). Paths
+    are generated by chunks of chunkSize, only the running sums of the chunk results being kept, so the memory does
+    not grow with nb_paths (it is chunkSize x steps plus chunkSize x the number of contracts).
+    @param payoff: "european", "asian" (arithmetic average of the monitored prices) or "barrier".
+    @param barrier: barrier level of a barrier option (monitored at each step).
+    @param barrierType: "up-and-out", "up-and-in", "down-and-out" or "down-and-in".
+    @param steps: number of monitoring dates.
+    @param antithetic: use the paths of z and -z in pairs.
+    @param control_variate: regress the discounted payoff on a control of known expectation, the discounted
+    final price for a european payoff and the european option (priced by bsm_chain) otherwise.
+    @param seed: int or np.random.Generator.
+    @return: {"price", "stderr", "delta"}. The delta is estimated on the same paths, pathwise for the european and
+    asian payoffs and by likelihood ratio for the (discontinuous) barrier payoffs.
+    """
+    if payoff not in ('european', 'asian', 'barrier'):
+        raise Exception(f"Unknown payoff {payoff}. Use 'european', 'asian' or 'barrier'.")
+    if payoff == 'barrier' and (barrier is None or barrierType not in
+                                ('up-and-out', 'up-and-in', 'down-and-out', 'down-and-in')):
+        raise Exception("A barrier option needs a barrier and a barrierType among 'up-and-out', 'up-and-in', "
+                        "'down-and-out' and 'down-and-in'.")
+    s, k = np.broadcast_arrays(np.asarray(s, dtype=np.float64), np.asarray(k, dtype=np.float64))
+    shape = s.shape
+    spots, strikes = np.ravel(s), np.ravel(k)
+    phi = float(option_sign(typeOption))
+    rng = get_generator(seed)
+    dt = T / steps
+    drift = (rf - q - 0.5 * sigma ** 2) * dt
+    discount = np.exp(-rf * T)
+    if payoff == 'european':
+        expected = spots * np.exp(-q * T)
+    else:
+        expected = bsm_chain(spots, strikes, T, sigma, rf, q, typeOption, greeks=False)['price']
+
+    # running sums over the (pair averaged) samples: payoff, control, squares, cross product, likelihood ratio
+    sums = np.zeros((6, len(spots)))
+    count = 0
+    chunkSize = int(max(2, chunkSize))
+    done = 0
+    while done < nb_paths:
+        rows = min(chunkSize, nb_paths - done)
+        half = -(-rows // 2) if antithetic else rows
+        normals = rng.standard_normal((half, steps))
+        if antithetic:
+            normals = np.vstack([normals, -normals])
+        # the prices are proportional to the spot: path statistics of a unit spot, scaled for every contract
+        paths = np.exp(np.cumsum(drift + sigma * np.sqrt(dt) * normals, axis=1))
+        final = paths[:, -1, None] * spots
+        underlying = paths.mean(axis=1)[:, None] * spots if payoff == 'asian' else final
+        value = discount * np.maximum(phi * (underlying - strikes), 0)
+        if payoff == 'barrier':
+            touched = paths.max(axis=1)[:, None] * spots >= barrier if barrierType.startswith('up') else \
+                paths.min(axis=1)[:, None] * spots <= barrier
+            value = value * (touched if barrierType.endswith('-in') else ~touched)
+            # likelihood ratio (the payoff is discontinuous): only the first step depends on the spot
+            score = value * normals[:, 0, None] / (spots * sigma * np.sqrt(dt))
+        else:
+            # pathwise derivative
+            score = discount * phi * (phi * (underlying - strikes) > 0) * underlying / spots
+        control = discount * (final if payoff == 'european' else np.maximum(phi * (final - strikes), 0))
+        if antithetic:
+            value, control, score = ((x[:half] + x[half:]) / 2 for x in (value, control, score))
+        sums += (value.sum(axis=0), control.sum(axis=0), (value ** 2).sum(axis=0), (control ** 2).sum(axis=0),
+                 (value * control).sum(axis=0), score.sum(axis=0))
+        count += half
+        done += 2 * half if antithetic else half
+
+    mean, controlMean = sums[0] / count, sums[1] / count
+    variance = sums[2] / count - mean ** 2
+    controlVariance = sums[3] / count - controlMean ** 2
+    covariance = sums[4] / count - mean * controlMean
+    if control_variate:
+        beta = np.where(controlVariance > 0, covariance / np.where(controlVariance > 0, controlVariance, 1), 0)
+        price = mean - beta * (controlMean - expected)
+        variance = variance - 2 * beta * covariance + beta ** 2 * controlVariance
+    else:
+        price = mean
+    return {'price': price.reshape(shape),
+            'stderr': np.sqrt(np.clip(variance, 0, None) / count).reshape(shape),
+            'delta': (sums[5] / count).reshape(shape)}
+
+
+def legs_payoff(prices, k, premium, typeOption='c', quantity=1) -> np.ndarray:
+    """
+    Profit and loss at expiry of option strategies: sum over the legs of quantity * (payoff - premium).
+    @param prices: (P,) prices of the underlying at expiry (a history or a grid).
+    @param k, premium, typeOption, quantity: legs of the strategies, scalars or arrays whose last axis is the leg
+    (e.g. (nb_strategies x nb_legs) to evaluate many structures at once; a quantity of 0 pads shorter structures).
+    The quantity is negative for short legs.
+    @return: array of shape (strategies..., P).
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    k, premium, quantity, phi = np.broadcast_arrays(*(np.asarray(x, dtype=np.float64) for x in (k, premium, quantity)),
+                                                    option_sign(typeOption))
+    k, premium, quantity, phi = (np.atleast_1d(x) for x in (k, premium, quantity, phi))
+    # the premiums are a constant per strategy; then one broadcast per leg (the legs of a structure are few, the
+    # strategies and prices many) computed in a reused buffer
+    pnl = np.repeat(-np.sum(quantity * premium, axis=-1)[..., None], prices.size, axis=-1).reshape(
+        k.shape[:-1] + prices.shape)
+    leg = np.empty_like(pnl)
+    for i in range(k.shape[-1]):
+        np.subtract(prices, k[..., i, None], out=leg)
+        leg *= phi[..., i, None]
+        np.maximum(leg, 0, out=leg)
+        leg *= quantity[..., i, None]
+        pnl += leg
+    return pnl
+
+
+def strategy_profile(k, premium, typeOption='c', quantity=1, prices=None, nb_points: int = 1001) -> {}:
+    """
+    Profit and loss profile at expiry of one or many multi-leg strategies (see legs_payoff for the legs) on a grid of
+    prices, with their breakevens and maximum profit / loss read from the grid.
+    @param prices: grid of prices at expiry. Default nb_points from 0 to twice the highest strike, plus the strikes
+    (the P&L is linear between strikes, so breakevens and extrema on this grid are exact).
+    @return: {"prices": grid, "pnl": (strategies..., P), "breakevens": (strategies..., B) breakevens in increasing
+    order padded with NaN, "max_profit" and "max_loss": (strategies...), +inf / -inf when unbounded above the grid}.
+    """
+    k = np.asarray(k, dtype=np.float64)
+    if prices is None:
+        prices = np.union1d(np.linspace(0, 2 * np.max(k), nb_points), np.ravel(k))
+    prices = np.asarray(prices, dtype=np.float64)
+    pnl = legs_payoff(prices, k, premium, typeOption, quantity)
+
+    # breakevens: sign changes between consecutive grid prices, linearly interpolated
+    negative = pnl < 0
+    crossing = negative[..., 1:] != negative[..., :-1]
+    where = np.nonzero(crossing)
+    strategies, position = where[:-1], where[-1]
+    before, after = pnl[strategies + (position,)], pnl[strategies + (position + 1,)]
+    roots = prices[position] - before * (prices[position + 1] - prices[position]) / (after - before)
+    counts = crossing.sum(axis=-1)
+    breakevens = np.full(pnl.shape[:-1] + (int(counts.max()) if counts.size else 0,), np.nan)
+    # rank of each breakeven among those of its strategy (np.nonzero returns them in order)
+    first = np.concatenate([[0], np.cumsum(np.ravel(counts))[:-1]])
+    rank = np.arange(len(position)) - np.repeat(first, np.ravel(counts))
+    breakevens[strategies + (rank,)] = roots
+
+    # above the grid the P&L moves with the net quantity of calls
+    phi, quantity = np.broadcast_arrays(option_sign(typeOption), np.asarray(quantity, dtype=np.float64))
+    phi, quantity = np.broadcast_arrays(*(np.atleast_1d(x) for x in (phi, quantity)), np.atleast_1d(k))[:2]
+    slope = np.sum(quantity * (phi > 0), axis=-1)
+    return {'prices': prices,
+            'pnl': pnl,
+            'breakevens': breakevens,
+            'max_profit': np.where(slope > 0, np.inf, pnl.max(axis=-1)),
+            'max_loss': np.where(slope < 0, -np.inf, pnl.min(axis=-1))}
+
+
+class ScenarioCube(NamedTuple):
+    """
+    P&L of an option book under a grid of scenarios: pnl[u, i, j, l] is the P&L of the positions on underlyings[u]
+    when the spot moves by spotShocks[i], the volatility by volShocks[j] and the time by horizons[l].
+    """
+    pnl: np.ndarray
+    underlyings: list
+    spotShocks: np.ndarray
+    volShocks: np.ndarray
+    horizons: np.ndarray
+
+    def to_frame(self) -> pd.DataFrame:
+        index = pd.MultiIndex.from_product([self.underlyings, self.spotShocks, self.volShocks, self.horizons],
+                                           names=['underlying', 'spotShock', 'volShock', 'horizon'])
+        return pd.DataFrame({'PnL': self.pnl.ravel()}, index=index)
+
+
+def scenario_pnl(book: pd.DataFrame, spotShocks, volShocks=(0,), horizons=(0,), chunkSize: int = 1000) -> ScenarioCube:
+    """
+    Reprice a book of European options under every combination of spot shock x volatility shock x time decay and
+    aggregate the P&L by underlying. The book is broadcast against the whole grid in one array operation per chunk
+    of contracts (memory is chunkSize x scenarios). What does not depend on the scenario is computed once per
+    contract (log-moneyness, base price), the discount factors once per horizon and the volatility terms once per
+    (volatility, horizon) pair.
+    @param book: Dataframe with one row per position and the columns "underlying", "spot", "k", "T", "sigma",
+    "typeOption" ("c" / "p"), "quantity" (negative when short) and optionally "rf" and "q".
+    @param spotShocks: relative spot moves (e.g. -0.1 for a 10% fall).
+    @param volShocks: absolute volatility moves (e.g. 0.05 for +5 volatility points).
+    @param horizons: time elapsed in years (e.g. 1 / 252 for one day of decay). Options expiring before the horizon
+    are worth their intrinsic value.
+    @return: ScenarioCube.
+    """
+    spotShocks, volShocks, horizons = (np.atleast_1d(np.asarray(x, dtype=np.float64))
+                                       for x in (spotShocks, volShocks, horizons))
+    # positions sorted by underlying, so the P&L of each chunk is aggregated with one reduceat
+    book = book.sort_values('underlying', kind='stable')
+    underlyings, codes = np.unique(book['underlying'].values, return_inverse=True)
+    spot, k, T, sigma, quantity = (book[name].values.astype(np.float64) for name in ('spot', 'k', 'T', 'sigma', 'quantity'))
+    rf, q = (book[name].values.astype(np.float64) if name in book else np.zeros(len(book)) for name in ('rf', 'q'))
+    phi = option_sign(book['typeOption'].values)
+    base = bsm_chain(spot, k, T, sigma, rf, q, phi, greeks=False)['price']
+
+    pnl = np.zeros((len(underlyings), len(spotShocks), len(volShocks), len(horizons)))
+    logShift = np.log1p(spotShocks)[None, :, None, None]
+    shiftedSpot = spotShocks[None, :, None, None] + 1
+    for start in range(0, len(book), chunkSize):
+        rows = slice(start, start + chunkSize)
+        # (contracts x horizons) terms
+        tau = T[rows, None] - horizons[None, :]
+        live = tau > 0
+        safeTau = np.where(live, tau, 1)
+        sqrtTau = np.sqrt(safeTau)
+        forward = spot[rows, None] * np.exp(-q[rows, None] * safeTau)
+        discountedStrike = k[rows, None] * np.exp(-rf[rows, None] * safeTau)
+        carry = (rf[rows, None] - q[rows, None]) * safeTau
+        # (contracts x vols x horizons) terms
+        shockedSigma = np.clip(sigma[rows, None] + volShocks[None, :], 1e-8, None)[:, :, None]
+        volT = shockedSigma * sqrtTau[:, None, :]
+        drift = (carry[:, None, :] + 0.5 * volT ** 2) / volT
+        # (contracts x spots x vols x horizons)
+        sign = phi[rows, None, None, None]
+        d1 = (np.log(spot[rows] / k[rows])[:, None, None, None] + logShift) / volT[:, None] + drift[:, None]
+        d2 = d1 - volT[:, None]
+        price = sign * (forward[:, None, None] * shiftedSpot * ndtr(sign * d1)
+                        - discountedStrike[:, None, None] * ndtr(sign * d2))
+        intrinsic = np.maximum(sign * (spot[rows, None, None, None] * shiftedSpot - k[rows, None, None, None]), 0)
+        price = np.where(live[:, None, None, :], price, intrinsic)
+        positionPnl = quantity[rows, None, None, None] * (price - base[rows, None, None, None])
+        chunkCodes = codes[rows]
+        starts = np.flatnonzero(np.r_[True, chunkCodes[1:] != chunkCodes[:-1]])
+        pnl[chunkCodes[starts]] += np.add.reduceat(positionPnl, starts, axis=0)
+
+    return ScenarioCube(pnl, list(underlyings), spotShocks, volShocks, horizons)
 
 
 class Options:
@@ -27,97 +546,230 @@ class Options:
         self.rf = rf
         self.q = q
 
+    def _quantity(self) -> int:
+        if self.style not in ("long", "short") or self.typeOption not in ("c", "p"):
+            raise Exception("Combination (style, type) not existing in this world. Check your input.")
+        return 1 if self.style == "long" else -1
+
     def payoff(self):
-        df = pd.DataFrame(index=self.s.index)
+        """
+        Profit and loss at expiry (premium included) for each price of the stock price history.
+        @return: Dataframe with a "Payoff" column indexed as the stock prices.
+        """
+        prices = self.s.iloc[:, 0] if isinstance(self.s, pd.DataFrame) else self.s
+        df = pd.DataFrame(index=getattr(prices, 'index', None))
+        df["Payoff"] = legs_payoff(np.asarray(prices, dtype=np.float64), self.k, self.premium, self.typeOption,
+                                   self._quantity())
+        return df
 
-        if self.style == "long" and self.typeOption == "c":
-            df["Payoff"] = max(self.s[:, 0] - self.k, 0) - self.premium
+    def _chain(self, sigma, greeks=False) -> {}:
+        return bsm_chain(np.asarray(self.s, dtype=np.float64), self.k, self.T, sigma, self.rf, self.q,
+                         self.typeOption, greeks)
 
-        elif self.style == "long" and self.typeOption == "p":
-            df["Payoff"] = max(self.k - self.s[:, 0], 0) - self.premium
+    def _like_s(self, values: np.ndarray):
+        """
+        @return: values with the index (and columns) of the stock price when it is a Series / Dataframe.
+        """
+        if isinstance(self.s, pd.DataFrame):
+            return pd.DataFrame(values, index=self.s.index, columns=self.s.columns)
+        if isinstance(self.s, pd.Series):
+            return pd.Series(values, index=self.s.index, name=self.s.name)
+        return values
 
-        elif self.style == "short" and self.typeOption == "c":
-            df["Payoff"] = min(self.k - self.s[:, 0], 0) + self.premium
+    def bsm_price(self, sigma):
+        """
+        Black-Scholes-Merton price of the option for each stock price (see bsm_chain).
+        @param sigma: volatility.
+        """
+        return self._like_s(bsm_chain(np.asarray(self.s, dtype=np.float64), self.k, self.T, sigma, self.rf, self.q,
+                                      self.typeOption, False)['price'])
 
-        elif self.style == "short" and self.typeOption == "p":
-            df["Payoff"] = min(df[:, 0] - self.k, 0) + self.premium
+    def price(self, sigma):
+        """
+        Price of the option for each stock price with the pricer of the class (BSM for European Options).
+        @param sigma: volatility.
+        """
+        return self._like_s(self._chain(sigma)['price'])
 
-        else:
-            raise Exception("Combination (style, type) not existing in this world. Check your input.")
+    def greeks(self, sigma) -> {}:
+        """
+        @return: {name: value} with the price and every Greek of GREEKS for each stock price (see bsm_chain).
+        """
+        return {name: self._like_s(value) for name, value in self._chain(sigma, True).items()}
 
-        return df
+    def delta(self, sigma):
+        return self._like_s(self._chain(sigma, ('delta',))['delta'])
 
-    def bsm_price(self, sigma):
+    def gamma(self, sigma):
+        return self._like_s(self._chain(sigma, ('gamma',))['gamma'])
 
-        # calculate the bsm price of European call and put options
-        sigma = float(sigma)
-        d1 = (np.log(self.s / self.k) + (self.rf - self.q + sigma ** 2 * 0.5) * self.T) / (sigma * np.sqrt(self.T))
-        d2 = d1 - sigma * np.sqrt(self.T)
+    def vega(self, sigma):
+        return self._like_s(self._chain(sigma, ('vega',))['vega'])
 
-        if self.typeOption == 'c':
-            price = np.exp(-self.rf * self.T) * (self.s * np.exp((self.rf - self.q) * self.T) * stats.norm.cdf(d1)
-                                                 - self.k * stats.norm.cdf(d2))
-            return price
+    def theta(self, sigma):
+        return self._like_s(self._chain(sigma, ('theta',))['theta'])
 
-        elif self.typeOption == 'p':
-            price = np.exp(-self.rf * self.T) * (self.k * stats.norm.cdf(-d2) -
-                                                 self.s * np.exp((self.rf - self.q) * self.T) * stats.norm.cdf(-d1))
-            return price
+    def rho(self, sigma):
+        return self._like_s(self._chain(sigma, ('rho',))['rho'])
 
-        else:
-            print(f"No such option type, check function parameters")
+    def stress(self, sigma, spotShocks, volShocks=(0,), horizons=(0,)) -> np.ndarray:
+        """
+        P&L of the position (long or short one option on the last stock price) under a grid of spot shocks x
+        volatility shocks x time decay (see scenario_pnl).
+        @return: (spot shocks x vol shocks x horizons) array.
+        """
+        book = pd.DataFrame({'underlying': ['s'], 'spot': [float(np.ravel(np.asarray(self.s, dtype=np.float64))[-1])],
+                             'k': [self.k], 'T': [self.T], 'sigma': [sigma], 'rf': [self.rf], 'q': [self.q],
+                             'typeOption': [self.typeOption], 'quantity': [self._quantity()]})
+        return scenario_pnl(book, spotShocks, volShocks, horizons).pnl[0]
 
-    def delta(self):
-        return
+    def compute_implied_volatility(self, tol: float = 1e-8, maxiter: int = 100):
+        """
+        Volatility for which the BSM price of the option equals its premium, for each stock price
+        (see implied_volatility). NaN where it does not converge (e.g. premium outside of the no-arbitrage bounds).
+        """
+        result = implied_volatility(self.premium, np.asarray(self.s, dtype=np.float64), self.k, self.T, self.rf,
+                                    self.q, self.typeOption, tol, maxiter)
+        return self._like_s(result['volatility'])
 
-    def gamma(self):
-        return
 
-    def vega(self):
-        return
+class OptionStrategy:
+
+    def __init__(self, options: [Options], quantities: [float] = None):
+        """
+        Multi-leg strategy (spread, straddle, condor...) made of Options legs on the same underlying.
+        @param options: legs; the style of each leg gives the sign of its quantity.
+        @param quantities: number of contracts of each leg. Default 1.
+        """
+        self.options = list(options)
+        quantities = np.ones(len(self.options)) if quantities is None else np.asarray(quantities, dtype=np.float64)
+        self.k = np.array([option.k for option in self.options], dtype=np.float64)
+        self.premium = np.array([option.premium for option in self.options], dtype=np.float64)
+        self.typeOption = np.array([option.typeOption for option in self.options])
+        self.quantity = quantities * np.array([option._quantity() for option in self.options])
+
+    def payoff(self):
+        """
+        @return: Dataframe with the "Payoff" at expiry of the whole strategy for each price of the stock price
+        history of the first leg.
+        """
+        s = self.options[0].s
+        prices = s.iloc[:, 0] if isinstance(s, pd.DataFrame) else s
+        df = pd.DataFrame(index=getattr(prices, 'index', None))
+        df["Payoff"] = legs_payoff(np.asarray(prices, dtype=np.float64), self.k, self.premium, self.typeOption,
+                                   self.quantity)
+        return df
+
+    def profile(self, prices=None, nb_points: int = 1001) -> {}:
+        """
+        @return: P&L grid, breakevens, maximum profit and loss at expiry (see strategy_profile).
+        """
+        return strategy_profile(self.k, self.premium, self.typeOption, self.quantity, prices, nb_points)
 
-    def theta(self):
-        return
 
-    def rho(self):
-        return
+class LatticeOption(Options):
+
+    def __init__(self, s: pd.DataFrame, style: str, typeOption: str, k: float, premium: float, T: float,
+                 rf: float = 0, q: float = 0, american: bool = True, steps: int = 500, method: str = 'binomial'):
+        """
+        Option priced on a binomial / trinomial lattice (see lattice_price), American by default. Same interface as
+        Options: price, greeks and every sensitivity take the volatility and are computed for every stock price at
+        once. Delta, gamma and theta are read from the lattice; vega and rho are central differences of lattice
+        prices (vegaBump, rhoBump), all bumps being priced in one lattice_price call. The implied volatility
+        inverts the lattice price (see lattice_implied_volatility).
+        """
+        super().__init__(s, style, typeOption, k, premium, T, rf, q)
+        self.american = american
+        self.steps = steps
+        self.method = method
+
+    vegaBump = 1e-2
+    rhoBump = 1e-4
+
+    def _chain(self, sigma, greeks=False) -> {}:
+        s = np.asarray(self.s, dtype=np.float64)
+        names = {'delta', 'gamma', 'theta', 'vega', 'rho'} if greeks is True else \
+            set() if greeks is False else set(greeks)
+        if names - {'delta', 'gamma', 'theta', 'vega', 'rho'}:
+            raise Exception(f"{sorted(names - {'delta', 'gamma', 'theta', 'vega', 'rho'})} not available from the "
+                            f"lattice.")
+        # base, sigma -/+ vegaBump and rf -/+ rhoBump priced together on a leading axis
+        bumps = np.zeros((5, 2))
+        bumps[1:3, 0] = -self.vegaBump, self.vegaBump
+        bumps[3:, 1] = -self.rhoBump, self.rhoBump
+        rows = 5 if names & {'vega', 'rho'} else 1
+        sigmas, rfs = ((value + bumps[:rows, j]).reshape((rows,) + (1,) * s.ndim)
+                       for j, value in enumerate((sigma, self.rf)))
+        result = lattice_price(s[None], self.k, self.T, sigmas, rfs, self.q, self.typeOption, self.american,
+                               self.steps, self.method)
+        chain = {name: result[name][0] for name in ('price', 'delta', 'gamma', 'theta') if name == 'price' or
+                 name in names}
+        if 'vega' in names:
+            chain['vega'] = (result['price'][2] - result['price'][1]) / (2 * self.vegaBump)
+        if 'rho' in names:
+            chain['rho'] = (result['price'][4] - result['price'][3]) / (2 * self.rhoBump)
+        return chain
+
+    def compute_implied_volatility(self, tol: float = 1e-6, maxiter: int = 100):
+        """
+        Volatility for which the lattice price of the option equals its premium, for each stock price (see
+        lattice_implied_volatility). NaN where it does not converge.
+        """
+        result = lattice_implied_volatility(self.premium, np.asarray(self.s, dtype=np.float64), self.k, self.T,
+                                            self.rf, self.q, self.typeOption, self.american, self.steps, self.method,
+                                            tol, maxiter)
+        return self._like_s(result['volatility'])
 
 
+class MonteCarloOption(Options):
 
-    def compute_implied_volatility(self):
-        # apply bisection method to get the implied volatility by solving the BSM function
-        precision = 0.00001
-        upper_vol = 500.0
-        max_vol = 500.0
-        lower_vol = 0.0001
-        iteration = 0
+    def __init__(self, s: pd.DataFrame, style: str, typeOption: str, k: float, premium: float, T: float,
+                 rf: float = 0, q: float = 0, payoff: str = 'european', barrier: float = None,
+                 barrierType: str = 'up-and-out', steps: int = 252, nb_paths: int = 100000, chunkSize: int = 10000,
+                 antithetic: bool = True, control_variate: bool = True, seed=None):
+        """
+        Path-dependent option (european, asian or barrier payoff) priced by Monte-Carlo (see monte_carlo_price).
+        Same interface as Options: price, greeks and delta take the volatility; greeks also gives the standard
+        error of the price. A fixed seed makes successive calls use the same paths. The other sensitivities (gamma,
+        vega, theta, rho) are not supported, nor the implied volatility of an asian or barrier payoff (that of a
+        european payoff is the BSM one).
+        """
+        super().__init__(s, style, typeOption, k, premium, T, rf, q)
+        self.payoffType = payoff
+        self.barrier = barrier
+        self.barrierType = barrierType
+        self.steps = steps
+        self.nb_paths = nb_paths
+        self.chunkSize = chunkSize
+        self.antithetic = antithetic
+        self.control_variate = control_variate
+        self.seed = seed
 
-        while 1:
-            iteration += 1
-            mid_vol = (upper_vol + lower_vol) / 2.0
-            price = self.bsm_price(self, mid_vol)
+    def _chain(self, sigma, greeks=False) -> {}:
+        result = monte_carlo_price(np.asarray(self.s, dtype=np.float64), self.k, self.T, sigma, self.rf, self.q,
+                                   self.typeOption, self.payoffType, self.barrier, self.barrierType, self.steps,
+                                   self.nb_paths, self.chunkSize, self.antithetic, self.control_variate, self.seed)
+        names = set(result) - {'price'} if greeks is True else set() if greeks is False else set(greeks)
+        if names - set(result):
+            raise Exception(f"{sorted(names - set(result))} not available from the Monte-Carlo pricer.")
+        return {name: value for name, value in result.items() if name == 'price' or name in names}
 
-            if self.typeOption == 'c':
+    def _unsupported(self, name: str):
+        raise Exception(f"{name} is not supported by MonteCarloOption.")
 
-                lower_price = self.bsm_price(self, lower_vol)
-                if (lower_price - self.premium) * (price - self.premium) > 0:
-                    lower_vol = mid_vol
-                else:
-                    upper_vol = mid_vol
-                if abs(price - self.premium) < precision:
-                    break
-                if iteration > 50:
-                    break
+    def gamma(self, sigma):
+        self._unsupported('gamma')
 
-            elif self.typeOption == 'p':
-                upper_price = self.bsm_price(self, upper_vol)
+    def vega(self, sigma):
+        self._unsupported('vega')
 
-                if (upper_price - self.premium) * (price - self.premium) > 0:
-                    upper_vol = mid_vol
-                else:
-                    lower_vol = mid_vol
-                if abs(price - self.premium) < precision:
-                    break
+    def theta(self, sigma):
+        self._unsupported('theta')
 
+    def rho(self, sigma):
+        self._unsupported('rho')
 
-        return mid_vol
+    def compute_implied_volatility(self, tol: float = 1e-8, maxiter: int = 100):
+        if self.payoffType != 'european':
+            self._unsupported(f"The implied volatility of the {self.payoffType} payoff")
+        return super().compute_implied_volatility(tol, maxiter)
@@ -2,17 +2,48 @@ from typing import Any, Dict
 import numpy as np
 import pandas as pd
 from sklearn.linear_model import LinearRegression
-import yfinance as yf
 from BenUpFin import preProcessing as pp
+from BenUpFin.priceStore import PriceStore, YahooFetcher, period_start
+from BenUpFin.sharedReturns import ReturnsMatrix
 
 
 class Metrics:
 
     def __init__(self, data: pd.DataFrame(), tickers: [str]):
+        """
+        @param data: Dataframe with an "Adj Close" column, or a sharedReturns.ReturnsMatrix of daily returns.
+        """
         self.tickers = tickers
-        self.data = data
-        self.returns = pp.get_daily_returns(data, tickers)
+        if isinstance(data, ReturnsMatrix):
+            self.returns = data.to_frame(tickers)
+            self._base = data.base
+            self._data = None
+        else:
+            self.returns = pp.get_daily_returns(data, tickers)
+            self._data = data
 
+    @property
+    def data(self) -> pd.DataFrame():
+        """
+        Prices. When built from a ReturnsMatrix, the value of 1 invested in each ticker (computed on first use)
+        stands for the "Adj Close" prices, starting from the base date of the matrix when it is known.
+        """
+        if self._data is None:
+            prices = (1 + self.returns).cumprod()
+            if self._base is not None:
+                start = pd.DataFrame(1.0, index=pd.Index([self._base]), columns=prices.columns)
+                prices = pd.concat([start, prices])
+            self._data = pd.concat({'Adj Close': prices}, axis=1)
+        return self._data
+
+    @classmethod
+    def from_store(cls, store, tickers: [str], start=None, end=None, period: str = None, update: bool = True):
+        """
+        Build the metrics from a priceStore.PriceStore instead of downloading the prices.
+        @param update: fetch the missing dates first. False only reads the local store (no network access).
+        """
+        return cls(store.download(tickers, start=start, end=end, period=period, fields=('Adj Close',), update=update),
+                   tickers)
 
     def get_years_past(self) -> float:
         """
@@ -139,10 +170,17 @@ class Metrics:
         return alpha
 
     @staticmethod
-    def get_risk_free_rate() -> float:
+    def get_risk_free_rate(store: PriceStore = None, update: bool = True) -> float:
         """
         Get the 3-month treasury bond rate which is the risk free rate.
+        @param store: optional priceStore.PriceStore to read ^IRX from (only missing dates are downloaded). Default
+        a direct download, nothing being written to disk.
+        @param update: fetch the missing dates first. False only reads the local store.
         @return: mean 3 month treasury bond rate over 1 year
         """
-        rf_rate = yf.download(tickers="^IRX", period="6m")["Adj Close"].dropna().mean()
+        if store is None:
+            rf_rate = YahooFetcher()(["^IRX"], start=period_start("6mo"))["Adj Close"]["^IRX"]
+        else:
+            rf_rate = store.download(["^IRX"], period="6mo", fields=("Adj Close",), update=update)["Adj Close"]["^IRX"]
+        rf_rate = rf_rate.dropna().mean()
         return round(rf_rate, 5)
@@ -1,41 +1,388 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import pandas as pd
 import numpy as np
-from numpy.random import dirichlet, choice
+import matplotlib
 import matplotlib.pyplot as plt
 from BenUpFin import preProcessing as pp
+from BenUpFin.sharedReturns import ReturnsMatrix
+from BenUpFin.monteCarlo import get_seed_sequence
 
 
-def plot_sim_portfolios(simul_perf: pd.DataFrame(), nb_simulation: int = 10000):
+def non_dominated(volatilities: np.ndarray, returns: np.ndarray) -> np.ndarray:
+    """
+    Positions of the Pareto-optimal portfolios (no other portfolio has a lower or equal volatility and a higher
+    return): sorted by volatility, a portfolio is kept when its return beats every less volatile one. O(n log n).
+    @return: positions sorted by increasing volatility.
+    """
+    volatilities = np.asarray(volatilities)
+    returns = np.asarray(returns)
+    # a single-key sort first: a Pareto-optimal portfolio has a return at least as high as every portfolio before it,
+    # whatever the order of equal volatilities, so only these candidates need the exact (volatility, -return) sort
+    order = np.argsort(volatilities)
+    sortedReturns = returns[order]
+    candidates = order[sortedReturns >= np.maximum.accumulate(sortedReturns)]
+    order = candidates[np.lexsort((-returns[candidates], volatilities[candidates]))]
+    sortedReturns = returns[order]
+    best = np.maximum.accumulate(sortedReturns)
+    keep = np.empty(len(order), dtype=bool)
+    keep[:1] = True
+    keep[1:] = sortedReturns[1:] > best[:-1]
+    return order[keep]
+
+
+def pareto_front(simul_perf: pd.DataFrame()) -> pd.DataFrame():
+    """
+    Efficient frontier of simulated portfolios, without plotting.
+    @param simul_perf: output of the sim_portfolios method (volatility in the first column, return in the second).
+    @return: rows of the non-dominated portfolios, sorted by increasing volatility.
+    """
+    return simul_perf.iloc[non_dominated(simul_perf.iloc[:, 0].values, simul_perf.iloc[:, 1].values)]
+
+
+def plot_sim_portfolios(simul_perf: pd.DataFrame(), nb_simulation: int = None, mode: str = 'auto', bins: int = 300,
+                        max_points: int = 100000):
     """
     Plotting function of the randomly generated portfolios.
     @param simul_perf: First out put of the sim_portfolios method.
-    @param nb_simulation: nb of simulated portfolios generated.
+    @param nb_simulation: nb of simulated portfolios generated (for the title). Default the number of rows.
+    @param mode: "scatter" draws every portfolio colored by its sharpe ratio, "density" bins the cloud in a
+    (bins x bins) grid of counts before drawing, so the cost of the figure does not depend on the number of
+    portfolios. "auto" uses the scatter up to max_points portfolios.
     @return: A plot
     """
-    print(simul_perf)
-    ax = simul_perf.plot.scatter(x=0, y=1, c=2, cmap='Blues',
-                                 alpha=0.2, figsize=(14, 9), colorbar=True,
-                                 title=f'{nb_simulation:,d} Simulated Portfolios')
+    if mode not in ('auto', 'scatter', 'density'):
+        raise Exception(f"Unknown mode {mode}. Use 'auto', 'scatter' or 'density'.")
+    nb_simulation = len(simul_perf) if nb_simulation is None else nb_simulation
+    volatilities = simul_perf.iloc[:, 0].values
+    returns = simul_perf.iloc[:, 1].values
+    sharpe = simul_perf.iloc[:, 2].values
+    title = f'{nb_simulation:,d} Simulated Portfolios'
+
+    fig, ax = plt.subplots(figsize=(14, 9))
+    if mode == 'scatter' or (mode == 'auto' and len(simul_perf) <= max_points):
+        points = ax.scatter(volatilities, returns, c=sharpe, cmap='Blues', alpha=0.2)
+        fig.colorbar(points, ax=ax, label=simul_perf.columns[2])
+    else:
+        finite = np.isfinite(volatilities) & np.isfinite(returns)
+        x, y = volatilities[finite], returns[finite]
+        xEdges = np.linspace(x.min(), x.max(), bins + 1)
+        yEdges = np.linspace(y.min(), y.max(), bins + 1)
+        # uniform bins: the bin of each portfolio is computed directly and counted with a single bincount
+        xBin = np.clip(((x - xEdges[0]) / max(xEdges[-1] - xEdges[0], 1e-300) * bins).astype(np.int64), 0, bins - 1)
+        yBin = np.clip(((y - yEdges[0]) / max(yEdges[-1] - yEdges[0], 1e-300) * bins).astype(np.int64), 0, bins - 1)
+        counts = np.bincount(yBin * bins + xBin, minlength=bins * bins).reshape(bins, bins)
+        image = ax.imshow(np.ma.masked_equal(counts, 0), origin='lower', aspect='auto', cmap='Blues',
+                          extent=(xEdges[0], xEdges[-1], yEdges[0], yEdges[-1]),
+                          norm=matplotlib.colors.LogNorm())
+        fig.colorbar(image, ax=ax, label='Number of portfolios')
+    ax.set_title(title)
+    ax.set_xlabel(simul_perf.columns[0])
+    ax.set_ylabel(simul_perf.columns[1])
+
+    front = non_dominated(volatilities, returns)
+    ax.plot(volatilities[front], returns[front], color='darkorange', linewidth=1.5, label='Efficient Frontier')
 
-    max_sharpe_idx = simul_perf.iloc[:, 2].idxmax()
-    sd, r = simul_perf.iloc[max_sharpe_idx, :2].values
+    max_sharpe_idx = np.nanargmax(sharpe)
+    sd, r = volatilities[max_sharpe_idx], returns[max_sharpe_idx]
     print(f'Max Sharpe: annualized standard deviation={sd:.2%}, anualized return={r:.2%}')
     ax.scatter(sd, r, marker='*', color='darkblue', s=500, label='Max. Sharpe Ratio')
 
-    min_vol_idx = simul_perf.iloc[:, 0].idxmin()
-    sd, r = simul_perf.iloc[min_vol_idx, :2].values
+    min_vol_idx = np.nanargmin(volatilities)
+    sd, r = volatilities[min_vol_idx], returns[min_vol_idx]
     ax.scatter(sd, r, marker='*', color='green', s=500, label='Min Volatility')
     plt.legend(labelspacing=1, loc='upper left')
     plt.tight_layout()
     plt.show()
 
 
+def _box_bounds(bounds, nb_assets: int, short: bool = False) -> (np.ndarray, np.ndarray):
+    """
+    @param bounds: (lower, upper) weight bounds, scalars or one value per asset. Default (0, 1), or (-1, 1) when short.
+    @return: lower and upper bound arrays.
+    """
+    if bounds is None:
+        bounds = (-1, 1) if short else (0, 1)
+    lower = np.broadcast_to(np.asarray(bounds[0], dtype=np.float64), (nb_assets,)).copy()
+    upper = np.broadcast_to(np.asarray(bounds[1], dtype=np.float64), (nb_assets,)).copy()
+    if not (np.all(np.isfinite(lower)) and np.all(np.isfinite(upper))) or np.any(lower > upper):
+        raise Exception("Weight bounds should be finite with lower <= upper.")
+    if lower.sum() > 1 or upper.sum() < 1:
+        raise Exception("No fully invested portfolio satisfies the weight bounds.")
+    return lower, upper
+
+
+def project_weights(v: np.ndarray, lower: np.ndarray, upper: np.ndarray, tau: float = None) -> (np.ndarray, float):
+    """
+    Euclidean projection onto the fully invested portfolios with box constraints {sum(w) = 1, lower <= w <= upper}.
+    The projection is clip(v - tau, lower, upper) where tau solves a piecewise linear equation, found by safeguarded
+    Newton steps (exact after a few iterations) inside the bracket [min(v - upper), max(v - lower)].
+    @param tau: starting guess, e.g. the shift of the previous projection in an iterative solver.
+    @return: projected weights and their shift tau.
+    """
+    low, high = np.min(v - upper), np.max(v - lower)
+    tau = (np.sum(v) - 1) / len(v) if tau is None else tau
+    tau = min(max(tau, low), high)
+    for _ in range(100):
+        shifted = v - tau
+        w = np.clip(shifted, lower, upper)
+        excess = w.sum() - 1
+        if abs(excess) <= 1e-13:
+            break
+        if excess > 0:
+            low = tau
+        else:
+            high = tau
+        free = np.count_nonzero((shifted > lower) & (shifted < upper))
+        step = tau + excess / free if free else np.nan
+        tau = step if low < step < high else (low + high) / 2
+    return w, tau
+
+
+def solve_frontier_qp(mean: np.ndarray, cov: np.ndarray, tradeoff: float, lower: np.ndarray, upper: np.ndarray,
+                      x0: np.ndarray = None, lipschitz: float = None, tol: float = 1e-10,
+                      maxiter: int = 20000) -> np.ndarray:
+    """
+    Weights minimising 0.5 * w'(cov)w - tradeoff * mean'w over the fully invested portfolios within the bounds, by
+    accelerated projected gradient (FISTA with adaptive restart). Each iteration costs one matrix-vector product and
+    one projection, and a warm start `x0` close to the solution (e.g. the neighbouring frontier point) cuts the
+    number of iterations.
+    @param tradeoff: 0 gives the minimum variance portfolio, larger values move up the efficient frontier.
+    @param lipschitz: largest eigenvalue of cov (computed when not given).
+    @param tol: stop when no weight moves by more than tol in an iteration.
+    @return: weights.
+    """
+    if lipschitz is None:
+        lipschitz = np.linalg.eigvalsh(cov)[-1]
+    step = 1 / lipschitz
+    linear = tradeoff * mean
+    w, tau = project_weights(np.full(len(mean), 1 / len(mean)) if x0 is None else np.asarray(x0, np.float64),
+                             lower, upper)
+    y = w
+    theta = 1
+    for _ in range(maxiter):
+        nextW, tau = project_weights(y - step * (cov @ y - linear), lower, upper, tau)
+        move = nextW - w
+        if np.max(np.abs(move)) <= tol:
+            return nextW
+        nextTheta = (1 + np.sqrt(1 + 4 * theta ** 2)) / 2
+        if np.dot(y - nextW, move) > 0:
+            # the momentum points uphill: restart the acceleration
+            nextTheta = 1
+            y = nextW
+        else:
+            y = nextW + (theta - 1) / nextTheta * move
+        w, theta = nextW, nextTheta
+    return w
+
+
+def _max_return_weights(mean: np.ndarray, lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+    """
+    Highest return portfolio within the bounds: everything at its lower bound, then the remaining budget given to the
+    assets by decreasing mean return.
+    """
+    w = lower.copy()
+    budget = 1 - lower.sum()
+    for i in np.argsort(-mean, kind='stable'):
+        add = min(upper[i] - lower[i], budget)
+        w[i] += add
+        budget -= add
+        if budget <= 0:
+            break
+    return w
+
+
+def _frontier_ends(mean: np.ndarray, cov: np.ndarray, lower: np.ndarray, upper: np.ndarray, lipschitz: float,
+                   tol: float) -> (np.ndarray, np.ndarray, float):
+    """
+    @return: minimum variance weights, maximum return end of the frontier and the tradeoff reaching it.
+    """
+    minVariance = solve_frontier_qp(mean, cov, 0, lower, upper, lipschitz=lipschitz, tol=tol)
+    lowReturn, highReturn = mean @ minVariance, mean @ _max_return_weights(mean, lower, upper)
+    if highReturn - lowReturn <= 1e-12 * max(abs(highReturn), 1e-12):
+        return minVariance, minVariance, 0.0
+    tradeoff = lipschitz / (highReturn - lowReturn)
+    w = minVariance
+    for _ in range(60):
+        w = solve_frontier_qp(mean, cov, tradeoff, lower, upper, x0=w, lipschitz=lipschitz, tol=tol)
+        if mean @ w >= highReturn - 1e-6 * (highReturn - lowReturn):
+            break
+        tradeoff *= 2
+    return minVariance, w, tradeoff
+
+
+def efficient_frontier_weights(mean: np.ndarray, cov: np.ndarray, nb_points: int = 50, lower: np.ndarray = None,
+                               upper: np.ndarray = None, tol: float = 1e-10) -> (np.ndarray, np.ndarray):
+    """
+    Portfolios of the efficient frontier, from the minimum variance portfolio to the maximum return one, with evenly
+    spaced returns. Each point solves solve_frontier_qp for the tradeoff giving its target return, searched by
+    secant steps between its neighbours (the return grows piecewise linearly with the tradeoff), every solve being
+    warm-started from the previous point.
+    @param lower, upper: weight bounds (see _box_bounds). Default long only.
+    @return: (nb_points x n) weights and the tradeoff of each point.
+    """
+    lower, upper = _box_bounds((0 if lower is None else lower, 1 if upper is None else upper), len(mean))
+    lipschitz = np.linalg.eigvalsh(cov)[-1]
+    minVariance, maxReturn, highTradeoff = _frontier_ends(mean, cov, lower, upper, lipschitz, tol)
+    lowReturn, highReturn = mean @ minVariance, mean @ maxReturn
+    weights = np.empty((nb_points, len(mean)))
+    tradeoffs = np.empty(nb_points)
+    weights[0], tradeoffs[0] = minVariance, 0
+    if nb_points == 1:
+        return weights, tradeoffs
+    weights[-1], tradeoffs[-1] = maxReturn, highTradeoff
+
+    targets = np.linspace(lowReturn, highReturn, nb_points)
+    accuracy = 1e-2 * (highReturn - lowReturn) / (nb_points - 1)
+    lowT, lowR = 0.0, lowReturn
+    slope = (highReturn - lowReturn) / highTradeoff
+    for k in range(1, nb_points - 1):
+        highT, highR = highTradeoff, highReturn
+        w = weights[k - 1]
+        # first guess from the slope of the previous segment, then secant steps kept inside the bracket
+        t, lastT, lastR = lowT + (targets[k] - lowR) / slope, lowT, lowR
+        for _ in range(50):
+            if not lowT < t < highT:
+                t = (lowT + highT) / 2
+            w = solve_frontier_qp(mean, cov, t, lower, upper, x0=w, lipschitz=lipschitz, tol=tol)
+            r = mean @ w
+            if abs(r - targets[k]) <= accuracy or highT - lowT <= 1e-12 * highTradeoff:
+                break
+            if r < targets[k]:
+                lowT, lowR = t, r
+            else:
+                highT, highR = t, r
+            nextT = t + (targets[k] - r) * (t - lastT) / (r - lastR) if r != lastR else np.nan
+            lastT, lastR = t, r
+            t = nextT
+        if t > tradeoffs[k - 1] and r > mean @ weights[k - 1]:
+            slope = (r - mean @ weights[k - 1]) / (t - tradeoffs[k - 1])
+        weights[k], tradeoffs[k] = w, t
+        lowT, lowR = t, r
+    return weights, tradeoffs
+
+
+def max_sharpe_weights(mean: np.ndarray, cov: np.ndarray, rf: float = 0, lower: np.ndarray = None,
+                       upper: np.ndarray = None, tol: float = 1e-10) -> np.ndarray:
+    """
+    Maximum Sharpe ratio portfolio within the bounds. The Sharpe ratio is unimodal along the efficient frontier but
+    flat beyond the tradeoff reaching the maximum return portfolio, so the tradeoff of solve_frontier_qp maximising
+    it is first bracketed on a geometric grid, then refined by golden section search, each solve being warm-started
+    from the previous one.
+    @param rf: risk free rate over the period of the mean returns.
+    @return: weights.
+    """
+    lower, upper = _box_bounds((0 if lower is None else lower, 1 if upper is None else upper), len(mean))
+    lipschitz = np.linalg.eigvalsh(cov)[-1]
+    minVariance, maxReturn, highTradeoff = _frontier_ends(mean, cov, lower, upper, lipschitz, tol)
+    warm = {'w': minVariance}
+
+    def sharpe(t):
+        w = solve_frontier_qp(mean, cov, t, lower, upper, x0=warm['w'], lipschitz=lipschitz, tol=tol)
+        warm['w'] = w
+        return (mean @ w - rf) / np.sqrt(max(w @ cov @ w, 1e-300)), w
+
+    grid = np.r_[0, np.geomspace(1e-6 * highTradeoff, highTradeoff, 25)] if highTradeoff > 0 else np.zeros(1)
+    scan = [sharpe(t) for t in grid]
+    best = max(range(len(grid)), key=lambda i: scan[i][0])
+    if len(grid) == 1:
+        return scan[0][1]
+
+    ratio = (np.sqrt(5) - 1) / 2
+    a, b = grid[max(best - 1, 0)], grid[min(best + 1, len(grid) - 1)]
+    warm['w'] = scan[best][1]
+    c, d = b - ratio * (b - a), a + ratio * (b - a)
+    (fc, wc), (fd, wd) = sharpe(c), sharpe(d)
+    while b - a > 1e-6 * (grid[min(best + 1, len(grid) - 1)] - grid[max(best - 1, 0)]):
+        if fc >= fd:
+            b, d, fd, wd = d, c, fc, wc
+            c = b - ratio * (b - a)
+            fc, wc = sharpe(c)
+        else:
+            a, c, fc, wc = c, d, fd, wd
+            d = a + ratio * (b - a)
+            fd, wd = sharpe(d)
+    return max([(fc, wc), (fd, wd), scan[best]], key=lambda candidate: candidate[0])[1]
+
+
+def _select_portfolios(volatilities: np.ndarray, returns: np.ndarray, sharpe: np.ndarray, top_k: int) -> np.ndarray:
+    """
+    @return: sorted positions of the Pareto-optimal portfolios and of the top_k highest sharpe ratios (ties broken by
+    position, so the selection only depends on the portfolios and their order).
+    """
+    best = np.argsort(-sharpe, kind='stable')[:top_k]
+    return np.union1d(non_dominated(volatilities, returns), best)
+
+
+def _simulate_portfolio_shard(task) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+    """
+    Worker of PortOpt.sim_portfolios: draw and evaluate one shard of random portfolios. The mean vector (first row)
+    and the covariance matrix are read from shared memory when a shared memory name is given.
+    @return: position in the shard, annualized volatility, annualized return and weights (None unless kept) of the
+    portfolios of the shard, or of its Pareto-optimal and top_k sharpe ones only when top_k is not None.
+    """
+    moments, nb_assets, rows, seedSequence, short, days, rf_rate, keep_weights, top_k = task
+    shm = None
+    if isinstance(moments, str):
+        shm = shared_memory.SharedMemory(name=moments)
+        moments = np.ndarray((nb_assets + 1, nb_assets), dtype=np.float64, buffer=shm.buf)
+    try:
+        rng = np.random.default_rng(seedSequence)
+        # Generate weights (randomly)
+        weights = rng.dirichlet(alpha=np.full(nb_assets, .05), size=rows)
+        if short:
+            weights *= rng.choice([-1, 1], size=(rows, 1))
+        # Generate associated returns and volatilities (batched quadratic form)
+        returns = weights @ moments[0] * days
+        volatilities = np.sqrt(np.einsum('ij,ij->i', weights @ moments[1:], weights)) * np.sqrt(days)
+    finally:
+        del moments
+        if shm is not None:
+            shm.close()
+
+    positions = np.arange(rows)
+    if top_k is not None:
+        positions = _select_portfolios(volatilities, returns, (returns - rf_rate) / volatilities, top_k)
+        returns, volatilities, weights = returns[positions], volatilities[positions], weights[positions]
+    return positions, volatilities, returns, weights if keep_weights else None
+
+
 class PortOpt:
 
-    def __init__(self, data: pd.DataFrame(), tickers: [str]):
+    def __init__(self, data: pd.DataFrame(), tickers: [str], estimator=None):
+        """
+        @param data: Dataframe with an "Adj Close" column, or a sharedReturns.ReturnsMatrix of daily returns.
+        @param estimator: optional covEstimators estimator giving the mean and covariance used by the optimizations
+        (fed with the returns if it has not absorbed any yet, kept as is otherwise, e.g. a state loaded from disk).
+        Default the sample mean and covariance of the returns.
+        """
         self.tickers = tickers
         self.data = data
-        self.returns = pp.get_daily_returns(data=data, tickers=tickers, method="percent")
+        self.estimator = estimator
+        if isinstance(data, ReturnsMatrix):
+            self.returns = data.to_frame(tickers)
+        else:
+            self.returns = pp.get_daily_returns(data=data, tickers=tickers, method="percent")
+
+    @classmethod
+    def from_store(cls, store, tickers: [str], start=None, end=None, period: str = None, estimator=None,
+                   update: bool = True):
+        """
+        Build the optimizer from a priceStore.PriceStore instead of downloading the prices.
+        @param update: fetch the missing dates first. False only reads the local store (no network access).
+        """
+        return cls(store.download(tickers, start=start, end=end, period=period, fields=('Adj Close',), update=update),
+                   tickers, estimator)
+
+    def get_moments(self) -> (np.ndarray, np.ndarray):
+        """
+        @return: mean vector and covariance matrix of the daily returns, from the estimator when one is set.
+        """
+        if self.estimator is None:
+            return self.returns.mean().values, self.returns.cov().values
+        if self.estimator.count == 0:
+            self.estimator.update(self.returns.values)
+        return self.estimator.mean(), self.estimator.covariance()
 
     def get_days_past(self) -> float:
         """
@@ -47,44 +394,151 @@ class PortOpt:
 
         return round((end_date - start_date).days, 4)
 
-    def sim_portfolios(self, nb_simulation: int = 10000, rf_rate: float = 0, short=False):
+    def sim_portfolios(self, nb_simulation: int = 10000, rf_rate: float = 0, short=False, chunkSize: int = 100000,
+                       seed=None, keep_weights: bool = True, n_workers: int = 1, keep: str = 'all',
+                       top_k: int = 100):
         """
         The simulation generates random weights using the Dirichlet distribution, and computes the mean,
         standard deviation, and SR for each sample portfolio using the historical return data.
+        The mean vector and covariance matrix are computed once; the portfolios are drawn and evaluated by shards of
+        chunkSize, so that millions of portfolios never need more than one shard of work memory per process. Each
+        shard has its own seed spawned from `seed`, so the results do not depend on the number of workers.
         @param rf_rate: risk free rate which typically is the 3-month treasury bond rate. default=0
         @param nb_simulation: Number of simulation to run. Number of random portfolio to generate.
         @param short: if some position are shorted set it to true (idest: negative weights possible)
-        @return:Dataframe and vectors of weights.
+        @param chunkSize: number of portfolios per shard (unit of work sent to a worker).
+        @param seed: int, np.random.SeedSequence or np.random.Generator, to make the simulation reproducible.
+        @param keep_weights: add the weights of every portfolio (one column per ticker) to the output.
+        @param n_workers: number of processes sharing the shards (the mean and covariance are put in shared memory).
+        1 runs everything in the current process.
+        @param keep: "all" to return every portfolio, "pareto" to only keep the Pareto-optimal portfolios (lowest
+        volatility for their return) and the top_k highest sharpe ratios, merged as the shards come back.
+        @param top_k: number of highest sharpe ratio portfolios kept when keep="pareto".
+        @return:Dataframe of the annualized standard deviation, annualized return and sharpe ratio of each portfolio
+        (and its weights), indexed by simulation number.
         """
+        if keep not in ('all', 'pareto'):
+            raise Exception(f"Unknown keep {keep}. Use 'all' or 'pareto'.")
+        days = self.get_days_past()
+        mean, cov = self.get_moments()
+        nb_assets = len(mean)
+        chunkSize = int(max(1, chunkSize))
+        nb_shards = -(-nb_simulation // chunkSize)
+        seeds = get_seed_sequence(seed).spawn(nb_shards)
+        top_k = int(top_k) if keep == 'pareto' else None
+
+        def tasks(moments):
+            for i, seedSequence in enumerate(seeds):
+                rows = min(chunkSize, nb_simulation - i * chunkSize)
+                yield moments, nb_assets, rows, seedSequence, short, days, rf_rate, keep_weights, top_k
 
-        returns = []
-        volatilities = []
-        sharpes = []
-        alpha = np.full(shape=len(self.returns.columns), fill_value=.05)
+        if keep == 'all':
+            index = np.arange(nb_simulation)
+            returns = np.empty(nb_simulation)
+            volatilities = np.empty(nb_simulation)
+            weights = np.empty((nb_simulation, nb_assets)) if keep_weights else None
+        else:
+            index = np.empty(0, dtype=np.int64)
+            returns = np.empty(0)
+            volatilities = np.empty(0)
+            weights = np.empty((0, nb_assets)) if keep_weights else None
 
-        for i in range(nb_simulation):
+        def collect(results):
+            nonlocal index, returns, volatilities, weights
+            for i, (positions, shardVolatilities, shardReturns, shardWeights) in enumerate(results):
+                start = i * chunkSize
+                if keep == 'all':
+                    volatilities[start:start + len(positions)] = shardVolatilities
+                    returns[start:start + len(positions)] = shardReturns
+                    if keep_weights:
+                        weights[start:start + len(positions)] = shardWeights
+                    continue
+                # running selection: the Pareto front and top sharpe ratios of the union are within those of the parts
+                index = np.concatenate([index, positions + start])
+                volatilities = np.concatenate([volatilities, shardVolatilities])
+                returns = np.concatenate([returns, shardReturns])
+                selected = _select_portfolios(volatilities, returns, (returns - rf_rate) / volatilities, top_k)
+                index, volatilities, returns = index[selected], volatilities[selected], returns[selected]
+                if keep_weights:
+                    weights = np.concatenate([weights, shardWeights])[selected]
 
-            # Generate weights (randomly)
-            weights = dirichlet(alpha=alpha)
-            if short:
-                weights *= choice([-1, 1])
-            # Generate associated returns and volatilities
-            rp = np.sum(self.returns.mean() * weights)*self.get_days_past()
-            var_p = np.dot(weights.T, np.dot(self.returns.cov(), weights))
-            std_p = np.sqrt(var_p) * np.sqrt(self.get_days_past())
-            sharpe_p = (rp - rf_rate) / std_p
-            returns.append(rp)
-            sharpes.append(sharpe_p)
-            volatilities.append(std_p)
+        moments = np.vstack([mean, cov])
+        if n_workers <= 1:
+            collect(map(_simulate_portfolio_shard, tasks(moments)))
+        else:
+            shm = shared_memory.SharedMemory(create=True, size=moments.nbytes)
+            try:
+                np.ndarray(moments.shape, dtype=np.float64, buffer=shm.buf)[:] = moments
+                with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                    collect(executor.map(_simulate_portfolio_shard, tasks(shm.name)))
+            finally:
+                shm.close()
+                shm.unlink()
+
+        df = pd.DataFrame({'Annualized Standard Deviation': volatilities,
+                           'Annualized Returns': returns,
+                           'Sharpe Ratio': (returns - rf_rate) / volatilities}, index=index)
+        if keep_weights:
+            df = pd.concat([df, pd.DataFrame(weights, index=index, columns=self.returns.columns)], axis=1)
+
+        return df
+
+    def _portfolios_frame(self, weights: np.ndarray, rf_rate: float, days: float, mean: np.ndarray,
+                          cov: np.ndarray) -> pd.DataFrame:
+        """
+        @return: weights evaluated with the same layout and annualization as sim_portfolios.
+        """
+        returns = weights @ mean * days
+        volatilities = np.sqrt(np.clip(np.einsum('ij,ij->i', weights @ cov, weights), 0, None)) * np.sqrt(days)
+        df = pd.DataFrame({'Annualized Standard Deviation': volatilities,
+                           'Annualized Returns': returns,
+                           'Sharpe Ratio': (returns - rf_rate) / volatilities})
+        return pd.concat([df, pd.DataFrame(weights, columns=self.returns.columns)], axis=1)
 
-        # Convert lists to arrays
-        returns = np.array(returns)
-        volatilities = np.array(volatilities)
-        sharpes = np.array(sharpes)
+    def efficient_frontier(self, nb_points: int = 50, rf_rate: float = 0, short=False, bounds=None) -> pd.DataFrame:
+        """
+        Compute the efficient frontier directly instead of sampling random portfolios (see efficient_frontier_weights):
+        nb_points portfolios from the minimum volatility one to the maximum return one.
+        @param rf_rate: risk free rate, used for the sharpe ratio. default=0
+        @param short: allow negative weights (bounds default to (-1, 1) instead of (0, 1)).
+        @param bounds: (lower, upper) bounds of the weights, scalars or one value per ticker.
+        @return: Dataframe with the same columns as sim_portfolios (weights included), one row per frontier point.
+        """
+        days = self.get_days_past()
+        mean, cov = self.get_moments()
+        lower, upper = _box_bounds(bounds, len(mean), short)
+        weights, _ = efficient_frontier_weights(mean, cov, nb_points, lower, upper)
+        return self._portfolios_frame(weights, rf_rate, days, mean, cov)
 
-        return pd.DataFrame({'Annualized Standard Deviation': volatilities,
-                             'Annualized Returns': returns,
-                             'Sharpe Ratio': sharpes})
+    def min_volatility_portfolio(self, rf_rate: float = 0, short=False, bounds=None) -> pd.Series:
+        """
+        Global minimum volatility portfolio within the bounds (see efficient_frontier for the parameters).
+        @return: Series with the annualized standard deviation, annualized return, sharpe ratio and weights.
+        """
+        days = self.get_days_past()
+        mean, cov = self.get_moments()
+        lower, upper = _box_bounds(bounds, len(mean), short)
+        weights = solve_frontier_qp(mean, cov, 0, lower, upper)
+        return self._portfolios_frame(weights[None], rf_rate, days, mean, cov).iloc[0]
 
+    def max_sharpe_portfolio(self, rf_rate: float = 0, short=False, bounds=None) -> pd.Series:
+        """
+        Maximum sharpe ratio portfolio within the bounds (see efficient_frontier for the parameters).
+        @return: Series with the annualized standard deviation, annualized return, sharpe ratio and weights.
+        """
+        days = self.get_days_past()
+        mean, cov = self.get_moments()
+        lower, upper = _box_bounds(bounds, len(mean), short)
+        weights = max_sharpe_weights(mean, cov, rf_rate / days, lower, upper)
+        return self._portfolios_frame(weights[None], rf_rate, days, mean, cov).iloc[0]
 
+    def backtest(self, strategies, lookback: int = 252, rebalance='M', costs: float = 0, estimator=None):
+        """
+        Walk-forward backtest of strategies re-optimized over a sliding window of the returns (see
+        backtest.WalkForward).
+        @param strategies: {name: strategy} or list of names of backtest.STRATEGIES.
+        @return: backtest.BacktestResult with the realized returns, weights history and turnover of each strategy.
+        """
+        from BenUpFin.backtest import WalkForward
+        return WalkForward(self.returns, lookback, rebalance, costs, estimator).run(strategies)
 
@@ -1,21 +1,70 @@
+from typing import NamedTuple
 import pandas as pd
 import numpy as np
 
 
-def get_daily_returns(data: pd.DataFrame(), tickers: [str], method: str = "percent"):
+class ReturnsArray(NamedTuple):
+    """
+    Returns as a contiguous (T x n) NumPy matrix with the metadata needed to rebuild the Dataframe.
+    """
+    values: np.ndarray
+    index: pd.Index
+    columns: list
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.values, index=self.index, columns=self.columns, copy=False)
+
+
+def get_daily_returns(data: pd.DataFrame(), tickers: [str], method: str = "percent", dtype=None,
+                      nan_policy="ffill", as_array: bool = False):
     """
     @param data: Dataframe with a column name "Adj Close"
     @param tickers: period over which the returns have to be computed
     @param method: log if you want log returns or percent if you want the basic return (as percentage of change)
+    @param dtype: dtype of the output (e.g. np.float32 to halve the memory). Default float64.
+    @param nan_policy: how missing prices are handled, either one policy for every ticker or a {ticker: policy}
+    dictionary (tickers not in the dictionary use "ffill"):
+        - "ffill": prices are forward filled (as pct_change historically did), dates still missing are dropped.
+        - "drop": dates where the return of this ticker is missing are dropped.
+        - "zero": missing returns are set to 0.
+        - "keep": missing returns are kept as NaN.
+    @param as_array: return a ReturnsArray (contiguous matrix, index and columns) instead of a Dataframe.
     @return: Dataframe of returns
     """
-    returns = pd.DataFrame()
+    if method not in ("percent", "log"):
+        raise Exception(f"Unknown method {method}. Use 'percent' or 'log'.")
+    tickers = list(tickers)
+    policies = nan_policy if isinstance(nan_policy, dict) else dict.fromkeys(tickers, nan_policy)
+    policies = np.array([policies.get(name, "ffill") for name in tickers])
+    unknown = set(policies) - {"ffill", "drop", "zero", "keep"}
+    if unknown:
+        raise Exception(f"Unknown nan_policy {unknown}. Use 'ffill', 'drop', 'zero' or 'keep'.")
+
+    prices = data['Adj Close'][tickers]
+    ffill = policies == "ffill"
+    if ffill.any() and prices.isna().values.any():
+        prices = prices.copy()
+        prices.iloc[:, ffill] = prices.iloc[:, ffill].ffill()
 
-    for name in tickers:
-        if method == "percent":
-            returns[name] = data['Adj Close'][name].pct_change()
-        elif method == "log":
-            returns[name] = np.log(1 + data['Adj Close'][name].pct_change())
+    values = prices.to_numpy(dtype=dtype or np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = values[1:] / values[:-1]
+    if method == "percent":
+        returns -= 1
+    else:
+        np.log(returns, out=returns)
 
-    return returns.dropna()
+    missing = np.isnan(returns)
+    if missing.any():
+        zero = policies == "zero"
+        returns[:, zero] = np.where(missing[:, zero], 0, returns[:, zero])
+        dropped = missing[:, (policies == "drop") | ffill].any(axis=1)
+        returns = returns[~dropped]
+        index = prices.index[1:][~dropped]
+    else:
+        index = prices.index[1:]
 
+    returns = np.ascontiguousarray(returns)
+    if as_array:
+        return ReturnsArray(returns, index, tickers)
+    return pd.DataFrame(returns, index=index, columns=tickers, copy=False)
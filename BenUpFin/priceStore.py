@@ -0,0 +1,246 @@
+import os
+import re
+import tempfile
+import numpy as np
+import pandas as pd
+
+FIELDS = ('Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume')
+
+
+def period_start(period: str, end: pd.Timestamp = None) -> pd.Timestamp:
+    """
+    Convert a yfinance-like period ("5d", "6mo", "1y", "ytd", "max"...) into a start date.
+    @param end: end of the period. Default today.
+    @return: start date (None for "max").
+    """
+    end = pd.Timestamp.today().normalize() if end is None else pd.Timestamp(end)
+    if period is None or period == 'max':
+        return None
+    if period == 'ytd':
+        return pd.Timestamp(year=end.year, month=1, day=1)
+    match = re.fullmatch(r'(\d+)(d|wk|mo|m|y)', period)
+    if match is None:
+        raise Exception(f"Unknown period {period}. Use for instance '5d', '1wk', '6mo', '1y', 'ytd' or 'max'.")
+    n, unit = int(match.group(1)), match.group(2)
+    offsets = {'d': pd.DateOffset(days=n), 'wk': pd.DateOffset(weeks=n), 'mo': pd.DateOffset(months=n),
+               'm': pd.DateOffset(months=n), 'y': pd.DateOffset(years=n)}
+    return end - offsets[unit]
+
+
+def last_session(end: pd.Timestamp = None) -> pd.Timestamp:
+    """
+    Last business day whose prices are complete: the last business day up to `end` when given, otherwise the last
+    business day before today (today's session is not closed yet).
+    """
+    end = pd.Timestamp.today().normalize() - pd.Timedelta(days=1) if end is None else pd.Timestamp(end).normalize()
+    return pd.offsets.BDay().rollback(end)
+
+
+def _split_fields(prices: pd.DataFrame, tickers: [str]) -> {}:
+    """
+    @param prices: yfinance layout, (field, ticker) columns, or a single ticker frame with field columns.
+    @return: {ticker: Dataframe with one column per field}
+    """
+    if isinstance(prices.columns, pd.MultiIndex):
+        return {name: prices.xs(name, axis=1, level=1) for name in tickers
+                if name in prices.columns.get_level_values(1)}
+    return {tickers[0]: prices}
+
+
+class YahooFetcher:
+
+    def __call__(self, tickers: [str], start: pd.Timestamp = None, end: pd.Timestamp = None) -> pd.DataFrame:
+        """
+        Download daily prices from Yahoo Finance (yfinance is only imported when used).
+        @return: Dataframe with (field, ticker) columns, as yf.download.
+        """
+        import yfinance as yf
+        data = yf.download(tickers=list(tickers), start=start, end=end, auto_adjust=False, progress=False)
+        if not isinstance(data.columns, pd.MultiIndex):
+            data.columns = pd.MultiIndex.from_product([data.columns, list(tickers)])
+        return data
+
+
+class CSVFetcher:
+
+    def __init__(self, directory: str):
+        """
+        Local stand-in for YahooFetcher (tests, offline runs): one "<ticker>.csv" file per ticker with a "Date"
+        column and one column per field.
+        """
+        self.directory = directory
+
+    def __call__(self, tickers: [str], start: pd.Timestamp = None, end: pd.Timestamp = None) -> pd.DataFrame:
+        frames = {}
+        for name in tickers:
+            df = pd.read_csv(os.path.join(self.directory, f"{name}.csv"), index_col='Date', parse_dates=True)
+            frames[name] = df.loc[start:end]
+        data = pd.concat(frames, axis=1)
+        return data.swaplevel(axis=1).sort_index(axis=1)
+
+
+class PriceStore:
+
+    def __init__(self, root: str, fetcher=None):
+        """
+        Local columnar store of daily prices, one file per ticker holding the dates and one array per field.
+        Reading a field only loads that column. New dates are appended incrementally, missing ones being fetched
+        with `fetcher`, so workers read local disk instead of downloading the same history again.
+        @param root: directory of the store (created if needed).
+        @param fetcher: callable (tickers, start, end) -> Dataframe with (field, ticker) columns. Default YahooFetcher.
+        """
+        self.root = os.path.expanduser(root)
+        self.fetcher = YahooFetcher() if fetcher is None else fetcher
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, ticker: str) -> str:
+        return os.path.join(self.root, f"{str(ticker).replace(os.sep, '_')}.npz")
+
+    def tickers(self) -> [str]:
+        return sorted(name[:-4] for name in os.listdir(self.root) if name.endswith('.npz'))
+
+    def _load(self, ticker: str, fields) -> (np.ndarray, {}, np.datetime64):
+        """
+        @return: stored dates, requested fields and the start date the history is complete from (NaT when the whole
+        history was fetched, None when the ticker is not stored).
+        """
+        path = self._path(ticker)
+        if not os.path.exists(path):
+            return np.empty(0, dtype='datetime64[ns]'), {}, None
+        with np.load(path) as columns:
+            return columns['Date'], {field: columns[field] for field in fields if field in columns.files}, \
+                columns['Since'][()]
+
+    def checked(self, ticker: str) -> pd.Timestamp:
+        """
+        @return: date up to which the history of `ticker` was last fetched (None when it is not stored). It can be
+        later than the last stored date when the fetcher had nothing new (holidays).
+        """
+        path = self._path(ticker)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as columns:
+            return pd.Timestamp(columns['Checked'][()] if 'Checked' in columns.files else columns['Date'][-1])
+
+    def _write(self, ticker: str, arrays: {}):
+        # write to a temporary file first so that readers never see a partial file
+        handle, temporary = tempfile.mkstemp(dir=self.root, suffix='.npz')
+        with os.fdopen(handle, 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(temporary, self._path(ticker))
+
+    def _mark_checked(self, ticker: str, checked: pd.Timestamp):
+        path = self._path(ticker)
+        if not os.path.exists(path):
+            return
+        with np.load(path) as columns:
+            arrays = {name: columns[name] for name in columns.files}
+        previous = arrays.get('Checked', arrays['Date'][-1])
+        arrays['Checked'] = np.maximum(np.datetime64(checked, 'ns'), previous)
+        self._write(ticker, arrays)
+
+    def last_date(self, ticker: str) -> pd.Timestamp:
+        dates, _, _ = self._load(ticker, ())
+        return pd.Timestamp(dates[-1]) if len(dates) else None
+
+    def append(self, prices: pd.DataFrame, tickers: [str] = None, since=None, checked=None):
+        """
+        Merge new prices into the store (dates already stored are overwritten by the new values).
+        @param prices: Dataframe with (field, ticker) columns as returned by yf.download, or the fields of a single
+        ticker (then give tickers=[ticker]).
+        @param since: date from which `prices` is the complete history, "max" when it is the whole history.
+        Default the first date of `prices`.
+        @param checked: date up to which `prices` is complete. Default its last date.
+        @return: tickers written to the store.
+        """
+        tickers = list(prices.columns.get_level_values(1).unique()) if tickers is None else list(tickers)
+        written = []
+        for name, frame in _split_fields(prices, tickers).items():
+            frame = frame.dropna(how='all')
+            if frame.empty:
+                continue
+            written.append(name)
+            newSince = np.datetime64('NaT', 'ns') if since == 'max' else \
+                np.datetime64(pd.Timestamp(frame.index[0] if since is None else since), 'ns')
+            dates, columns, storedSince = self._load(name, FIELDS)
+            if len(dates):
+                stored = pd.DataFrame(columns, index=pd.DatetimeIndex(dates))
+                stored = stored[~stored.index.isin(frame.index)]
+                frame = pd.concat([stored, frame]).sort_index()
+                if not np.isnat(newSince):
+                    newSince = storedSince if np.isnat(storedSince) else min(newSince, storedSince)
+            arrays = {field: frame[field].to_numpy(np.float64) for field in frame.columns if field in FIELDS}
+            arrays['Date'] = frame.index.values.astype('datetime64[ns]')
+            arrays['Since'] = np.array(newSince, dtype='datetime64[ns]')
+            lastChecked = arrays['Date'][-1] if checked is None else \
+                max(arrays['Date'][-1], np.datetime64(pd.Timestamp(checked), 'ns'))
+            if len(dates):
+                lastChecked = max(lastChecked, np.datetime64(self.checked(name), 'ns'))
+            arrays['Checked'] = np.array(lastChecked, dtype='datetime64[ns]')
+            self._write(name, arrays)
+        return written
+
+    def update(self, tickers: [str], start=None, end=None, staleness: int = 0):
+        """
+        Fetch the dates missing from the store: after the last date checked for each ticker, or from `start` for
+        new tickers and for tickers whose stored history starts later. Tickers needing the same start date are
+        fetched in one call. Tickers already checked up to the last complete session (see last_session) are not
+        fetched, so repeated calls on a weekend, a holiday or before the close do not hit the network.
+        @param staleness: number of business days a stored history may lag behind the last complete session
+        before it is refetched.
+        """
+        start = None if start is None else pd.Timestamp(start)
+        threshold = last_session(end) - pd.offsets.BDay(int(staleness))
+        groups = {}
+        for name in tickers:
+            dates, _, since = self._load(name, ())
+            complete = len(dates) and (np.isnat(since) or (start is not None and start >= pd.Timestamp(since)))
+            if complete and self.checked(name) >= threshold:
+                continue
+            first = pd.Timestamp(dates[-1]) + pd.Timedelta(days=1) if complete else start
+            groups.setdefault(first, []).append(name)
+        end = None if end is None else pd.Timestamp(end)
+        session = last_session(end)
+        for first, missing in groups.items():
+            prices = self.fetcher(missing, first, end)
+            fetched = []
+            if prices is not None and not prices.empty:
+                # a session still trading would be stored as complete: only closed sessions are kept
+                prices = prices.loc[:session]
+                fetched = self.append(prices, missing, since='max' if first is None else first, checked=session)
+            # tickers the fetcher had nothing new for are up to date until the last complete session
+            for name in set(missing) - set(fetched):
+                self._mark_checked(name, session)
+
+    def read(self, tickers: [str], field: str = 'Adj Close', start=None, end=None) -> pd.DataFrame:
+        """
+        Bulk read of one field for several tickers.
+        @return: Dataframe indexed by date with one column per ticker.
+        """
+        start = None if start is None else np.datetime64(pd.Timestamp(start), 'ns')
+        end = None if end is None else np.datetime64(pd.Timestamp(end), 'ns')
+        series = {}
+        for name in tickers:
+            dates, columns, _ = self._load(name, (field,))
+            lower = 0 if start is None else np.searchsorted(dates, start, side='left')
+            upper = len(dates) if end is None else np.searchsorted(dates, end, side='right')
+            values = columns.get(field, np.full(len(dates), np.nan))
+            series[name] = pd.Series(values[lower:upper], index=pd.DatetimeIndex(dates[lower:upper]))
+        return pd.DataFrame(series, columns=list(tickers))
+
+    def download(self, tickers: [str], start=None, end=None, period: str = None, fields=FIELDS,
+                 update: bool = True, staleness: int = 0) -> pd.DataFrame:
+        """
+        Drop-in replacement of yf.download backed by the store.
+        @param period: yfinance-like period ("1y", "6mo"...), used when start is not given.
+        @param update: fetch the missing dates first (see update). False only reads the local files.
+        @param staleness: see update.
+        @return: Dataframe with (field, ticker) columns.
+        """
+        tickers = list(tickers)
+        if start is None and period is not None:
+            start = period_start(period, end)
+        if update:
+            self.update(tickers, start, end, staleness)
+        frames = {field: self.read(tickers, field, start, end) for field in fields}
+        return pd.concat(frames, axis=1)
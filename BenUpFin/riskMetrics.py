@@ -1,177 +1,581 @@
 import pandas as pd
 import numpy as np
 from BenUpFin import preProcessing
+from BenUpFin import monteCarlo as mc
+from BenUpFin.monteCarlo import normal_risk_measures, student_risk_measures
+from BenUpFin import rollingRisk as rr
+from BenUpFin import garch
+from BenUpFin import covEstimators
+from BenUpFin.sharedReturns import ReturnsMatrix
 from scipy.stats import norm, t
-#from arch import arch_model
 import math
+from collections import deque
+from scipy.signal import lfilter
+
+
+def ewma_variance(sqrdReturns: np.ndarray, decayFactor: float = 0.94, window: int = None,
+                  initialVariance=None) -> np.ndarray:
+    """
+    EWMA variance of a series of squared returns in O(n), the estimate at date t including the return of date t.
+    With window=None the infinite RiskMetrics recursion var[t] = decay * var[t-1] + (1 - decay) * r[t]**2 is used
+    (seeded with initialVariance, by default the first squared return). Otherwise the weights decay**j, j < window, are normalised over the
+    window and the sliding sum is updated recursively: S[t] = I[t] - decay**window * I[t - window] where I is the
+    infinite exponential filter of the squared returns. Dates without a full window are NaN.
+    @param sqrdReturns: array of squared returns, oldest first. 2-D arrays are filtered column by column.
+    """
+    sqrdReturns = np.asarray(sqrdReturns, dtype=np.float64)
+    if window is None:
+        initial = decayFactor * (sqrdReturns[:1] if initialVariance is None else np.reshape(initialVariance, (1, -1)))
+        initial = initial.reshape(sqrdReturns[:1].shape)
+        variance, _ = lfilter([1 - decayFactor], [1, -decayFactor], sqrdReturns, axis=0, zi=initial)
+        return variance
+
+    infinite = lfilter([1], [1, -decayFactor], sqrdReturns, axis=0)
+    windowed = np.full_like(infinite, np.nan)
+    windowed[window - 1:window] = infinite[window - 1:window]
+    windowed[window:] = infinite[window:] - decayFactor ** window * infinite[:-window]
+    return windowed * (1 - decayFactor) / (1 - decayFactor ** window)
+
+
+class EWMARiskStream:
+
+    def __init__(self, mu: float = 0, confidenceLevel: float = 0.95, decayFactor: float = 0.94, window: int = None,
+                 variance: float = None):
+        """
+        Stateful EWMA volatility / VaR / ES of a single return series, updated in constant time per observation.
+        @param mu: mean return used in the VaR and ES.
+        @param window: same meaning as in ewma_variance. None for the infinite RiskMetrics recursion.
+        @param variance: initial variance for the infinite recursion. Defaults to the first squared return.
+        """
+        self.mu = mu
+        self.confidenceLevel = confidenceLevel
+        self.decayFactor = decayFactor
+        self.window = window
+        self.variance = variance
+        self._z = norm.ppf(confidenceLevel)
+        self._esFactor = norm.pdf(self._z) * (1 - confidenceLevel) ** -1
+        if window is not None:
+            self._sqrdReturns = deque(maxlen=window)
+            self._sum = 0.0
+            self._tailWeight = decayFactor ** window
+
+    @classmethod
+    def from_history(cls, returns: np.ndarray, **kwargs) -> "EWMARiskStream":
+        """
+        Build a stream whose state is the one reached after observing `returns` (oldest first).
+        """
+        stream = cls(**kwargs)
+        sqrdReturns = np.asarray(returns, dtype=np.float64) ** 2
+        if stream.window is None:
+            stream.variance = ewma_variance(sqrdReturns, stream.decayFactor)[-1]
+        else:
+            last = sqrdReturns[-stream.window:]
+            stream._sqrdReturns.extend(last)
+            stream._sum = float(np.sum(last * stream.decayFactor ** np.arange(len(last))[::-1]))
+            stream.variance = stream._normalised()
+        return stream
+
+    def _normalised(self) -> float:
+        n = len(self._sqrdReturns)
+        return self._sum * (1 - self.decayFactor) / (1 - self.decayFactor ** n)
+
+    def update(self, portfolioReturn: float) -> {}:
+        """
+        Absorb one new return.
+        @return: dictionary with the updated volatility, VaR and ES.
+        """
+        sqrdReturn = portfolioReturn ** 2
+        if self.window is None:
+            if self.variance is None:
+                self.variance = sqrdReturn
+            else:
+                self.variance = self.decayFactor * self.variance + (1 - self.decayFactor) * sqrdReturn
+        else:
+            self._sum = self.decayFactor * self._sum + sqrdReturn
+            if len(self._sqrdReturns) == self.window:
+                self._sum -= self._tailWeight * self._sqrdReturns[0]
+            self._sqrdReturns.append(sqrdReturn)
+            self.variance = self._normalised()
+
+        return self.risk_measures()
+
+    def risk_measures(self) -> {}:
+        volatility = math.sqrt(self.variance)
+        return {'volatility': volatility,
+                'VaR': self.mu + volatility * self._z,
+                'ES': self.mu + volatility * self._esFactor}
+
 
 class Metrics:
 
+    # cache entries depending on the weights, dropped when the weights change
+    _portfolioStatistics = ('portfolioReturns', 'portfolioMean', 'portfolioStd', 'sortedPortfolio')
+
     def __init__(self, data: pd.DataFrame(), tickers: [str], weights: [float]):
+        """
+        @param data: Dataframe with an "Adj Close" column, or a sharedReturns.ReturnsMatrix of daily returns.
+        """
         self.data = data
-        self.returns = preProcessing.get_daily_returns(data=data, tickers=tickers, method='percent')
+        self._cache = {}
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        if isinstance(data, ReturnsMatrix):
+            self.returns = data.to_frame(tickers)
+        else:
+            self.returns = preProcessing.get_daily_returns(data=data, tickers=tickers, method='percent')
         self.weights = weights
-        self.portfolioReturns= preProcessing.get_daily_returns(data=data, tickers=tickers, method='percent') @ weights
+
+    @classmethod
+    def from_store(cls, store, tickers: [str], weights: [float], start=None, end=None, period: str = None,
+                   update: bool = True):
+        """
+        Build the metrics from a priceStore.PriceStore instead of downloading the prices.
+        @param update: fetch the missing dates first. False only reads the local store (no network access).
+        """
+        return cls(store.download(tickers, start=start, end=end, period=period, fields=('Adj Close',), update=update),
+                   tickers, weights)
+
+    #region Statistics cache
+
+    @property
+    def returns(self) -> pd.DataFrame():
+        return self._returns
+
+    @returns.setter
+    def returns(self, returns: pd.DataFrame()):
+        self._returns = returns
+        self._cache.clear()
+
+    @property
+    def weights(self) -> [float]:
+        return self._weights
+
+    @weights.setter
+    def weights(self, weights: [float]):
+        # a read-only copy, so that the caller cannot change the weights behind the cached statistics
+        self._weights = np.array(weights, dtype=np.float64)
+        self._weights.flags.writeable = False
+        for key in self._portfolioStatistics:
+            self._cache.pop(key, None)
+
+    def _cached(self, key: str, compute):
+        """
+        Lazily computed statistic: `compute` is only called on the first request of `key`.
+        """
+        if key in self._cache:
+            self.cacheHits += 1
+        else:
+            self.cacheMisses += 1
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    def cache_info(self) -> {}:
+        """
+        @return: dictionary with the number of cache hits, misses and the statistics currently cached.
+        """
+        return dict(hits=self.cacheHits, misses=self.cacheMisses, cached=sorted(self._cache))
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    @property
+    def portfolioReturns(self) -> pd.Series():
+        return self._cached('portfolioReturns', lambda: self.returns @ self.weights)
+
+    @property
+    def mean(self) -> pd.Series():
+        """
+        Mean return of each ticker.
+        """
+        return self._cached('mean', lambda: self.returns.mean())
+
+    @property
+    def std(self) -> pd.Series():
+        """
+        Standard deviation (ddof=0, as np.std) of the returns of each ticker.
+        """
+        return self._cached('std', lambda: self.returns.std(ddof=0))
+
+    @property
+    def covariance(self) -> pd.DataFrame():
+        """
+        Covariance matrix (ddof=0) of the returns.
+        """
+        return self._cached('covariance', lambda: self.returns.cov(ddof=0))
+
+    def Covariance_Stream(self, estimator=None):
+        """
+        @param estimator: covEstimators estimator to prime (RollingCovariance, EWMACovariance, LedoitWolfCovariance...).
+        Default RollingCovariance(ddof=0), which gives the covariance property.
+        @return: the estimator fed with the returns history, to be updated one day at a time.
+        """
+        estimator = covEstimators.RollingCovariance(ddof=0) if estimator is None else estimator
+        return estimator.update(self.returns.values)
+
+    @property
+    def sortedReturns(self) -> np.ndarray:
+        """
+        Returns of each ticker sorted in ascending order (T x n array).
+        """
+        return self._cached('sortedReturns', lambda: np.sort(self.returns.values, axis=0))
+
+    @property
+    def portfolioMean(self) -> float:
+        return self._cached('portfolioMean', lambda: np.mean(self.portfolioReturns.values))
+
+    @property
+    def portfolioStd(self) -> float:
+        return self._cached('portfolioStd', lambda: np.std(self.portfolioReturns.values))
+
+    @property
+    def sortedPortfolio(self) -> np.ndarray:
+        return self._cached('sortedPortfolio', lambda: np.sort(self.portfolioReturns.values))
+
+    #endregion
 
     #region Historical method
 
+    def _historical(self, confidenceLevel, portfolio: bool = False):
+        sortedReturns = self.sortedPortfolio[:, None] if portfolio else self.sortedReturns
+        var, es = mc.tail_risk_measures(sortedReturns, len(sortedReturns), [confidenceLevel], inclusive=True)
+        return var[0], es[0]
+
     def historicalVaR(self, confidenceLevel: int = 95) -> {}:
-        var = {}
-        for name in self.returns.columns:
-            cut = -1*np.percentile(self.returns[name], 100 - confidenceLevel)
-            var[name] = np.round(cut, 3)
-        return var
+        var, _ = self._historical(confidenceLevel)
+        return {name: np.round(value, 3) for name, value in zip(self.returns.columns, var)}
 
     def historicalExpectedShortfall(self, confidenceLevel: int = 95) -> {}:
-        es = {}
-        for name in self.returns.columns:
-            cut = 1*np.percentile(self.returns[name], 100 - confidenceLevel)
-            es[name] = np.round(-1*self.returns[name][self.returns[name] <= cut].mean(), 3)
-        return es
+        _, es = self._historical(confidenceLevel)
+        return {name: np.round(value, 3) for name, value in zip(self.returns.columns, es)}
 
     def historicalPortfolioVaR(self, confidenceLevel: int = 95) -> float:
-        cut = -1 * np.percentile(self.portfolioReturns, 100 - confidenceLevel)
-        var = np.round(cut, 3)
-        return var
+        var, _ = self._historical(confidenceLevel, portfolio=True)
+        return np.round(var[0], 3)
 
     def historicalPortfolioES(self, confidenceLevel: int = 95) -> float:
-        cut = 1 * np.percentile(self.portfolioReturns, 100 - confidenceLevel)
-        es = np.round(-1 * self.portfolioReturns[self.portfolioReturns <= cut].mean(), 3)
-        return es
+        _, es = self._historical(confidenceLevel, portfolio=True)
+        return np.round(es[0], 3)
 
     #endregion
 
     #region Parametric method
 
     def parametricVar_Normal(self,  confidenceLevel: float = 0.95)->{}:
-        var = {}
-        for name in self.returns.columns:
-            mu = np.mean(self.returns[name])
-            std = np.std(self.returns[name])
-            var[name] = round(mu + std * norm.ppf(confidenceLevel), 3)
-        return var
+        var, _ = normal_risk_measures(self.mean, self.std, confidenceLevel)
+        return {name: round(value, 3) for name, value in var.items()}
 
     def parametricES_Normal(self, confidenceLevel: float = 0.95)->{}:
-        es = {}
-        for name in self.returns.columns:
-            mu = np.mean(self.returns[name])
-            std = np.std(self.returns[name])
-            es[name] = round(mu + std * norm.pdf(norm.ppf(confidenceLevel)) * (1-confidenceLevel)**-1, 3)
-
-        return es
+        _, es = normal_risk_measures(self.mean, self.std, confidenceLevel)
+        return {name: round(value, 3) for name, value in es.items()}
 
     def parametric_Normal_Portfolio(self, confidenceLevel: float = 0.95)->{}:
         riskMeasures = {}
 
-        mu = np.mean(self.portfolioReturns.values)
-        std = np.std(self.portfolioReturns.values)
-        riskMeasures['Portfolio VaR'] = round(mu + std * norm.ppf(confidenceLevel), 3)
-        riskMeasures['Portfolio ES'] = round(mu + std * norm.pdf(norm.ppf(confidenceLevel)) * (1-confidenceLevel)**-1, 3)
+        var, es = normal_risk_measures(self.portfolioMean, self.portfolioStd, confidenceLevel)
+        riskMeasures['Portfolio VaR'] = round(var, 3)
+        riskMeasures['Portfolio ES'] = round(es, 3)
 
         return riskMeasures
 
     def parametricVar_student(self,dof: int,  confidenceLevel: float = 0.95)->{}:
-        var_t = {}
-        for name in self.returns.columns:
-            mu = np.mean(self.returns[name])
-            std = np.std(self.returns[name])
-            var_t[name] = round(mu + std * t.ppf(confidenceLevel, dof)*np.sqrt((dof-2)/dof), 3)
-        return var_t
+        var_t, _ = student_risk_measures(self.mean, self.std, dof, confidenceLevel)
+        return {name: round(value, 3) for name, value in var_t.items()}
 
     def parametricES_student(self, dof: int, confidenceLevel: float = 0.95)->{}:
-        es_t = {}
-        for name in self.returns.columns:
-            mu = np.mean(self.returns[name])
-            std = np.std(self.returns[name])
-            xanu = t.ppf(1-confidenceLevel, dof)
-            es_t[name] = round((-1 /(1-confidenceLevel)) * (1 - dof) ** (-1) * (dof - 2 + xanu ** 2) * t.pdf(xanu, dof) * std -mu, 3)
-        return es_t
-
-    def parametric_Student_Portfolio(self,dof: int, co) -> {}:
+        _, es_t = student_risk_measures(self.mean, self.std, dof, confidenceLevel)
+        return {name: round(value, 3) for name, value in es_t.items()}
+
+    def parametric_Student_Portfolio(self, dof: int, confidenceLevel: float = 0.95) -> {}:
         riskMeasures = {}
 
-        mu = np.mean(self.portfolioReturns[name])
-        std = np.std(self.portfolioReturns[name])
-        riskMeasures['Portfolio VaR'] = round(mu + std * t.ppf(confidenceLevel, dof)*np.sqrt((dof-2)/dof), 3)
-        riskMeasures['Portfolio ES'] = round((-1 / (1 - confidenceLevel)) * (1 - dof) ** (-1) * (dof - 2 + xanu ** 2) * t.pdf(xanu, dof) * std - mu, 3)
+        var, es = student_risk_measures(self.portfolioMean, self.portfolioStd, dof, confidenceLevel)
+        riskMeasures['Portfolio VaR'] = round(var, 3)
+        riskMeasures['Portfolio ES'] = round(es, 3)
 
         return riskMeasures
 
     def Parametric_Normal_RiskMeasures_Portfolio(self, confidenceLevel: float=0.95, window: int = 100) -> pd.DataFrame():
 
-        var = pd.Series(index=Returns.index, name='VaR')
-        es = pd.Series(index=Returns.index, name='ES')
-        for i in range(0, len(Returns) - window):
-            if i == 0:
-                Data = Returns[-window:]
+        return self.Rolling_RiskMeasures_Portfolio(method='normal', confidenceLevel=confidenceLevel,
+                                                   window=window).round(3)
+
+    def Rolling_RiskMeasures_Portfolio(self, method: str = 'historical', confidenceLevel: float = 0.95,
+                                       window: int = 250, dof: int = 5) -> pd.DataFrame():
+        """
+        Rolling-window VaR and ES of the portfolio (see rollingRisk.rolling_risk_measures).
+        @param method: "historical", "normal" or "student".
+        @return: Dataframe with the VaR and ES columns, indexed by the last date of each window.
+        """
+        return rr.rolling_risk_measures(self.portfolioReturns, window=window, method=method,
+                                        confidenceLevel=confidenceLevel, dof=dof)
+
+    #endregion
+
+    #region Risk report
+
+    def risk_report(self, confidenceLevels: [float] = (0.90, 0.95, 0.975, 0.99),
+                    methods: [str] = ('historical', 'normal', 'student'), dof: int = 5) -> pd.DataFrame():
+        """
+        VaR and ES of every ticker and of the portfolio for several methods and confidence levels in one pass:
+        each column is sorted once and its moments computed once, whatever the number of levels.
+        The figures follow the conventions of the historical*, parametric*_Normal and parametric*_student methods
+        (not rounded).
+        @param confidenceLevels: list of confidence levels (95 or 0.95 are both accepted).
+        @param methods: subset of "historical", "normal" and "student".
+        @param dof: degrees of freedom of the student distribution.
+        @return: Dataframe indexed by (ticker, method, confidenceLevel) with the VaR and ES columns.
+        """
+        names = list(self.returns.columns) + ['Portfolio']
+        levels = [mc.as_probability(c) for c in confidenceLevels]
+        mu = np.append(self.mean.values, self.portfolioMean)
+        std = np.append(self.std.values, self.portfolioStd)
+
+        blocks = []
+        for method in methods:
+            if method == 'historical':
+                sortedReturns = np.column_stack([self.sortedReturns, self.sortedPortfolio])
+                var, es = mc.tail_risk_measures(sortedReturns, len(sortedReturns), levels, inclusive=True)
+            elif method == 'normal':
+                var, es = map(np.array, zip(*[normal_risk_measures(mu, std, c) for c in levels]))
+            elif method == 'student':
+                var, es = map(np.array, zip(*[student_risk_measures(mu, std, dof, c) for c in levels]))
             else:
-                Data = Returns[-(window + i):-i]
-            mu = np.mean(Data)
-            stdev = np.std(Data)
-            var[-i - 1] = round(mu + stdev * norm.ppf(Confidence_Interval),3)
-            es[-i-1] = round(mu + std * norm.pdf(norm.ppf(confidenceLevel)) * (1 - confidenceLevel) ** -1, 3)
+                raise Exception(f"Unknown method {method}. Use 'historical', 'normal' or 'student'.")
+            index = pd.MultiIndex.from_product([[method], levels, names],
+                                               names=['method', 'confidenceLevel', 'ticker'])
+            blocks.append(pd.DataFrame({'VaR': var.ravel(), 'ES': es.ravel()}, index=index))
+
+        report = pd.concat(blocks).reorder_levels(['ticker', 'method', 'confidenceLevel'])
+
+        return report.reindex(pd.MultiIndex.from_product([names, list(methods), levels],
+                                                         names=['ticker', 'method', 'confidenceLevel']))
+
+    #endregion
+
+    #region Risk decomposition
+
+    def risk_decomposition(self, method: str = 'normal', confidenceLevel: float = 0.95,
+                           blockSize: int = 500) -> pd.DataFrame():
+        """
+        Marginal (dVaR/dw), component (w * marginal, summing to the portfolio figure) and incremental (change of the
+        portfolio figure when the position is removed) VaR and ES of every ticker.
+        - "normal": analytical, from the cached covariance with a single matrix-vector product (Euler allocation
+          of parametric_Normal_Portfolio).
+        - "historical": from the tail scenarios of historicalPortfolioVaR/ES, i.e. the returns of each ticker on
+          the dates defining the portfolio quantile (VaR) or in the portfolio tail (ES). Incremental figures
+          recompute the portfolio quantile without each position, block by block.
+        @param method: "normal" or "historical".
+        @param confidenceLevel: 95 or 0.95 are both accepted.
+        @param blockSize: number of tickers removed at once for the historical incremental figures.
+        @return: Dataframe indexed by ticker.
+        """
+        confidenceLevel = mc.as_probability(confidenceLevel)
+        weights = np.asarray(self.weights, dtype=np.float64)
+
+        if method == 'normal':
+            mean = self.mean.values
+            covariance = self.covariance.values
+            sigmaW = covariance @ weights
+            std = self.portfolioStd
+            z = norm.ppf(confidenceLevel)
+            factors = {'VaR': z, 'ES': norm.pdf(z) * (1 - confidenceLevel) ** -1}
+            # portfolio variance once each position is removed
+            stdWithout = np.sqrt(np.clip(std ** 2 - 2 * weights * sigmaW + weights ** 2 * np.diag(covariance), 0, None))
+            df = pd.DataFrame(index=self.returns.columns)
+            for measure, factor in factors.items():
+                marginal = mean + factor * sigmaW / std
+                df[f'marginal {measure}'] = marginal
+                df[f'component {measure}'] = weights * marginal
+                df[f'incremental {measure}'] = factor * (std - stdWithout) + weights * mean
+            return df
+
+        if method != 'historical':
+            raise Exception(f"Unknown method {method}. Use 'normal' or 'historical'.")
+
+        returns = self.returns.values
+        portfolio = self.portfolioReturns.values
+        order = np.argsort(portfolio, kind='stable')
+        position = (1 - confidenceLevel) * (len(portfolio) - 1)
+        lower = int(np.floor(position))
+        upper = min(lower + 1, len(portfolio) - 1)
+        fraction = position - lower
+        cut = portfolio[order[lower]] + fraction * (portfolio[order[upper]] - portfolio[order[lower]])
+        tail = portfolio <= cut
+
+        df = pd.DataFrame(index=self.returns.columns)
+        df['marginal VaR'] = -((1 - fraction) * returns[order[lower]] + fraction * returns[order[upper]])
+        df['component VaR'] = weights * df['marginal VaR'].values
+        var = -cut
+        es = -portfolio[tail].mean()
+        incrementalVaR = np.empty(len(weights))
+        incrementalES = np.empty(len(weights))
+        for start in range(0, len(weights), blockSize):
+            block = slice(start, start + blockSize)
+            without = portfolio[:, None] - returns[:, block] * weights[block]
+            without.sort(axis=0)
+            varWithout, esWithout = mc.tail_risk_measures(without, len(without), [confidenceLevel], inclusive=True)
+            incrementalVaR[block] = var - varWithout[0]
+            incrementalES[block] = es - esWithout[0]
+        df['incremental VaR'] = incrementalVaR
+        df['marginal ES'] = -returns[tail].mean(axis=0)
+        df['component ES'] = weights * df['marginal ES'].values
+        df['incremental ES'] = incrementalES
 
         return df
 
     #endregion
 
+    #region What-if analysis
+
+    def whatif_RiskMeasures(self, weights: np.ndarray, confidenceLevel: float = 0.95, decayFactor: float = 0.94,
+                            window: int = 100, blockSize: int = 1000) -> {}:
+        """
+        Risk of K candidate allocations without building K Metrics objects: the K portfolio return series are
+        obtained with one matrix product against the cached returns (block by block for large K).
+        Conventions follow historicalPortfolioVaR/ES, parametric_Normal_Portfolio and EWMA_RiskMeasures_Portfolio
+        (latest date).
+        @param weights: (K x n) matrix, one candidate weight vector per row (columns ordered as self.returns).
+        @param confidenceLevel: 95 or 0.95 are both accepted.
+        @param blockSize: number of candidates processed at once.
+        @return: dictionary of (K,) arrays: historical, normal and EWMA VaR and ES of every candidate.
+        """
+        weights = np.atleast_2d(np.asarray(weights, dtype=np.float64))
+        confidenceLevel = mc.as_probability(confidenceLevel)
+        returns = self.returns.values
+        keys = ['historical VaR', 'historical ES', 'normal VaR', 'normal ES', 'EWMA VaR', 'EWMA ES']
+        results = {key: np.empty(len(weights)) for key in keys}
+
+        covariance = self.covariance.values
+        mean = self.mean.values
+        if window is not None:
+            # only the last window of returns is needed for the latest EWMA volatility
+            decay = decayFactor ** np.arange(window)[::-1]
+            decay /= decay.sum()
+
+        for start in range(0, len(weights), blockSize):
+            block = slice(start, start + blockSize)
+            candidates = weights[block]
+            # the parametric measures only need the cached moments: w'Cw of the whole block with one matrix product
+            mu = candidates @ mean
+            std = np.sqrt(np.sum((candidates @ covariance) * candidates, axis=1))
+            results['normal VaR'][block], results['normal ES'][block] = normal_risk_measures(mu, std, confidenceLevel)
+
+            portfolios = returns @ candidates.T
+            if window is None:
+                variance = ewma_variance(portfolios ** 2, decayFactor)[-1]
+            elif len(portfolios) < window:
+                # as in EWMA_RiskMeasures_Portfolio, there is no EWMA volatility before a full window
+                variance = np.full(len(candidates), np.nan)
+            else:
+                variance = decay @ portfolios[-window:] ** 2
+            results['EWMA VaR'][block], results['EWMA ES'][block] = \
+                normal_risk_measures(mu, np.sqrt(variance), confidenceLevel)
+
+            portfolios.sort(axis=0)
+            var, es = mc.tail_risk_measures(portfolios, len(portfolios), [confidenceLevel], inclusive=True)
+            results['historical VaR'][block], results['historical ES'][block] = var[0], es[0]
+
+        return results
+
+    #endregion
+
     #region Monte-Carlo simulation Method
 
-    def MonteCarlo_Portfolio_VaR(self, nb_simulation = 1000)->float:
-        mu = np.mean(self.portfolioReturns)
-        std = np.std(self.portfolioReturns)
-        T = len(self.portfolioReturns.index)
-        sim_returns = []
-        for i in range(nb_simulation):
-            rand_rets = np.random.normal(mu, std, T)
-            sim_returns.append(rand_rets)
-        var = round(-np.percentile(sim_returns, 5), 4)
-
-        return var
-
-    def MonteCarlo_Portfolio_ES(self, nb_simulation = 1000, confidenceLevel: int = 95)->float:
-        mu = np.mean(self.portfolioReturns)
-        std = np.std(self.portfolioReturns)
-        T = len(self.portfolioReturns.index)
-        sim_returns = []
-        for i in range(nb_simulation):
-            rand_rets = np.random.normal(mu, std, T)
-            sim_returns.append(rand_rets)
-        var = np.percentile(sim_returns, 100-confidenceLevel)
-        sorted_returns = np.sort(np.array(sim_returns).reshape(-1))
-        es = round(-1*sorted_returns[sorted_returns<var].mean(), 4)
-
-        return es
-
-    def MonteCarlo_VaR(self, nb_simulation = 1000, confidenceLevel:int = 95)-> {}:
-        var = {}
-        for name in self.returns.columns:
-            mu = np.mean(self.returns[name])
-            std = np.std(self.returns[name])
-            T = len(self.returns.index)
-            sim_returns = []
-            for i in range(nb_simulation):
-                rand_rets = np.random.normal(mu, std, T)
-                sim_returns.append(rand_rets)
-            var[name] = round(-np.percentile(sim_returns, 100-confidenceLevel), 4)
-
-        return var
-
-    def MonteCarlo_ES(self, nb_simulation = 1000, confidenceLevel:int = 95)-> {}:
-        es = {}
-        for name in self.returns.columns:
-            mu = np.mean(self.returns[name])
-            std = np.std(self.returns[name])
-            T = len(self.returns.index)
-            sim_returns = []
-            for i in range(nb_simulation):
-                rand_rets = np.random.normal(mu, std, T)
-                sim_returns.append(rand_rets)
-            var = np.percentile(sim_returns, 100 - confidenceLevel)
-            sorted_returns = np.sort(np.array(sim_returns).reshape(-1))
-            es[name] = round(-1 * sorted_returns[sorted_returns < var].mean(), 4)
-
-        return es
+    def MonteCarlo_RiskMeasures(self, nb_simulation: int = 1000, confidenceLevels: [float] = (95,),
+                                chunkSize: int = 10000, seed=None) -> pd.DataFrame():
+        """
+        Gaussian Monte-Carlo VaR and ES of every ticker and of the portfolio at several confidence levels,
+        all computed from a single draw (see monteCarlo.MonteCarloEngine).
+        @param nb_simulation: number of simulated one-period returns per series.
+        @param confidenceLevels: list of confidence levels (95 or 0.95 are both accepted).
+        @param chunkSize: maximum number of scenarios held in memory at once.
+        @param seed: int or np.random.Generator, to make the simulation reproducible.
+        @return: Dataframe indexed by ticker (plus a 'Portfolio' row) with (measure, confidence level) columns.
+        """
+        mu = np.append(self.mean.values, self.portfolioMean)
+        std = np.append(self.std.values, self.portfolioStd)
+        engine = mc.MonteCarloEngine(mu, std, nb_simulation=nb_simulation, chunkSize=chunkSize, seed=seed)
+        var, es = engine.risk_measures(confidenceLevels)
+
+        return mc.risk_measures_frame(var, es, list(self.returns.columns) + ['Portfolio'], confidenceLevels)
+
+    def MonteCarlo_Multivariate_RiskMeasures(self, nb_simulation: int = 10000, confidenceLevels: [float] = (95,),
+                                             blockSize: int = 50000, n_workers: int = 1, seed=None) -> pd.DataFrame():
+        """
+        Correlated Monte-Carlo: the returns covariance is factored once (Cholesky) and asset scenarios are drawn
+        jointly, so the portfolio VaR/ES reflects the cross-asset covariance. Large runs can be split across a
+        process pool (see monteCarlo.MultivariateMonteCarloEngine); results only depend on the seed, not on the
+        number of workers.
+        @param nb_simulation: number of simulated one-period scenarios.
+        @param confidenceLevels: list of confidence levels (95 or 0.95 are both accepted).
+        @param blockSize: number of scenarios simulated per task.
+        @param n_workers: number of processes to use.
+        @param seed: int, to make the simulation reproducible.
+        @return: Dataframe indexed by ticker (plus a 'Portfolio' row) with (measure, confidence level) columns.
+        """
+        engine = mc.MultivariateMonteCarloEngine(self.mean.values, self.covariance.values,
+                                                 self.weights, nb_simulation=nb_simulation, blockSize=blockSize,
+                                                 seed=seed, n_workers=n_workers)
+        var, es = engine.risk_measures(confidenceLevels)
+
+        return mc.risk_measures_frame(var, es, list(self.returns.columns) + ['Portfolio'], confidenceLevels)
+
+    def Bootstrap_RiskMeasures(self, nb_simulation: int = 10000, confidenceLevels: [float] = (95,),
+                               mode: str = 'bootstrap', horizon: int = 1, blockSize: int = 5,
+                               decayFactor: float = 0.94, chunkSize: int = 10000, seed=None) -> pd.DataFrame():
+        """
+        Resampled historical VaR and ES of every ticker and of the portfolio (see monteCarlo.BootstrapEngine).
+        @param mode: "bootstrap" (i.i.d. dates), "block" (block bootstrap of consecutive dates) or "filtered"
+        (filtered historical simulation: returns standardized by their EWMA volatility forecast, resampled and
+        rescaled by today's forecast).
+        @param horizon: number of daily returns summed in each scenario.
+        @param blockSize: length of the blocks in "block" mode.
+        @param decayFactor: decay of the EWMA volatility used in "filtered" mode.
+        @param chunkSize: maximum number of scenarios held in memory at once.
+        @param seed: int or np.random.Generator, to make the resampling reproducible.
+        @return: Dataframe indexed by ticker (plus a 'Portfolio' row) with (measure, confidence level) columns.
+        """
+        returns = self.returns.values
+        scale = None
+        if mode == 'filtered':
+            variance = ewma_variance(returns ** 2, decayFactor, initialVariance=np.mean(returns ** 2, axis=0))
+            # residual of date t standardized by the forecast made at t-1, forecast for the next date
+            returns = returns[1:] / np.sqrt(variance[:-1])
+            scale = np.sqrt(variance[-1])
+            mode = 'bootstrap'
+        engine = mc.BootstrapEngine(returns, self.weights, nb_simulation=nb_simulation, mode=mode, horizon=horizon,
+                                    blockSize=blockSize, scale=scale, chunkSize=chunkSize, seed=seed)
+        var, es = engine.risk_measures(confidenceLevels)
+
+        return mc.risk_measures_frame(var, es, list(self.returns.columns) + ['Portfolio'], confidenceLevels)
+
+    def _MonteCarlo_Measure(self, measure: str, nb_simulation: int, confidenceLevel, portfolio: bool,
+                            chunkSize: int, seed):
+        if portfolio:
+            mu, std, names = [self.portfolioMean], [self.portfolioStd], ['Portfolio']
+        else:
+            mu, std, names = self.mean.values, self.std.values, self.returns.columns
+        engine = mc.MonteCarloEngine(mu, std, nb_simulation=nb_simulation, chunkSize=chunkSize, seed=seed)
+        var, es = engine.risk_measures([confidenceLevel])
+        values = var[0] if measure == 'VaR' else es[0]
+
+        return {name: round(value, 4) for name, value in zip(names, values)}
+
+    def MonteCarlo_Portfolio_VaR(self, nb_simulation=1000, confidenceLevel: int = 95, chunkSize: int = 10000,
+                                 seed=None)->float:
+        return self._MonteCarlo_Measure('VaR', nb_simulation, confidenceLevel, True, chunkSize, seed)['Portfolio']
+
+    def MonteCarlo_Portfolio_ES(self, nb_simulation = 1000, confidenceLevel: int = 95, chunkSize: int = 10000,
+                                seed=None)->float:
+        return self._MonteCarlo_Measure('ES', nb_simulation, confidenceLevel, True, chunkSize, seed)['Portfolio']
+
+    def MonteCarlo_VaR(self, nb_simulation = 1000, confidenceLevel:int = 95, chunkSize: int = 10000,
+                       seed=None)-> {}:
+        return self._MonteCarlo_Measure('VaR', nb_simulation, confidenceLevel, False, chunkSize, seed)
+
+    def MonteCarlo_ES(self, nb_simulation = 1000, confidenceLevel:int = 95, chunkSize: int = 10000,
+                      seed=None)-> {}:
+        return self._MonteCarlo_Measure('ES', nb_simulation, confidenceLevel, False, chunkSize, seed)
 
     #endregion
 
@@ -179,60 +583,66 @@ class Metrics:
 
     def GARCH_Normal_RiskMeasures_Portfolio(self, confidenceLevel:int = 0.95)->pd.DataFrame():
 
+        return self._GARCH_RiskMeasures_Portfolio('normal', confidenceLevel)
+
+    def GARCH_Student_RiskMeasures_Portfolio(self, confidenceLevel: float = 0.95) -> pd.DataFrame():
+
+        return self._GARCH_RiskMeasures_Portfolio('t', confidenceLevel)
+
+    def _GARCH_RiskMeasures_Portfolio(self, dist: str, confidenceLevel: float) -> pd.DataFrame():
+        """
+        Fit a GARCH(1,1) on the portfolio returns and compute VaR and ES from the one step ahead forecast of each date.
+        The fitted model is kept in self.garchModel so that it can be updated with new returns (warm start).
+        """
         df = pd.DataFrame(index=self.portfolioReturns.index)
-        print(df.head())
         # Specify and fit a GARCH model
-        model = arch_model(self.portfolioReturns, p = 1, q = 1,mean = 'constant', vol = 'GARCH', dist = 't', rescale=False)
-        model_fit = model.fit(disp='off',)
+        model = garch.GARCH(dist=dist).fit(self.portfolioReturns.rename('Portfolio'))
+        self.garchModel = model
 
         # Make mean & variance forecast
-        forecast = model_fit.forecast(start=self.portfolioReturns.index.values[0])
-        mu = forecast.mean[self.portfolioReturns.index.values[0]:]
+        mu = model.params.loc['Portfolio', 'mu']
+        std = model.forecast()['Portfolio'].values
         df['mean'] = mu
-        std = np.sqrt(forecast.variance[self.portfolioReturns.index.values[0]:])
         df['Volatility'] = std
-        df['VaR'] = mu.values + std.values * norm.ppf(confidenceLevel)
-        df['ES'] = mu.values + std.values * norm.pdf(norm.ppf(confidenceLevel)) * (1 - confidenceLevel) ** -1
+        if dist == 'normal':
+            df['VaR'], df['ES'] = normal_risk_measures(mu, std, confidenceLevel)
+        else:
+            df['VaR'], df['ES'] = student_risk_measures(mu, std, model.params.loc['Portfolio', 'nu'], confidenceLevel)
 
         return df
 
-    def EWMA_RiskMeasures_Portfolio(self, confidenceLevel: float =0.95, decayFactor: float = 0.94, window: int =100)->pd.DataFrame():
-
-        mu = np.mean(self.portfolioReturns)
-        var = pd.Series(index=self.portfolioReturns.index, name='VaR')
-        es = pd.Series(index=self.portfolioReturns.index, name='ES')
-        std = pd.Series(index=self.portfolioReturns.index, name='volatility')
-
-        ## Defining exponentially smoothed weights components
-        decay = np.empty([window, ])
-        Weights = np.empty([window, ])
-        decay[0] = 1.0
-        decay[1] = decayFactor
-        Range = range(window)
-
-        # Building weights
-        for i in range(2, window):
-            decay[i] = decay[1] ** Range[i]
-        for i in range(window):
-            Weights[i] = decay[i] / sum(decay)
-
-        # squared the returns
-        sqrdReturns = self.portfolioReturns ** 2
-
-        ## finding standard deviation on the sliding window before computing risk measures (VaR en Expected Shortfall)
-        for i in range(0, len(self.portfolioReturns) - window):
-            if i == 0:
-                sqrdData = sqrdReturns[-(window):]
-            else:
-                sqrdData = sqrdReturns[-(window + i):-i]
-
-            EWMAstdev = math.sqrt(sum(Weights * sqrdData))
-            std[-i-1] = EWMAstdev
-            var[-i - 1] = mu + EWMAstdev * norm.ppf(confidenceLevel)
-            es[-i-1] = mu + EWMAstdev * norm.pdf(norm.ppf(confidenceLevel)) * (1 - confidenceLevel) ** -1
+    def GARCH_Tickers(self, dist: str = 'normal', x0: pd.DataFrame() = None) -> garch.GARCH:
+        """
+        Fit a GARCH(1,1) on every ticker in a single batched call.
+        @param dist: "normal" or "t".
+        @param x0: optional starting parameters (e.g. the params of a previous fit) to warm-start the optimisation.
+        @return: the fitted garch.GARCH model (params, forecast, conditional_volatility).
+        """
+        return garch.GARCH(dist=dist).fit(self.returns, x0=x0)
 
-        df = pd.concat([std, var, es], axis=1)
+    def EWMA_RiskMeasures_Portfolio(self, confidenceLevel: float =0.95, decayFactor: float = 0.94, window: int =100)->pd.DataFrame():
+        """
+        RiskMetrics EWMA volatility of the portfolio and the associated (normal) VaR and ES, computed in O(n).
+        @param window: number of squared returns in the truncated EWMA (weights decayFactor**j normalised over the
+        window, most recent return first). None uses the infinite RiskMetrics recursion.
+        @return: Dataframe with the volatility, VaR and ES columns, indexed by date.
+        """
+        mu = self.portfolioMean
+        variance = ewma_variance(self.portfolioReturns.values ** 2, decayFactor, window)
+        std = np.sqrt(variance)
+        z = norm.ppf(confidenceLevel)
+        df = pd.DataFrame({'volatility': std,
+                           'VaR': mu + std * z,
+                           'ES': mu + std * norm.pdf(z) * (1 - confidenceLevel) ** -1},
+                          index=self.portfolioReturns.index)
 
         return df.dropna()
 
+    def EWMA_Stream(self, confidenceLevel: float = 0.95, decayFactor: float = 0.94, window: int = 100):
+        """
+        @return: an EWMARiskStream primed with the portfolio history, to be updated one return at a time.
+        """
+        return EWMARiskStream.from_history(self.portfolioReturns.values, mu=self.portfolioMean,
+                                           confidenceLevel=confidenceLevel, decayFactor=decayFactor, window=window)
+
     #endregion
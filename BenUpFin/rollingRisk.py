@@ -0,0 +1,171 @@
+import numpy as np
+import pandas as pd
+from BenUpFin.monteCarlo import as_probability, normal_risk_measures, student_risk_measures
+
+
+class RollingOrderStatistics:
+
+    def __init__(self, values: np.ndarray):
+        """
+        Order statistics of a sliding window over several series at once. Every observation is ranked once
+        against its whole column; the window content is then a set of ranks held in Fenwick (binary indexed)
+        trees of counts and of values, so inserting, removing, selecting the k-th smallest value and summing the
+        values below a rank are O(log T) per step, vectorized over the columns.
+        @param values: (T x P) array, one series per column, oldest first.
+        """
+        self.values = np.asarray(values, dtype=np.float64)
+        self.length, self.nb_columns = self.values.shape
+        order = np.argsort(self.values, axis=0, kind='stable')
+        self.sortedValues = np.take_along_axis(self.values, order, axis=0)
+        self.ranks = np.empty_like(order)
+        np.put_along_axis(self.ranks, order, np.arange(1, self.length + 1)[:, None], axis=0)
+        # highest rank sharing the value of each rank, so that ties are counted exactly
+        isLast = np.vstack([self.sortedValues[1:] != self.sortedValues[:-1], np.ones((1, self.nb_columns), bool)])
+        lastRank = np.where(isLast, np.arange(1, self.length + 1)[:, None], self.length + 1)
+        self.lastEqual = np.minimum.accumulate(lastRank[::-1], axis=0)[::-1]
+
+        # tree indices 1..size (a power of two) plus a sink at size + 1 absorbing updates past the root
+        self._depth = max(1, int(self.length - 1).bit_length()) + 1
+        self._size = 1 << (self._depth - 1)
+        self._offsets = np.arange(self.nb_columns) * (self._size + 2)
+        self._counts = np.zeros(self.nb_columns * (self._size + 2), dtype=np.int64)
+        self._sums = np.zeros(self.nb_columns * (self._size + 2))
+
+    def _update(self, row: int, sign: int):
+        position = self.ranks[row].copy()
+        value = sign * self.values[row]
+        for _ in range(self._depth):
+            index = self._offsets + position
+            self._counts[index] += sign
+            self._sums[index] += value
+            position += position & -position
+            np.minimum(position, self._size + 1, out=position)
+
+    def add(self, row: int):
+        self._update(row, 1)
+
+    def remove(self, row: int):
+        self._update(row, -1)
+
+    def kth(self, k: np.ndarray) -> np.ndarray:
+        """
+        @param k: 1-based order of the statistic to select, for each column.
+        @return: rank (1-based, in the whole column) of the k-th smallest value currently in the window.
+        """
+        k = np.array(k, dtype=np.int64)
+        position = np.zeros(self.nb_columns, dtype=np.int64)
+        step = self._size
+        while step:
+            counts = self._counts[self._offsets + position + step]
+            move = counts < k
+            position += step * move
+            k -= counts * move
+            step >>= 1
+        return position + 1
+
+    def prefix(self, rank: np.ndarray) -> (np.ndarray, np.ndarray):
+        """
+        @return: number and sum of the values of the window whose rank is lower or equal to `rank`.
+        """
+        position = np.array(rank, dtype=np.int64)
+        count = np.zeros(self.nb_columns, dtype=np.int64)
+        total = np.zeros(self.nb_columns)
+        for _ in range(self._depth):
+            index = self._offsets + position
+            count += self._counts[index]
+            total += self._sums[index]
+            position -= position & -position
+        return count, total
+
+    def value(self, rank: np.ndarray) -> np.ndarray:
+        return self.sortedValues[np.asarray(rank) - 1, np.arange(self.nb_columns)]
+
+
+def rolling_moments(values: np.ndarray, window: int) -> (np.ndarray, np.ndarray):
+    """
+    Rolling mean and (population) standard deviation from cumulative sums, in O(T) for every column.
+    Dates without a full window are NaN.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    center = values.mean(axis=0)
+    centered = values - center
+    cumSum = np.vstack([np.zeros((1,) + values.shape[1:]), np.cumsum(centered, axis=0)])
+    cumSqr = np.vstack([np.zeros((1,) + values.shape[1:]), np.cumsum(centered ** 2, axis=0)])
+    mean = np.full(values.shape, np.nan)
+    std = np.full(values.shape, np.nan)
+    windowMean = (cumSum[window:] - cumSum[:-window]) / window
+    windowSqr = (cumSqr[window:] - cumSqr[:-window]) / window
+    mean[window - 1:] = windowMean + center
+    std[window - 1:] = np.sqrt(np.clip(windowSqr - windowMean ** 2, 0, None))
+    return mean, std
+
+
+def rolling_historical(values: np.ndarray, window: int, confidenceLevel=95) -> (np.ndarray, np.ndarray):
+    """
+    Rolling historical VaR (np.percentile with linear interpolation, as a positive loss) and ES (mean of the
+    returns lower or equal to the cut) of every column. Dates without a full window are NaN.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    length, nb_columns = values.shape
+    var = np.full(values.shape, np.nan)
+    es = np.full(values.shape, np.nan)
+    if length < window:
+        return var, es
+
+    position = (1 - as_probability(confidenceLevel)) * (window - 1)
+    lower = int(np.floor(position))
+    fraction = position - lower
+    statistics = RollingOrderStatistics(values)
+    for row in range(window - 1):
+        statistics.add(row)
+    lowerOrder = np.full(nb_columns, lower + 1)
+    upperOrder = np.full(nb_columns, min(lower + 2, window))
+    for row in range(window - 1, length):
+        statistics.add(row)
+        if row >= window:
+            statistics.remove(row - window)
+        lowerRank = statistics.kth(lowerOrder)
+        upperRank = statistics.kth(upperOrder)
+        lowerValue = statistics.value(lowerRank)
+        upperValue = statistics.value(upperRank)
+        cut = lowerValue + fraction * (upperValue - lowerValue)
+        lastRank = np.where(upperValue <= cut, upperRank, lowerRank)
+        count, total = statistics.prefix(statistics.lastEqual[lastRank - 1, np.arange(nb_columns)])
+        var[row] = -cut
+        es[row] = -total / count
+    return var, es
+
+
+def rolling_risk_measures(returns, window: int = 250, method: str = 'historical', confidenceLevel=0.95,
+                          dof: int = 5) -> pd.DataFrame:
+    """
+    Date-indexed rolling VaR and ES of one or several return series.
+    @param returns: Series or Dataframe of returns (one column per portfolio).
+    @param window: number of observations in each window.
+    @param method: "historical", "normal" or "student".
+    @param confidenceLevel: 95 or 0.95 are both accepted.
+    @param dof: degrees of freedom of the student distribution.
+    @return: Dataframe with VaR and ES columns (one (column, measure) pair per series for a Dataframe input),
+    indexed by the last date of each window. Dates without a full window are dropped.
+    """
+    frame = returns.to_frame() if isinstance(returns, pd.Series) else returns
+    values = frame.values.astype(np.float64)
+    confidenceLevel = as_probability(confidenceLevel)
+
+    if method == 'historical':
+        var, es = rolling_historical(values, window, confidenceLevel)
+    elif method == 'normal':
+        var, es = normal_risk_measures(*rolling_moments(values, window), confidenceLevel)
+    elif method == 'student':
+        mu, std = rolling_moments(values, window)
+        var, es = student_risk_measures(mu, std, dof, confidenceLevel)
+    else:
+        raise Exception(f"Unknown method {method}. Use 'historical', 'normal' or 'student'.")
+
+    if isinstance(returns, pd.Series):
+        df = pd.DataFrame({'VaR': var[:, 0], 'ES': es[:, 0]}, index=frame.index)
+    else:
+        columns = pd.MultiIndex.from_product([frame.columns, ['VaR', 'ES']])
+        df = pd.DataFrame(np.stack([var, es], axis=2).reshape(len(frame), -1), index=frame.index, columns=columns)
+
+    return df.iloc[window - 1:]
@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from BenUpFin import preProcessing as pp
+
+
+class ReturnsMatrix:
+
+    def __init__(self, path: str, values: np.ndarray, index: pd.Index, columns: [str], base=None,
+                 version: str = None):
+        """
+        Returns matrix backed by a memory-mapped file. It is built once (see build / from_prices) and attached
+        read-only by every process: the pages are shared through the OS page cache, so attaching costs neither a
+        copy nor memory proportional to the universe. Pickling only sends the path, so instances can be passed to
+        process-pool workers as they are.
+        Each build writes a new version of the files in its own sub-directory and then switches the CURRENT pointer
+        file, so a matrix being rebuilt is never attached half written and attached matrices keep their version.
+        Use attach / build / from_prices rather than the constructor.
+        @param base: date of the prices the first returns are computed from (None when unknown).
+        """
+        self.path = path
+        self.version = version
+        self.values = values
+        self.index = index
+        self.columns = list(columns)
+        self.base = base
+        self._positions = {name: i for i, name in enumerate(self.columns)}
+
+    @staticmethod
+    def _files(path: str) -> (str, str, str, str):
+        return tuple(os.path.join(path, f'{name}.npy') for name in ('values', 'index', 'columns', 'base'))
+
+    @classmethod
+    def build(cls, path: str, returns, base=None) -> "ReturnsMatrix":
+        """
+        Write the returns to `path` (a directory) and attach them.
+        @param returns: Dataframe of returns or preProcessing.ReturnsArray.
+        @param base: date of the prices the first returns are computed from, if known.
+        """
+        if isinstance(returns, pd.DataFrame):
+            returns = pp.ReturnsArray(returns.values, returns.index, list(returns.columns))
+        os.makedirs(path, exist_ok=True)
+        previous = cls._current(path)
+        version = os.path.basename(tempfile.mkdtemp(prefix='version-', dir=path))
+        valuesFile, indexFile, columnsFile, baseFile = cls._files(os.path.join(path, version))
+        values = np.lib.format.open_memmap(valuesFile, mode='w+', dtype=returns.values.dtype,
+                                           shape=returns.values.shape)
+        values[:] = returns.values
+        values.flush()
+        del values
+        np.save(indexFile, np.asarray(returns.index.values))
+        np.save(columnsFile, np.array([str(name) for name in returns.columns]))
+        np.save(baseFile, np.asarray([] if base is None else [np.datetime64(pd.Timestamp(base))]))
+        # every file of the version is complete before the pointer is (atomically) switched to it
+        pointer = os.path.join(path, 'CURRENT')
+        with open(f'{pointer}.{os.getpid()}.tmp', 'w') as file:
+            file.write(version)
+        os.replace(f'{pointer}.{os.getpid()}.tmp', pointer)
+        # the previous version is kept for the matrices still attached to it, older ones are removed
+        for name in os.listdir(path):
+            if name.startswith('version-') and name not in (version, previous):
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+        return cls.attach(path)
+
+    @classmethod
+    def from_prices(cls, path: str, data: pd.DataFrame(), tickers: [str], method: str = 'percent',
+                    dtype=None) -> "ReturnsMatrix":
+        """
+        Compute the daily returns of an "Adj Close" Dataframe (see preProcessing.get_daily_returns) and build the
+        shared matrix.
+        """
+        return cls.build(path, pp.get_daily_returns(data, tickers, method=method, dtype=dtype, as_array=True),
+                         base=data.index[0])
+
+    @staticmethod
+    def _current(path: str):
+        """
+        @return: the version the CURRENT file of `path` points to, None for a matrix without versions.
+        """
+        try:
+            with open(os.path.join(path, 'CURRENT')) as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def attach(cls, path: str, version: str = None) -> "ReturnsMatrix":
+        """
+        Attach (zero-copy, read-only) a matrix previously built in `path`.
+        @param version: version to attach. Default the current one.
+        """
+        version = version or cls._current(path)
+        valuesFile, indexFile, columnsFile, baseFile = cls._files(path if version is None else
+                                                                 os.path.join(path, version))
+        values = np.load(valuesFile, mmap_mode='r')
+        index = pd.Index(np.load(indexFile))
+        columns = np.load(columnsFile).tolist()
+        base = pd.Index(np.load(baseFile)) if os.path.exists(baseFile) else ()
+        return cls(path, values, index, columns, base[0] if len(base) else None, version)
+
+    def __reduce__(self):
+        return ReturnsMatrix.attach, (self.path, self.version)
+
+    @property
+    def shape(self) -> (int, int):
+        return self.values.shape
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def to_frame(self, tickers: [str] = None) -> pd.DataFrame:
+        """
+        @param tickers: columns to keep. None, or a run of consecutive columns, gives a Dataframe sharing the memory
+        map; any other selection copies the selected columns.
+        @return: Dataframe of returns indexed by date.
+        """
+        if tickers is None or list(tickers) == self.columns:
+            return pd.DataFrame(self.values, index=self.index, columns=self.columns, copy=False)
+        positions = [self._positions[str(name)] for name in tickers]
+        if positions == list(range(positions[0], positions[0] + len(positions))):
+            values = self.values[:, positions[0]:positions[0] + len(positions)]
+        else:
+            values = self.values[:, positions]
+        return pd.DataFrame(values, index=self.index, columns=list(tickers), copy=False)
@@ -1,27 +1,248 @@
+import numpy as np
 import pandas as pd
 
-from BenUpFin.dataGenerator import Data
+from BenUpFin.priceStore import PriceStore
+from BenUpFin.sharedReturns import ReturnsMatrix
+
+
+def _rolling_sum(values: np.ndarray, period: int) -> np.ndarray:
+    """
+    Sum over the last `period` rows of every column of a (T x n) array, from the difference of two cumulative sums.
+    As DataFrame.rolling(period).sum(), windows that are not full or contain a NaN are NaN.
+    """
+    missing = np.isnan(values)
+    sums = np.cumsum(np.where(missing, 0, values), axis=0)
+    counts = np.cumsum(missing, axis=0)
+    rolled = np.full(values.shape, np.nan)
+    rolled[period - 1:] = sums[period - 1:]
+    rolled[period:] -= sums[:-period]
+    gaps = counts[period - 1:].copy()
+    gaps[1:] -= counts[:-period]
+    rolled[period - 1:][gaps > 0] = np.nan
+    return rolled
+
+
+def _rolling_extremum(values: np.ndarray, period: int, function) -> np.ndarray:
+    """
+    np.max or np.min over the last `period` rows of every column (NaN when the window is not full).
+    """
+    rolled = np.full(values.shape, np.nan)
+    if len(values) >= period:
+        rolled[period - 1:] = function(np.lib.stride_tricks.sliding_window_view(values, period, axis=0), axis=-1)
+    return rolled
+
+
+class IndicatorPanel:
+
+    def __init__(self, close: pd.DataFrame, high: pd.DataFrame = None, low: pd.DataFrame = None,
+                 volume: pd.DataFrame = None):
+        """
+        Technical indicators of many tickers at once. Every field is a wide Dataframe (dates x tickers) and every
+        indicator is computed with column-wise rolling operations over the whole panel, so screening a universe is
+        one pass over the data. Each indicator returns a panel with the same dates and tickers as the prices (the
+        first dates of a rolling window, or of a ticker listed later, are NaN).
+        @param close: closing prices. high, low and volume are only needed by the stochastic oscillator, the on
+        balance volume and the Chaikin money flow.
+        """
+        self.close = close
+        self._closeValues = self._values(close)
+        self.high = None if high is None else high.reindex(index=close.index, columns=close.columns)
+        self.low = None if low is None else low.reindex(index=close.index, columns=close.columns)
+        self.volume = None if volume is None else volume.reindex(index=close.index, columns=close.columns)
+        self._delta = None
+
+    def _panel(self, values: np.ndarray) -> pd.DataFrame:
+        return pd.DataFrame(values, index=self.close.index, columns=self.close.columns, copy=False)
+
+    @staticmethod
+    def _values(frame: pd.DataFrame) -> np.ndarray:
+        return frame.to_numpy(np.float64)
+
+    @classmethod
+    def from_prices(cls, data: pd.DataFrame(), tickers: [str] = None) -> "IndicatorPanel":
+        """
+        @param data: Dataframe with (field, ticker) columns, as yf.download or PriceStore.download.
+        """
+        tickers = list(data['Close'].columns) if tickers is None else list(tickers)
+        fields = {field: data[field][tickers] if field in data.columns.get_level_values(0) else None
+                  for field in ('High', 'Low', 'Volume')}
+        return cls(data['Close'][tickers], fields['High'], fields['Low'], fields['Volume'])
+
+    @classmethod
+    def from_store(cls, store: PriceStore, tickers: [str], period: str = None, start=None, end=None,
+                   update: bool = True) -> "IndicatorPanel":
+        """
+        Read the Close, High, Low and Volume panels of `tickers` from a priceStore.PriceStore (one bulk read per
+        field).
+        @param period: yfinance-like period ("1y", "6mo"...), used when start is not given.
+        @param update: fetch the missing dates first (a single call to the store's fetcher for all the tickers).
+        """
+        data = store.download(tickers, start=start, end=end, period=period,
+                              fields=('Close', 'High', 'Low', 'Volume'), update=update)
+        return cls.from_prices(data, tickers)
+
+    @classmethod
+    def from_returns(cls, returns, tickers: [str] = None) -> "IndicatorPanel":
+        """
+        Close-only panel rebuilt from (percent) returns, as price levels starting at 1: enough for sma, macd,
+        bollinger_bands, rsi and price_rate_of_change.
+        @param returns: Dataframe of returns or sharedReturns.ReturnsMatrix.
+        """
+        frame = returns.to_frame(tickers) if isinstance(returns, ReturnsMatrix) else \
+            (returns if tickers is None else returns[list(tickers)])
+        return cls(np.cumprod(1 + frame))
+
+    def _field(self, name: str) -> pd.DataFrame:
+        field = getattr(self, name)
+        if field is None:
+            raise Exception(f"The {name} prices are needed by this indicator.")
+        return field
+
+    def _close_delta(self) -> np.ndarray:
+        # shared by rsi and on_balance_volume
+        if self._delta is None:
+            self._delta = np.full(self._closeValues.shape, np.nan)
+            self._delta[1:] = self._closeValues[1:] - self._closeValues[:-1]
+        return self._delta
+
+    def sma(self, period: int = 5) -> pd.DataFrame:
+        """
+        @param period: number of days over which the average is calculated. Usual values are 5, 20, 50, 252.
+        @return: moving average of the closing prices.
+        """
+        return self._panel(_rolling_sum(self._closeValues, period) / period)
+
+    def macd(self, period1: int = 5, period2: int = 20) -> pd.DataFrame:
+        """
+        Difference between the moving averages over period1 and period2 (period1 < period2). Buy signal when it
+        crosses 0 from below, sell signal when it crosses 0 from above.
+        """
+        if period1 >= period2:
+            raise Exception("period1 must be lower than period2.")
+        return self.sma(period1) - self.sma(period2)
+
+    def bollinger_bands(self, period: int = 20, width: float = 2) -> pd.DataFrame:
+        """
+        Moving average of the closing prices and bands `width` rolling standard deviations above and below it.
+        @return: Dataframe with (band, ticker) columns, band in "sma", "lower", "upper".
+        """
+        # the moments are taken around the first price of each ticker to limit the cancellation in the variance
+        shifted = self._closeValues - self.close.bfill().to_numpy(np.float64)[:1]
+        sums, squares = _rolling_sum(shifted, period), _rolling_sum(shifted ** 2, period)
+        variance = np.maximum(squares - sums ** 2 / period, 0) / (period - 1)
+        sma = self.sma(period)
+        std = self._panel(np.sqrt(variance))
+        return pd.concat({'sma': sma, 'lower': sma - width * std, 'upper': sma + width * std}, axis=1)
+
+    def rsi(self, period: int = 14) -> pd.DataFrame:
+        """
+        Relative strength index, from 0 to 100: above 70 the stock may be overbought, below 30 oversold.
+        """
+        delta = self._close_delta()
+        up = _rolling_sum(np.maximum(delta, 0), period)
+        down = _rolling_sum(np.maximum(-delta, 0), period)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self._panel(100 - 100 / (1 + up / down))
+
+    def stochastic_oscillator(self, period: int = 14) -> pd.DataFrame:
+        """
+        Level of the closing price in the low-high range of the last `period` days, from 0 to 100.
+        """
+        highestHigh = _rolling_extremum(self._values(self._field('high')), period, np.max)
+        lowestLow = _rolling_extremum(self._values(self._field('low')), period, np.min)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self._panel(100 * (self._closeValues - lowestLow) / (highestHigh - lowestLow))
+
+    def price_rate_of_change(self, n: int = 1) -> pd.DataFrame:
+        """
+        @param n: number of days over which the rate of change is computed.
+        @return: change of the closing price with respect to the price n days ago, as a fraction of the latter.
+        """
+        return self.close.pct_change(n, fill_method=None)
+
+    def on_balance_volume(self) -> pd.DataFrame:
+        """
+        Cumulated volume, counted positively on up days and negatively on down days (0 on the first date).
+        """
+        signed = np.sign(self._close_delta()) * self._values(self._field('volume'))
+        obv = np.cumsum(np.nan_to_num(signed), axis=0)
+        return self._panel(np.where(np.isnan(self._closeValues), np.nan, obv))
+
+    def chaikin_money_flow(self, n: int = 20) -> pd.DataFrame:
+        """
+        Money flow volume (volume weighted by the position of the close in the low-high range, from -1 to 1) summed
+        over n days, over the volume of the n days. Buy signal when it crosses 0 from below while the price rises.
+        """
+        high, low, volume = (self._values(self._field(name)) for name in ('high', 'low', 'volume'))
+        close = self._closeValues
+        with np.errstate(divide='ignore', invalid='ignore'):
+            multiplier = ((close - low) - (high - close)) / (high - low)
+            # a day with no range does not move the money flow
+            multiplier[high == low] = 0
+            return self._panel(_rolling_sum(multiplier * volume, n) / _rolling_sum(volume, n))
+
+    def compute(self, indicators=None) -> {}:
+        """
+        @param indicators: {name: {parameters}} of the methods to run (e.g. {"rsi": {"period": 14}}), or a list of
+        names run with their default parameters. Default every indicator the available fields allow.
+        @return: {name: panel}
+        """
+        if indicators is None:
+            indicators = ['sma', 'macd', 'bollinger_bands', 'rsi', 'price_rate_of_change']
+            if self.high is not None and self.low is not None:
+                indicators.append('stochastic_oscillator')
+            if self.volume is not None:
+                indicators.append('on_balance_volume')
+                if self.high is not None and self.low is not None:
+                    indicators.append('chaikin_money_flow')
+        if not isinstance(indicators, dict):
+            indicators = {name: {} for name in indicators}
+        return {name: getattr(self, name)(**parameters) for name, parameters in indicators.items()}
 
 
 class Indicators:
 
-    def __init__(self, ticker: str, period: str):
+    def __init__(self, ticker: str, period: str, store: PriceStore, update: bool = True):
         """
         Technical indicators are function of the market activity for a financial asset.
         They attempt to uncover patters in market behavior using market activity data to produce
-        trading signals.
+        trading signals. The prices are only read (see IndicatorPanel.from_store) when the first indicator is
+        computed; use IndicatorPanel directly to compute the indicators of many tickers at once.
         @param ticker: Symbol of the company to analyze ( ex: Apple -> APPL)
+        @param period: history to use ("1y", "6mo"...).
+        @param store: priceStore.PriceStore the prices are read from.
+        @param update: fetch the missing dates first. False only reads the local store.
         """
-        data = Data(ticker)
-        self.series = data.get_close_only(data.oclhv(period))
+        self.ticker = ticker
+        self.period = period
+        self.store = store
+        self.update = update
+        self._panel = None
 
-    def sma(self, period: int = 5) -> pd.DataFrame:
+    @property
+    def panel(self) -> IndicatorPanel:
+        if self._panel is None:
+            self._panel = IndicatorPanel.from_store(self.store, [self.ticker], period=self.period, update=self.update)
+        return self._panel
+
+    @property
+    def series(self) -> pd.DataFrame:
+        """
+        @return: Dataframe with the Close, High, Low and Volume columns of the ticker.
+        """
+        panel = self.panel
+        return pd.DataFrame({name.capitalize(): getattr(panel, name)[self.ticker]
+                             for name in ('close', 'high', 'low', 'volume')})
+
+    def _column(self, panel: pd.DataFrame, name: str) -> pd.DataFrame:
+        return panel[[self.ticker]].set_axis([name], axis=1).dropna()
+
+    def sma(self, period: int = 5) -> pd.Series:
         """
-        When the MACD goes below the Signal line, it indicates a sell signal. When it goes above the SignalLine, it indicates a buy signal.
         @param period: Rolling period (number  of days over which the average is calculated. Usual value are 5, 20, 50, 252
-        @return: Dataframe on which moving average had been applied. Depending on the period length  (n), the n first index will be dropped.
+        @return: Series on which moving average had been applied. Depending on the period length  (n), the n first index will be dropped.
         """
-        return self.series['Close'].rolling(period).mean().dropna()
+        return self.panel.sma(period)[self.ticker].dropna()
 
     def macd(self, period1: int = 5, period2: int = 20) -> pd.DataFrame:
         """
@@ -30,27 +251,16 @@ class Indicators:
         Sell signal when crosses O from above.
         @return: Dataframe of the difference between two moving average with different lengths.
         """
-        assert period1 < period2
-        df = pd.DataFrame()
-        df['MACD'] = self.sma(period1) - self.sma(period2)
-
-        return df
+        return self._column(self.panel.macd(period1, period2), 'MACD')
 
     def bollinger_bands(self, period: int = 20) -> pd.DataFrame:
         """
         Compute the bollinger bands on the the simple moving average (given a period).
         If sma crosses lower band from under, then buy signal. If sma crosses upper band from above, then sell signal.
         @param period: The bollinger band is computed typically on the 20 days moving average.
-        @return: Dataframe with 4 columns (sma, lower, upper, signal)
+        @return: Dataframe with 3 columns (sma, lower, upper)
         """
-        # Generating the 3 components of the bollinger bands
-        df = pd.DataFrame()
-        df['sma'] = self.sma(period)
-        std_dev = df['sma'].std()
-        df['lower'] = df['sma'] - 2 * std_dev
-        df['upper'] = df['sma'] + 2 * std_dev
-
-        return df
+        return self.panel.bollinger_bands(period).xs(self.ticker, axis=1, level=1).dropna()
 
     def rsi(self, period: int = 14) -> pd.DataFrame():
         """
@@ -58,21 +268,7 @@ class Indicators:
         when RSI is below 30, it may indicate the stock is oversold.
         @return: Dataframe with the rsa component. This dataframe is shorter as we lose the n = period first indexes.
         """
-        # Creating up and down series based on the original price series
-        delta = self.series['close'].diff()
-        up_days = delta.copy()
-        up_days[delta <= 0] = 0.0
-        down_days = abs(delta.copy())
-        down_days[delta > 0] = 0.0
-        # Getting the mean of the up and down series over a given period
-        rs_up = up_days.rolling(period).mean()
-        rs_down = down_days.rolling(period).mean()
-        rsi = 100 - 100 / (1 + rs_up / rs_down)
-        # Create dataframe
-        df = pd.DataFrame(index=self.series.index)
-        df['RSI'] = rsi
-
-        return df.dropna()
+        return self._column(self.panel.rsi(period), 'RSI')
 
     def stochastic_oscillator(self, period: int = 14) -> pd.DataFrame():
         """
@@ -81,12 +277,7 @@ class Indicators:
         @param period: Number of days over which the moving average is computed for low and high prices' series
         @return: Dataframe with data relative to the stochastic oscillator. Shorter than the original series.
         """
-        highest_high = self.series['High'].rolling(period).max()
-        lowest_low = self.series['Low'].rolling(period).min()
-        k = 100 * (self.series['Close'] - lowest_low) / highest_high - lowest_low
-        df = pd.DataFrame()
-        df['Stochastic Oscillator'] = k
-        return df.dropna()
+        return self._column(self.panel.stochastic_oscillator(period), 'Stochastic Oscillator')
 
     def price_rate_of_change(self, n: int = 1) -> pd.DataFrame():
         """
@@ -94,13 +285,7 @@ class Indicators:
         @param n: number of days over which the rate of change is computed. default = 1.
         @return: Dataframe with the price rate of change. the n first indexes are dropped.
         """
-        numerator = self.series['Close'].diff(n)
-        denumerator = self.series['Close'].shift(n)
-        proc = numerator / denumerator
-        df = pd.DataFrame()
-        df['PROC'] = proc
-
-        return df.dropna()
+        return self._column(self.panel.price_rate_of_change(n), 'PROC')
 
     def on_balance_volume(self) -> pd.DataFrame():
         """
@@ -109,20 +294,7 @@ class Indicators:
         Conversely, falling OBV reflects negative volume pressure that can foreshadow lower prices.
         @return: Dataframe
         """
-        i = 0
-        obv = [0]
-        while i < self.series.index[-1]:
-            if self.series.loc[i + 1, 'Close'] - self.series.loc[i, 'Close'] > 0:
-                obv.append(self.series.loc[i + 1, 'Volume'])
-            if self.series.loc[i + 1, 'Close'] - self.series.loc[i, 'Close'] == 0:
-                obv.append(0)
-            if self.series.loc[i + 1, 'Close'] - self.series.loc[i, 'Close'] < 0:
-                obv.append(-self.series.loc[i + 1, 'Volume'])
-            i = i + 1
-
-        df = pd.DataFrame(obv, columns=['OBV'], index=self.series.index)
-
-        return df
+        return self._column(self.panel.on_balance_volume(), 'OBV')
 
     def chaikin_money_flow(self, n: int = 20) -> pd.DataFrame():
         """
@@ -132,10 +304,4 @@ class Indicators:
         @param n: number of days on which the rolling window is performed
         @return: Dataframe where the n first indexes are dropped (nans).
         """
-        mfv = self.series['Volume'] * (2 * self.series['High'] - self.series['Low']) / \
-              (self.series['High'] - self.series['Low'])
-        c_mfv = mfv.rolling(n).sum() / self.series['Volume'].rolling(n).sum()
-        df = pd.DataFrame(c_mfv, columns=['CMF'], index = self.series.index)
-
-        return df.dropna()
-
+        return self._column(self.panel.chaikin_money_flow(n), 'CMF')
@@ -0,0 +1,338 @@
+import os
+import pickle
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+from BenUpFin.garch import GARCH
+from BenUpFin import optionValuation as ov
+from BenUpFin.monteCarlo import MultivariateMonteCarloEngine, BootstrapEngine, tail_risk_measures, \
+    normal_risk_measures, student_risk_measures
+from BenUpFin.rollingRisk import rolling_risk_measures
+from BenUpFin.priceStore import PriceStore, CSVFetcher, last_session
+from BenUpFin.riskMetrics import Metrics
+from BenUpFin import perfMetrics
+from BenUpFin.sharedReturns import ReturnsMatrix
+
+
+def make_prices(nb_tickers: int = 5, length: int = 400, seed: int = 0) -> (pd.DataFrame, [str]):
+    rng = np.random.default_rng(seed)
+    tickers = [f"T{i}" for i in range(nb_tickers)]
+    returns = rng.normal(5e-4, 0.02, (length, nb_tickers)) + rng.normal(0, 0.01, (length, 1))
+    prices = 100 * np.cumprod(1 + returns, axis=0)
+    index = pd.bdate_range('2020-01-01', periods=length)
+    return pd.DataFrame(prices, index=index, columns=pd.MultiIndex.from_product([['Adj Close'], tickers])), tickers
+
+
+class MultivariateMonteCarloTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        a = rng.normal(size=(4, 4)) * 0.01
+        self.mu = np.full(4, 2e-4)
+        self.cov = a @ a.T
+        self.weights = np.full(4, 0.25)
+
+    def engine(self, seed=7, n_workers=1):
+        return MultivariateMonteCarloEngine(self.mu, self.cov, self.weights, nb_simulation=20000, blockSize=3000,
+                                            chunkSize=1000, seed=seed, n_workers=n_workers)
+
+    def test_same_result_for_any_number_of_workers(self):
+        var1, es1 = self.engine(n_workers=1).risk_measures((95, 99))
+        var2, es2 = self.engine(n_workers=2).risk_measures((95, 99))
+        np.testing.assert_array_equal(var1, var2)
+        np.testing.assert_array_equal(es1, es2)
+
+    def test_fixed_seed_is_reproducible_across_calls(self):
+        engine = self.engine()
+        np.testing.assert_array_equal(engine.risk_measures()[0], engine.risk_measures()[0])
+
+    def test_generator_seed(self):
+        var1, _ = self.engine(seed=np.random.default_rng(3)).risk_measures()
+        var2, _ = self.engine(seed=np.random.default_rng(3)).risk_measures()
+        np.testing.assert_array_equal(var1, var2)
+
+
+class BootstrapTest(unittest.TestCase):
+
+    def test_tail_matches_full_sort_despite_ties(self):
+        # 50 dates resampled 20000 times: the scenarios are full of ties at the cut
+        returns = np.random.default_rng(0).normal(size=(50, 2))
+        for horizon, chunkSize in ((1, 777), (3, 5000)):
+            engine = BootstrapEngine(returns, nb_simulation=20000, horizon=horizon, chunkSize=chunkSize, seed=3)
+            var, es = engine.risk_measures((95, 99))
+            engine = BootstrapEngine(returns, nb_simulation=20000, horizon=horizon, chunkSize=chunkSize, seed=3)
+            scenarios = np.sort(np.vstack([chunk.copy() for chunk in engine.simulate()]), axis=0)
+            expectedVar, expectedEs = tail_risk_measures(scenarios, len(scenarios), (95, 99), inclusive=True)
+            np.testing.assert_allclose(var, expectedVar)
+            np.testing.assert_allclose(es, expectedEs)
+
+
+class GarchTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        returns, variance = np.empty((600, 3)), np.full(3, 1e-4)
+        for t, shock in enumerate(rng.normal(size=(600, 3))):
+            returns[t] = np.sqrt(variance) * shock
+            variance = 2e-6 + 0.08 * returns[t] ** 2 + 0.9 * variance
+        self.returns = pd.DataFrame(returns, index=pd.bdate_range('2020-01-01', periods=600), columns=['A', 'B', 'C'])
+        self.full = GARCH().fit(self.returns)
+
+    def test_batch_fit_converges_per_series(self):
+        self.assertTrue(self.full.converged.all())
+        self.assertTrue((self.full.params['alpha'] + self.full.params['beta'] < 1).all())
+
+    def test_update_with_a_row(self):
+        last = self.returns.iloc[-1]
+        for row in (last, last.values, self.returns.iloc[-1:]):
+            model = GARCH().fit(self.returns.iloc[:-1]).update(row)
+            self.assertEqual(model.index[-1], self.returns.index[-1])
+            np.testing.assert_allclose(model.params.values, self.full.params.values, rtol=1e-2, atol=1e-4)
+
+
+class WhatIfTest(unittest.TestCase):
+
+    def test_ewma_window_longer_than_the_history(self):
+        data, tickers = make_prices(length=300)
+        metrics = Metrics(data, tickers, np.full(5, 0.2))
+        results = metrics.whatif_RiskMeasures(np.full((3, 5), 0.2), window=400)
+        self.assertTrue(np.isnan(results['EWMA VaR']).all())
+        self.assertTrue(metrics.EWMA_RiskMeasures_Portfolio(window=400).empty)
+        np.testing.assert_allclose(results['normal VaR'], metrics.whatif_RiskMeasures(np.full(5, 0.2))['normal VaR'][0])
+
+
+class MetricsCacheTest(unittest.TestCase):
+
+    def test_mutating_the_weights_list_does_not_change_the_cached_figures(self):
+        data, tickers = make_prices()
+        weights = [0.2] * 5
+        metrics = Metrics(data, tickers, weights)
+        before = metrics.historicalPortfolioVaR()
+        weights[0], weights[1] = 1.0, -0.6
+        self.assertEqual(metrics.historicalPortfolioVaR(), before)
+        self.assertEqual(Metrics(data, tickers, [0.2] * 5).historicalPortfolioVaR(), before)
+        with self.assertRaises(ValueError):
+            metrics.weights[0] = 1.0
+        metrics.weights = weights
+        self.assertEqual(metrics.historicalPortfolioVaR(), Metrics(data, tickers, weights).historicalPortfolioVaR())
+
+
+class OptionPricersTest(unittest.TestCase):
+
+    def test_monte_carlo_matches_bsm_for_a_grid_of_contracts(self):
+        spots, strikes = np.array([90., 100., 110.]), np.array([[95.], [105.]])
+        bsm = ov.bsm_chain(spots, strikes, 1, 0.2, 0.03, 0.01, 'p')
+        result = ov.monte_carlo_price(spots, strikes, 1, 0.2, 0.03, 0.01, 'p', steps=10, nb_paths=40000, seed=1)
+        self.assertEqual(result['price'].shape, (2, 3))
+        np.testing.assert_allclose(result['price'], bsm['price'], atol=4 * result['stderr'].max())
+        np.testing.assert_allclose(result['delta'], bsm['delta'], atol=0.02)
+
+    def test_european_lattice_matches_bsm(self):
+        spots = np.array([90., 100., 110.])
+        bsm = ov.bsm_chain(spots, 100, 0.5, 0.25, 0.02, 0, 'c')
+        lattice = ov.lattice_price(spots, 100, 0.5, 0.25, 0.02, 0, 'c', american=False, steps=1000)
+        np.testing.assert_allclose(lattice['price'], bsm['price'], atol=0.02)
+        np.testing.assert_allclose(lattice['delta'], bsm['delta'], atol=1e-3)
+
+    def test_american_implied_volatility_reprices_the_premium(self):
+        spots, sigma = np.array([90., 100., 110.]), np.array([0.15, 0.25, 0.4])
+        price = ov.lattice_price(spots, 100, 1, sigma, 0.05, 0, 'p', steps=200)['price']
+        result = ov.lattice_implied_volatility(price, spots, 100, 1, 0.05, 0, 'p', steps=200)
+        self.assertTrue(result['converged'].all())
+        np.testing.assert_allclose(result['volatility'], sigma, atol=1e-5)
+        # deep in the money the option is worth its exercise value whatever the volatility
+        exercised = ov.lattice_implied_volatility(40., 60., 100, 1, 0.05, 0, 'p', steps=200)
+        self.assertFalse(exercised['converged'])
+        self.assertTrue(np.isnan(exercised['volatility']))
+
+
+class ImpliedVolatilityTest(unittest.TestCase):
+
+    def test_chain_is_inverted_or_flagged(self):
+        rng = np.random.default_rng(0)
+        size = 20000
+        s, k = rng.uniform(50, 150, size), rng.uniform(50, 150, size)
+        T, sigma = rng.uniform(0.01, 3, size), rng.uniform(0.03, 1.5, size)
+        typeOption = np.where(rng.random(size) < 0.5, 'c', 'p')
+        price = ov.bsm_chain(s, k, T, sigma, 0.03, 0.01, typeOption, greeks=False)['price']
+        result = ov.implied_volatility(price, s, k, T, 0.03, 0.01, typeOption)
+        converged = result['converged']
+        self.assertGreater(converged.mean(), 0.9)
+        np.testing.assert_allclose(result['volatility'][converged], sigma[converged], atol=1e-6)
+        self.assertTrue(np.isnan(result['volatility'][~converged]).all())
+        # quotes below the price tolerance carry no information on the volatility
+        self.assertFalse(converged[price <= 1e-8].any())
+
+
+class RollingRiskTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # rounded returns, so that the windows contain ties
+        self.returns = pd.DataFrame(np.round(rng.standard_t(4, (300, 2)) * 0.01, 3),
+                                    index=pd.bdate_range('2020-01-01', periods=300), columns=['A', 'B'])
+        self.window = 60
+
+    def windows(self):
+        for end in range(self.window, len(self.returns) + 1):
+            yield self.returns.iloc[end - self.window:end]
+
+    def test_historical_matches_each_window(self):
+        rolling = rolling_risk_measures(self.returns, self.window, 'historical')
+        for (date, row), window in zip(rolling.iterrows(), self.windows()):
+            values = np.sort(window.values, axis=0)
+            var, es = tail_risk_measures(values, len(values), [0.95], inclusive=True)
+            np.testing.assert_allclose(row.values, np.stack([var[0], es[0]], axis=1).ravel())
+
+    def test_parametric_matches_each_window(self):
+        for method, measures in (('normal', normal_risk_measures),
+                                 ('student', lambda mu, std, c: student_risk_measures(mu, std, 5, c))):
+            rolling = rolling_risk_measures(self.returns, self.window, method)
+            for (date, row), window in zip(rolling.iterrows(), self.windows()):
+                var, es = measures(window.mean().values, window.std(ddof=0).values, 0.95)
+                np.testing.assert_allclose(row.values, np.stack([var, es], axis=1).ravel(), rtol=1e-8, atol=1e-12)
+
+
+class RiskDecompositionTest(unittest.TestCase):
+
+    def setUp(self):
+        data, tickers = make_prices()
+        self.weights = np.array([0.3, 0.25, 0.2, 0.15, 0.1])
+        self.metrics = Metrics(data, tickers, self.weights)
+
+    def test_normal_marginals_match_finite_differences(self):
+        decomposition = self.metrics.risk_decomposition('normal')
+        h = 1e-6
+        bumps = np.eye(len(self.weights)) * h
+        up = self.metrics.whatif_RiskMeasures(self.weights + bumps)
+        down = self.metrics.whatif_RiskMeasures(self.weights - bumps)
+        for measure in ('VaR', 'ES'):
+            derivative = (up[f'normal {measure}'] - down[f'normal {measure}']) / (2 * h)
+            np.testing.assert_allclose(decomposition[f'marginal {measure}'].values, derivative, rtol=1e-6, atol=1e-9)
+
+    def test_normal_components_sum_to_portfolio_figure(self):
+        decomposition = self.metrics.risk_decomposition('normal')
+        portfolio = self.metrics.whatif_RiskMeasures(self.weights)
+        for measure in ('VaR', 'ES'):
+            self.assertAlmostEqual(decomposition[f'component {measure}'].sum(), portfolio[f'normal {measure}'][0])
+
+    def test_incremental_figures_match_removing_each_position(self):
+        without = self.weights * (1 - np.eye(len(self.weights)))
+        portfolio = self.metrics.whatif_RiskMeasures(self.weights)
+        removed = self.metrics.whatif_RiskMeasures(without)
+        for method in ('normal', 'historical'):
+            decomposition = self.metrics.risk_decomposition(method)
+            for measure in ('VaR', 'ES'):
+                key = f'{method} {measure}'
+                np.testing.assert_allclose(decomposition[f'incremental {measure}'].values,
+                                           portfolio[key][0] - removed[key], atol=1e-12)
+
+
+class ReturnsMatrixTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data, self.tickers = make_prices(length=300)
+        self.directory = tempfile.TemporaryDirectory()
+        self.matrix = ReturnsMatrix.from_prices(self.directory.name, self.data, self.tickers)
+
+    def tearDown(self):
+        del self.matrix
+        self.directory.cleanup()
+
+    def test_performance_metrics_match_the_prices(self):
+        fromPrices = perfMetrics.Metrics(self.data, self.tickers)
+        fromMatrix = perfMetrics.Metrics(ReturnsMatrix.attach(self.directory.name), self.tickers)
+        self.assertEqual(fromMatrix.get_years_past(), fromPrices.get_years_past())
+        pd.testing.assert_series_equal(fromMatrix.compound_annual_growth_rate(),
+                                       fromPrices.compound_annual_growth_rate())
+
+
+    def test_rebuild_switches_every_file_at_once(self):
+        returns = self.matrix.to_frame()
+        shorter = returns.iloc[:100, :2] * 2
+        rebuilt = ReturnsMatrix.build(self.directory.name, shorter)
+        attached = ReturnsMatrix.attach(self.directory.name)
+        pd.testing.assert_frame_equal(attached.to_frame(), shorter, check_freq=False)
+        self.assertIsNone(attached.base)
+        # a matrix attached before the rebuild (and its pickled copies) keeps its own version
+        pd.testing.assert_frame_equal(pickle.loads(pickle.dumps(self.matrix)).to_frame(), returns)
+        del rebuilt, attached
+
+
+class CountingFetcher(CSVFetcher):
+
+    def __init__(self, directory: str):
+        super().__init__(directory)
+        self.calls = []
+
+    def __call__(self, tickers, start=None, end=None):
+        self.calls.append((list(tickers), start, end))
+        return super().__call__(tickers, start, end)
+
+
+class PriceStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        csv = os.path.join(self.directory.name, 'csv')
+        os.makedirs(csv)
+        data, self.tickers = make_prices(nb_tickers=2, length=60)
+        self.end = data.index[-1]
+        self.prices = data['Adj Close']
+        for name in self.tickers:
+            frame = pd.DataFrame({field: self.prices[name] for field in ('Open', 'High', 'Low', 'Close', 'Adj Close')})
+            frame['Volume'] = 1e6
+            frame.rename_axis('Date').to_csv(os.path.join(csv, f"{name}.csv"))
+        self.fetcher = CountingFetcher(csv)
+        self.store = PriceStore(os.path.join(self.directory.name, 'store'), self.fetcher)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        data = self.store.download(self.tickers, end=self.end)
+        pd.testing.assert_frame_equal(data['Adj Close'], self.prices, check_freq=False, check_names=False,
+                                      check_index_type=False)
+        self.assertEqual(self.store.tickers(), sorted(self.tickers))
+        self.assertEqual(self.store.last_date(self.tickers[0]), self.end)
+
+    def test_incremental_append_and_no_refetch(self):
+        middle = self.prices.index[30]
+        self.store.download(self.tickers, end=middle)
+        self.store.download(self.tickers, end=self.end)
+        # the second call only fetches the dates after the stored ones
+        self.assertEqual(self.fetcher.calls[1][1], middle + pd.Timedelta(days=1))
+        self.store.download(self.tickers, end=self.end)
+        self.assertEqual(len(self.fetcher.calls), 2)
+        pd.testing.assert_frame_equal(self.store.read(self.tickers), self.prices, check_freq=False,
+                                      check_names=False, check_index_type=False)
+
+    def test_read_only(self):
+        self.store.download(self.tickers, end=self.end)
+        self.store.download(self.tickers, update=False)
+        self.assertEqual(len(self.fetcher.calls), 1)
+
+    def test_holiday_is_not_refetched(self):
+        self.store.download(self.tickers, end=self.end)
+        # nothing new after the last stored date: one fetch, then the store is known to be up to date
+        later = self.end + pd.offsets.BDay(3)
+        self.store.download(self.tickers, end=later)
+        self.store.download(self.tickers, end=later)
+        self.assertEqual(len(self.fetcher.calls), 2)
+        self.assertEqual(self.store.checked(self.tickers[0]), last_session(later))
+
+    def test_new_ticker_does_not_refetch_the_others(self):
+        middle = self.prices.index[30]
+        self.store.download(self.tickers[:1], end=middle)
+        self.store.download(self.tickers, end=self.end)
+        # the stored ticker is fetched from its last date, the new one on its own from the start
+        self.assertEqual(sorted(self.fetcher.calls[1:]), sorted([(self.tickers[:1], middle + pd.Timedelta(days=1),
+                                                                  self.end), (self.tickers[1:], None, self.end)]))
+        pd.testing.assert_frame_equal(self.store.read(self.tickers), self.prices, check_freq=False,
+                                      check_names=False, check_index_type=False)
+
+
+if __name__ == '__main__':
+    unittest.main()